@@ -24,10 +24,10 @@ protocol driver, and a wrapped ultramemcached driver.
 While pyermc is somewhat compatible with python-memcached, full
 compatibility is not a design goal.
 
-pyermc supports connecting to a single memcached instance (or server
-that speaks the memcached protocol). If you require multiple servers,
-consistent hashing, etc, then it is recommended to use twemproxy or
-similar.
+pyermc's Client connects to a single memcached instance (or server
+that speaks the memcached protocol). For multiple servers, ShardedClient
+distributes keys with a ketama (libketama compatible) consistent hash
+ring. Proxies such as twemproxy also work.
 
 pyermc exposes connectivity faults, via exceptions, to the calling
 code. This is in contrast to python-memcached, which simply enters an
@@ -58,3 +58,11 @@ del NullHandler
 from .memcache import (
     Client, MAX_KEY_LENGTH, MAX_VALUE_LENGTH,
     MemcacheKeyError, MemcacheValueError, MemcacheDriverException)
+from .compressor import (
+    Compressor, LZ4Compressor, ZlibCompressor, ZstdCompressor,
+    AdaptiveCompression)
+from .localcache import LocalCache
+from .pipeline import Pipeline
+from .pool import ClientPool, MemcachePoolExhausted
+from .serializer import Serializer, PickleSerializer
+from .sharded import ShardedClient
@@ -0,0 +1,138 @@
+# -*- coding: utf8 -*-
+
+# Copyright 2013 Medium Entertainment, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bounded store for the CAS_IDs remembered by `Client` with cache_cas=True.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+# default max number of CAS_IDs remembered per client
+CAS_MAX_ENTRIES = 10000
+
+
+class CasIds(object):
+    """
+    Mapping of key to CAS_ID, evicting the least recently used keys beyond
+    `max_entries`, and optionally dropping entries older than `max_age`.
+
+    Both keys and CAS_IDs are small, so bounding the number of entries
+    bounds the memory used.
+    """
+    def __init__(self, max_entries=CAS_MAX_ENTRIES, max_age=None):
+        """
+        Create a new, empty, CasIds.
+
+        Keyword arguments:
+          max_entries -- max number of CAS_IDs to keep. None means no limit.
+                         default: CAS_MAX_ENTRIES
+          max_age     -- seconds a CAS_ID is kept after being fetched. None
+                         means until evicted.
+                         default: None
+        """
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.evictions = 0
+        self.expirations = 0
+
+        self._lock = threading.Lock()
+        # key -> (cas_id, expires_at), least recently used first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter([k for k, cas_id in self.items()])
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        cas_id = self.get(key)
+        if cas_id is None:
+            raise KeyError(key)
+        return cas_id
+
+    def __setitem__(self, key, cas_id):
+        if self.max_age is None:
+            expires_at = None
+        else:
+            expires_at = time.time() + self.max_age
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (cas_id, expires_at)
+            while (self.max_entries is not None and
+                   len(self._entries) > self.max_entries):
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._entries[key]
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'CasIds(%r)' % dict(self.items())
+
+    def get(self, key, default=None):
+        """
+        returns the CAS_ID of `key`, or `default` if not known
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            if entry[1] is not None and entry[1] <= time.time():
+                self.expirations += 1
+                return default
+            # re-insert as most recently used
+            self._entries[key] = entry
+            return entry[0]
+
+    def items(self):
+        """
+        returns list -- (key, CAS_ID) tuples, least recently used first.
+                        may include expired entries.
+        """
+        with self._lock:
+            return [(k, v[0]) for k, v in self._entries.iteritems()]
+
+    def clear(self):
+        """
+        Drop everything.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        returns dict -- current size, evictions and expirations
+        """
+        return {
+            'entries': len(self._entries),
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
@@ -0,0 +1,248 @@
+# -*- coding: utf8 -*-
+
+# Copyright 2013 Medium Entertainment, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compressors for stored values. Every codec has its own flag bit, so values
+compressed with different codecs can be read side by side.
+"""
+
+import zlib
+import threading
+
+import lz4
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# flag bit of each codec
+FLAG_LZ4 = 1<<3
+FLAG_ZLIB = 1<<4
+FLAG_ZSTD = 1<<5
+# all of the above
+COMPRESSION_FLAGS = FLAG_LZ4 | FLAG_ZLIB | FLAG_ZSTD
+
+
+class Compressor(object):
+    """
+    Interface of the compressors a `Client` uses for values.
+    """
+    # flag bit set on values compressed by this codec. one of FLAG_LZ4,
+    # FLAG_ZLIB or FLAG_ZSTD, the only bits read as compression. bit 6
+    # marks chunked large values.
+    flag = None
+
+    def compress(self, data):
+        """
+        returns str -- `data` compressed
+        """
+        raise NotImplementedError
+
+    def decompress(self, data):
+        """
+        returns str -- `data` decompressed
+        """
+        raise NotImplementedError
+
+
+class LZ4Compressor(Compressor):
+    """
+    lz4. very fast, the default.
+    """
+    flag = FLAG_LZ4
+
+    def compress(self, data):
+        return lz4.compress(data)
+
+    def decompress(self, data):
+        return lz4.decompress(data)
+
+
+class ZlibCompressor(Compressor):
+    """
+    zlib (deflate). slower than lz4, but compresses better.
+    """
+    flag = FLAG_ZLIB
+
+    def __init__(self, level=6):
+        """
+        Keyword arguments:
+          level -- compression level, 1 (fastest) to 9 (smallest)
+                   default: 6
+        """
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class ZstdCompressor(Compressor):
+    """
+    zstd, optionally with a trained dictionary. Small values that share a
+    structure (eg. JSON documents of the same shape) hardly compress on
+    their own, but do well with a dictionary trained on samples of them.
+
+    Requires the `zstandard` package.
+    """
+    flag = FLAG_ZSTD
+
+    def __init__(self, level=3, dict_data=None):
+        """
+        Keyword arguments:
+          level     -- compression level, 1 (fastest) to 22 (smallest)
+                       default: 3
+          dict_data -- dictionary, as returned by `train_dictionary`. Values
+                       must be read with the same dictionary they were
+                       written with.
+                       default: None
+        """
+        if zstandard is None:
+            raise ImportError("ZstdCompressor requires zstandard")
+        self.level = level
+        if dict_data is not None:
+            dict_data = zstandard.ZstdCompressionDict(dict_data)
+            # precompute once, rather than on every compressor created
+            dict_data.precompute_compress(level=level)
+        self.dict_data = dict_data
+        # zstandard (de)compressors may not be shared between threads
+        self._local = threading.local()
+
+    @staticmethod
+    def train_dictionary(samples, dict_size=16384):
+        """
+        Train a dictionary on sample values.
+
+        Arguments:
+          samples   -- list of str, representative of the values to store
+        Keyword arguments:
+          dict_size -- max size of the dictionary, in bytes
+                       default: 16384
+
+        returns str -- the dictionary
+        """
+        if zstandard is None:
+            raise ImportError("ZstdCompressor requires zstandard")
+        return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+    def _codecs(self):
+        local = self._local
+        if not hasattr(local, 'compressor'):
+            kwargs = {}
+            if self.dict_data is not None:
+                kwargs['dict_data'] = self.dict_data
+            local.compressor = zstandard.ZstdCompressor(
+                level=self.level, **kwargs)
+            local.decompressor = zstandard.ZstdDecompressor(**kwargs)
+        return local
+
+    def compress(self, data):
+        return self._codecs().compressor.compress(data)
+
+    def decompress(self, data):
+        return self._codecs().decompressor.decompress(data)
+
+
+class AdaptiveCompression(object):
+    """
+    Tracks how well values compress per key prefix, and stops compressing
+    the prefixes whose values don't shrink enough to be worth it, saving
+    the CPU otherwise spent compressing only to throw the result away.
+
+    Skipped prefixes are retried every `retry_every` values, in case their
+    data changed.
+    """
+    def __init__(self, min_saving=0.1, samples=20, retry_every=1000,
+                 max_prefixes=1000, prefix=None):
+        """
+        Keyword arguments:
+          min_saving   -- fraction of the size compression must save, on
+                          average, for a prefix to keep being compressed.
+                          default: 0.1
+          samples      -- number of values compressed before deciding.
+                          default: 20
+          retry_every  -- a skipped prefix gets compressed again after
+                          this many values.
+                          default: 1000
+          max_prefixes -- max number of prefixes tracked. Tracking restarts
+                          from scratch beyond that.
+                          default: 1000
+          prefix       -- function returning the prefix of a key.
+                          default: the key up to its first ':'
+        """
+        self.min_saving = min_saving
+        self.samples = samples
+        self.retry_every = retry_every
+        self.max_prefixes = max_prefixes
+        if prefix is None:
+            prefix = lambda key: key.split(':', 1)[0]
+        self.prefix = prefix
+        # prefix -> [values compressed, total size, total compressed size,
+        #            values skipped since the last try]
+        self._prefixes = {}
+
+    def _entry(self, key):
+        prefix = self.prefix(key)
+        entry = self._prefixes.get(prefix)
+        if entry is None:
+            if len(self._prefixes) >= self.max_prefixes:
+                self._prefixes.clear()
+            entry = self._prefixes[prefix] = [0, 0, 0, 0]
+        return entry
+
+    def _skipping(self, entry):
+        return (entry[0] >= self.samples and
+                entry[2] > entry[1] * (1 - self.min_saving))
+
+    def should_compress(self, key):
+        """
+        returns bool -- whether to try compressing the value of `key`
+        """
+        entry = self._entry(key)
+        if not self._skipping(entry):
+            return True
+        entry[3] += 1
+        if entry[3] < self.retry_every:
+            return False
+        # start sampling again from scratch
+        entry[:] = [0, 0, 0, 0]
+        return True
+
+    def record(self, key, size, compressed_size):
+        """
+        Record the result of compressing the value of `key`.
+        """
+        entry = self._entry(key)
+        entry[0] += 1
+        entry[1] += size
+        entry[2] += compressed_size
+
+    def stats(self):
+        """
+        returns dict -- prefix mapped to a dict of the values sampled, their
+                        average compressed/original size ratio, and whether
+                        the prefix is skipped
+        """
+        stats = {}
+        for prefix, entry in self._prefixes.items():
+            stats[prefix] = {
+                'samples': entry[0],
+                'ratio': float(entry[2]) / entry[1] if entry[1] else 1.0,
+                'skipped': self._skipping(entry),
+            }
+        return stats
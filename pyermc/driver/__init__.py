@@ -18,7 +18,7 @@
 Driver backends for pyermc
 """
 
-from .base import Driver
+from .base import Driver, RECV_SIZE, writable_view
 from .textproto import TextProtoDriver
 
 DEFAULT_DRIVER = TextProtoDriver
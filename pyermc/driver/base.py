@@ -19,6 +19,92 @@ import errno
 import socket
 
 
+# default size of each recv from the socket
+RECV_SIZE = 4096
+# initial size of the receive buffer. grows as needed for large values.
+BUFFER_SIZE = 16 * RECV_SIZE
+# pieces of a request at least this long are sent on their own, rather than
+# copied into one str with the rest of the request.
+SEND_COPY_LIMIT = 16384
+# max keys, or items, per window of a multi command. a window is sent, and
+# all of its responses read, before the next one goes out, so neither the
+# request nor the unread responses grow with the number of keys, and a
+# server blocked writing responses can't stall a client still sending.
+MULTI_WINDOW = 1000
+# driver methods whose first argument is a list of keys or items, which
+# pipelines split into windows
+MULTI_COMMANDS = frozenset(
+    ['get_multi', 'gets_multi', 'set_multi', 'delete_multi'])
+
+
+def join_buffers(pieces):
+    """
+    join a list of str and buffers (bytearray, memoryview) into one str.
+    """
+    try:
+        return ''.join(pieces)
+    except TypeError:
+        return ''.join([p if isinstance(p, str) else memoryview(p).tobytes()
+                        for p in pieces])
+
+
+def writable_view(writable, size):
+    """
+    memoryview over the first `size` bytes of a writable buffer. a
+    bytearray is grown as needed, other buffers must be large enough.
+    """
+    if isinstance(writable, bytearray) and len(writable) < size:
+        writable.extend(bytearray(size - len(writable)))
+    view = memoryview(writable)
+    if len(view) < size:
+        raise ValueError(
+            "Buffer too small for value. %d < %d" % (len(view), size))
+    return view[:size]
+
+
+def split_command(command, size):
+    """
+    split a pipeline command on more than `size` keys or items into
+    commands on windows of at most `size` of them. Their responses are put
+    back together with `merge_responses`.
+    """
+    if command[0] not in MULTI_COMMANDS:
+        return [command]
+    items = command[1][0]
+    if not isinstance(items, list):
+        items = list(items)
+    rest = tuple(command[1][1:])
+    return [(command[0], (items[i:i + size],) + rest) + tuple(command[2:])
+            for i in xrange(0, len(items), size)] or [
+                (command[0], (items,) + rest) + tuple(command[2:])]
+
+
+def merge_responses(responses):
+    """
+    merge the responses to the windows of a multi command. dicts (multi
+    gets) are combined, lists (keys that failed) concatenated, and None
+    (noreply commands in a pipeline) skipped.
+    """
+    merged = None
+    for response in responses:
+        if response is None:
+            continue
+        if merged is None:
+            merged = response
+        elif isinstance(merged, dict):
+            merged.update(response)
+        else:
+            merged.extend(response)
+    return merged
+
+
+def _kwargs(command):
+    # keyword arguments of a pipeline_send command, if it has any
+    if len(command) > 2:
+        return command[2]
+    return {}
+
+
 class Driver(object):
     def is_connected(self):
         """
@@ -86,29 +172,41 @@ class Driver(object):
         """
         raise NotImplementedError
 
-    def delete(self, key):
+    def delete(self, key, noreply=False):
         """
         performs DELETE <key>
 
+        param: noreply
+               if true, don't wait for the response, and return None.
+               failures are reported by `sync` instead, where supported.
+
         returns: bool
                  success or failure of command
         """
         raise NotImplementedError
 
-    def incr(self, key, val):
+    def incr(self, key, val, noreply=False):
         """
         performs INCR <key>
 
+        param: noreply
+               if true, don't wait for the response, and return None.
+               failures are reported by `sync` instead, where supported.
+
         returns: None or int
                  If increment fails, return None
                  If increment succeeds, return the new value after increment
         """
         raise NotImplementedError
 
-    def decr(self, key, val):
+    def decr(self, key, val, noreply=False):
         """
         performs DECR <key>
 
+        param: noreply
+               if true, don't wait for the response, and return None.
+               failures are reported by `sync` instead, where supported.
+
         returns: None or int
                  If decrement fails, return None
                  If decrement succeeds, return the new value after decrement
@@ -164,6 +262,32 @@ class Driver(object):
         """
         raise NotImplementedError
 
+    def get_into(self, key, writable):
+        """
+        performs GET <key>, writing a value with no flags set (a plain str)
+        straight into `writable` instead of returning it.
+
+        this default implementation gets the value as usual, and leaves
+        writing it to the caller. TCP drivers override it to read from the
+        socket into `writable`, avoiding any copy of the value.
+
+        param: writable
+               a writable buffer (bytearray, grown as needed, memoryview,
+               ...), or a file like object with a write method.
+
+        returns: None or list
+                 If get fails, return None
+                 If get succeeds, return a list of:
+                    [int, int, str or None]
+                    element 0 is the length of the value. element 1 is the
+                    flag bitfield as int. element 2 is the data as str, or
+                    None if it was written into `writable`.
+        """
+        response = self.get(key)
+        if response is None:
+            return None
+        return [len(response[0]), response[1], response[0]]
+
     def gets_multi(self, keys):
         """
         performs GET_MULTI <key1> <key2> ...
@@ -178,62 +302,190 @@ class Driver(object):
         """
         raise NotImplementedError
 
-    def add(self, key, val, time, flags):
+    def iter_multi(self, keys):
+        """
+        performs GET_MULTI <key1> <key2> ..., yielding each value as soon as
+        it is read.
+
+        this default implementation yields from get_multi. TCP drivers
+        parse responses as they are iterated over. The connection can't be
+        used for anything else until the iterator is exhausted, and is
+        closed if the iterator is closed early.
+
+        returns: iterator
+                 of (key, [str, int]) tuples, as the items of the dict
+                 returned by get_multi
+        """
+        return self.get_multi(keys).iteritems()
+
+    def add(self, key, val, time, flags, noreply=False):
         """
         performs ADD <key> <value>
 
+        param: noreply
+               if true, don't wait for the response, and return None.
+               failures are reported by `sync` instead, where supported.
+
         returns: bool
                  True/False success or failure of command
         """
         raise NotImplementedError
 
-    def append(self, key, val, time, flags):
+    def append(self, key, val, time, flags, noreply=False):
         """
         performs APPEND <key> <value>
 
+        param: noreply
+               if true, don't wait for the response, and return None.
+               failures are reported by `sync` instead, where supported.
+
         returns: bool
                  True/False success or failure of command
         """
         raise NotImplementedError
 
-    def prepend(self, key, val, time, flags):
+    def prepend(self, key, val, time, flags, noreply=False):
         """
         performs PREPEND <key> <value>
 
+        param: noreply
+               if true, don't wait for the response, and return None.
+               failures are reported by `sync` instead, where supported.
+
         returns: bool
                  True/False success or failure of command
         """
         raise NotImplementedError
 
-    def replace(self, key, val, time, flags):
+    def replace(self, key, val, time, flags, noreply=False):
         """
         performs REPLACE <key> <value>
 
+        param: noreply
+               if true, don't wait for the response, and return None.
+               failures are reported by `sync` instead, where supported.
+
         returns: bool
                  True/False success or failure of command
         """
         raise NotImplementedError
 
-    def set(self, key, val, time, flags):
+    def set(self, key, val, time, flags, noreply=False):
         """
         performs SET <key> <value>
 
+        param: val
+               str, or a buffer (bytearray, memoryview). TCP drivers send
+               large values as is, without copying them.
+        param: noreply
+               if true, don't wait for the response, and return None.
+               failures are reported by `sync` instead, where supported.
+
         returns: bool
                  True/False success or failure of command
         """
         raise NotImplementedError
 
+    def set_multi(self, items, time, noreply=False):
+        """
+        performs SET <key> <value> for every item, pipelined
+
+        param: items
+               list of (key, val, flags) tuples
+        param: noreply
+               if true, don't wait for (or ask for, where the protocol
+               allows) responses. failures are then not reported.
+
+        returns: list
+                 keys that were not stored
+        """
+        raise NotImplementedError
+
+    def delete_multi(self, keys, noreply=False):
+        """
+        performs DELETE <key> for every key, pipelined
+
+        param: noreply
+               if true, don't wait for (or ask for, where the protocol
+               allows) responses. failures are then not reported.
+
+        returns: list
+                 keys that were not deleted (eg. not found)
+        """
+        raise NotImplementedError
+
+    def sync(self):
+        """
+        waits until the server has processed every noreply command sent so
+        far, and collects the keys of those that failed.
+
+        this default implementation is for drivers that never leave
+        responses unread, so there is nothing to wait for.
+
+        returns: list
+                 keys of noreply commands that failed since the last sync
+        """
+        return []
+
+    def pipeline_send(self, commands):
+        """
+        sends a batch of commands without waiting for their responses, so
+        that requests to several servers can be in flight at once.
+        responses must then be collected with `pipeline_recv`, before any
+        other command is issued.
+
+        this default implementation simply runs the commands right away.
+        drivers that can separate sending and receiving should override
+        both methods.
+
+        param: commands
+               list of (method_name, args) or (method_name, args, kwargs)
+               tuples, naming driver methods such as 'get_multi', and the
+               arguments to call them with.
+
+        returns: True
+        """
+        self._pipeline_results = [
+            getattr(self, command[0])(*command[1], **_kwargs(command))
+            for command in commands]
+        return True
+
+    def pipeline_recv(self):
+        """
+        reads the responses to commands sent by `pipeline_send`
+
+        returns: list
+                 the result of each command, as the driver method itself
+                 would have returned it, in the order commands were sent.
+        """
+        results = getattr(self, '_pipeline_results', None) or []
+        self._pipeline_results = None
+        return results
+
 
 class TCPDriver(Driver):
+    # max keys or items per window of a multi command
+    multi_window = MULTI_WINDOW
+
     def __init__(self, host, port, timeout, connect_timeout,
-                 disable_nagle=True):
+                 disable_nagle=True, recv_size=RECV_SIZE,
+                 adaptive_recv=False):
         self.host = host
         self.port = port
         self.timeout = timeout
         self.connect_timeout = connect_timeout
         self.disable_nagle = disable_nagle
-        self._buffer = ''
+        self.recv_size = recv_size
+        self.adaptive_recv = adaptive_recv
         self._sock = None
+        # outgoing data and response readers, while queuing a pipeline
+        self._wbuf = None
+        self._pending = []
+        # responses read while still queuing a pipeline, and the number of
+        # windows each of its commands was split into
+        self._done = []
+        self._windows_per_command = []
+        self._reset_buffer()
 
     ###
     ### connection handling
@@ -243,7 +495,10 @@ class TCPDriver(Driver):
                 return
             self.close()
 
-        self._buffer = ''
+        self._reset_buffer()
+        self._pending = []
+        self._done = []
+        self._windows_per_command = []
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._sock.settimeout(self.connect_timeout)
         self._sock.settimeout(self.timeout)
@@ -299,26 +554,273 @@ class TCPDriver(Driver):
             self._sock.close()
             self._sock = None
 
-    def _readbuffered(self):
-        data = self._sock.recv(4096)
-        if not data:
+    ###
+    ### receive buffer
+    ## Received data lives in a single preallocated bytearray. Unconsumed
+    ## data is the region [_rstart:_rend]. Consuming data just advances
+    ## _rstart, and new data is written past _rend with recv_into, so reading
+    ## a large value no longer copies the whole buffer for every chunk.
+    def _reset_buffer(self):
+        self._rbuf = bytearray(BUFFER_SIZE)
+        self._rstart = 0
+        self._rend = 0
+
+    def _reserve(self, size):
+        """
+        make sure there is room for at least `size` more bytes past the end
+        of the unconsumed data, compacting or growing the buffer if needed.
+        """
+        if self._rend + size <= len(self._rbuf):
+            return
+        pending = self._rend - self._rstart
+        needed = pending + size
+        if needed <= len(self._rbuf):
+            # enough room if we slide unconsumed data to the front
+            self._rbuf[:pending] = self._rbuf[self._rstart:self._rend]
+        else:
+            rbuf = bytearray(max(needed, len(self._rbuf) * 2))
+            rbuf[:pending] = self._rbuf[self._rstart:self._rend]
+            self._rbuf = rbuf
+        self._rstart = 0
+        self._rend = pending
+
+    def _readbuffered(self, size=None):
+        if size is None:
+            size = self.recv_size
+        self._reserve(size)
+        ## memoryview must not outlive this call, or the bytearray could not
+        ## be resized later.
+        count = self._sock.recv_into(
+            memoryview(self._rbuf)[self._rend:], size)
+        if not count:
             # conn closed? abort
             self.close()
             raise socket.error('Socket died')
-        self._buffer += data
+        self._rend += count
+
+    def _consume(self, size):
+        """
+        return the next `size` buffered bytes as a str, and mark them as
+        consumed. caller must make sure they have been read already.
+        """
+        start = self._rstart
+        b = memoryview(self._rbuf)[start:start+size].tobytes()
+        self._skip(size)
+        return b
+
+    def _skip(self, size):
+        """
+        mark the next `size` buffered bytes as consumed.
+        """
+        self._rstart += size
+        if self._rstart == self._rend:
+            # buffer drained. rewind, and drop any oversized buffer that a
+            # large value may have left behind.
+            self._rstart = self._rend = 0
+            if len(self._rbuf) > BUFFER_SIZE:
+                self._rbuf = bytearray(BUFFER_SIZE)
 
     def _read(self, size):
-        while len(self._buffer) < size:
-            self._readbuffered()
+        self._fill(size)
+        return self._consume(size)
+
+    def _unpack(self, codec):
+        """
+        read the next `codec.size` bytes and unpack them with `codec`, a
+        struct.Struct, straight from the buffer without copying them first.
+        """
+        self._fill(codec.size)
+        values = codec.unpack_from(self._rbuf, self._rstart)
+        self._skip(codec.size)
+        return values
+
+    def _fill(self, size):
+        """
+        make sure the next `size` bytes are buffered, reading as needed.
+        """
+        missing = size - (self._rend - self._rstart)
+        if missing > 0:
+            self._reserve(missing)
+            while self._rend - self._rstart < size:
+                room = len(self._rbuf) - self._rend
+                if self.adaptive_recv:
+                    # the protocol header already told us how much data is
+                    # coming, so ask for all of it at once.
+                    self._readbuffered(room)
+                else:
+                    self._readbuffered(min(self.recv_size, room))
+
+    def _read_into(self, size, writable):
+        """
+        read the next `size` bytes into `writable` (see Driver.get_into).
+        buffers are filled straight from the socket, file like objects get
+        at most BUFFER_SIZE bytes at a time, so memory use stays flat
+        whatever the size.
+        """
+        buffered = min(size, self._rend - self._rstart)
+        if hasattr(writable, 'write'):
+            if buffered:
+                writable.write(self._consume(buffered))
+            remaining = size - buffered
+            while remaining:
+                count = min(remaining, BUFFER_SIZE)
+                writable.write(self._read(count))
+                remaining -= count
+            return
 
-        b = self._buffer[:size]
-        self._buffer = self._buffer[size:]
-        return b
+        try:
+            view = writable_view(writable, size)
+        except ValueError:
+            # the value can't be skipped cleanly, so drop the connection
+            self.close()
+            raise
+        start = self._rstart
+        view[:buffered] = memoryview(self._rbuf)[start:start + buffered]
+        self._skip(buffered)
+        offset = buffered
+        while offset < size:
+            count = self._sock.recv_into(view[offset:], size - offset)
+            if not count:
+                # conn closed? abort
+                self.close()
+                raise socket.error('Socket died')
+            offset += count
 
     def _sendall(self, data):
+        """
+        send `data`, a str or a list of str and buffers.
+        """
+        if self._wbuf is not None:
+            if isinstance(data, list):
+                self._wbuf.extend(data)
+            else:
+                self._wbuf.append(data)
+            return
         if not self.is_connected():
             self.connect()
-        self._sock.sendall(data)
+        if isinstance(data, list):
+            self._sendpieces(data)
+        else:
+            self._sock.sendall(data)
+
+    def _sendpieces(self, pieces):
+        # python 2 has no sendmsg to send the pieces in a single scatter
+        # gather call. runs of small pieces are joined into one send, and
+        # large ones (values) are sent as they are, so they are never copied.
+        small = []
+        for piece in pieces:
+            if len(piece) < SEND_COPY_LIMIT:
+                small.append(piece)
+                continue
+            if small:
+                self._sock.sendall(join_buffers(small))
+                small = []
+            self._sock.sendall(piece)
+        if small:
+            self._sock.sendall(join_buffers(small))
 
     # alias for convenience
     _send = _sendall
+
+    def _windows(self, batch, items, *args):
+        """
+        calls batch(window, *args) for each window of at most `multi_window`
+        of `items`, so each is sent only once the responses to the previous
+        one are read, and returns the merged responses. While queuing a
+        pipeline `items` go in a single batch, as pipeline_send has already
+        split them into windows.
+        """
+        if not isinstance(items, list):
+            items = list(items)
+        size = self.multi_window
+        if self._wbuf is not None or len(items) <= size:
+            return batch(items, *args)
+        return merge_responses([
+            batch(items[i:i + size], *args)
+            for i in xrange(0, len(items), size)])
+
+    ###
+    ### pipelining
+    def _request(self, data, reader, *args):
+        """
+        sends `data`, then returns reader(*args), which should parse the
+        response. While queuing a pipeline, `data` is buffered and the
+        reader is deferred to `pipeline_recv` instead. A reader of None
+        means no response is expected, `data` of None that there is nothing
+        to send.
+        """
+        if data is not None:
+            self._sendall(data)
+        if self._wbuf is not None:
+            self._pending.append((reader, args))
+            return None
+        if reader is None:
+            return None
+        return reader(*args)
+
+    def pipeline_send(self, commands):
+        # connect up front, connecting drops any pending readers
+        if not self.is_connected():
+            self.connect()
+        self._wbuf = []
+        self._done = []
+        self._windows_per_command = []
+        try:
+            ## multi commands are split into windows, and once a window's
+            ## worth of keys is queued it is sent and its responses read
+            ## before queuing more, so the server never blocks writing
+            ## responses while we are still sending.
+            queued = 0
+            for command in commands:
+                windows = split_command(command, self.multi_window)
+                self._windows_per_command.append(len(windows))
+                for window in windows:
+                    size = 1
+                    if window[0] in MULTI_COMMANDS:
+                        size = len(window[1][0])
+                    if queued and queued + size > self.multi_window:
+                        self._flush_pipeline()
+                        queued = 0
+                    getattr(self, window[0])(*window[1], **_kwargs(window))
+                    queued += size
+            data = self._wbuf
+        except:
+            self._pending = []
+            self._done = []
+            self._windows_per_command = []
+            raise
+        finally:
+            self._wbuf = None
+        # _send is the base _sendall, skipping any protocol specific framing
+        # that was already applied while buffering.
+        self._send(data)
+        return True
+
+    def _flush_pipeline(self):
+        # send what was queued so far and read its responses, then carry on
+        # queuing
+        data, self._wbuf = self._wbuf, None
+        try:
+            self._send(data)
+            self._done.extend(self._read_pending())
+        finally:
+            self._wbuf = []
+
+    def _read_pending(self):
+        pending, self._pending = self._pending, []
+        return [reader(*args) if reader else None for reader, args in pending]
+
+    def pipeline_recv(self):
+        responses = self._done + self._read_pending()
+        self._done = []
+        counts, self._windows_per_command = self._windows_per_command, []
+        results = []
+        start = 0
+        for count in counts:
+            if count == 1:
+                results.append(responses[start])
+            else:
+                results.append(
+                    merge_responses(responses[start:start + count]))
+            start += count
+        return results
@@ -18,7 +18,8 @@
 Memcache binary protocol backend
 """
 
-from .base import TCPDriver
+from .base import TCPDriver, join_buffers
+from itertools import islice
 import struct
 
 ## refs:
@@ -61,18 +62,18 @@ CMD_GETKQ           = 0x0d
 CMD_APPEND          = 0x0e
 CMD_PREPEND         = 0x0f
 CMD_STAT            = 0x10
+CMD_SETQ            = 0x11
+CMD_ADDQ            = 0x12
+CMD_REPLACEQ        = 0x13
+CMD_DELETEQ         = 0x14
+CMD_INCREMENTQ      = 0x15
+CMD_DECREMENTQ      = 0x16
+CMD_APPENDQ         = 0x19
+CMD_PREPENDQ        = 0x1a
 
 ## unused in this driver
-#CMD_SETQ            = 0x11
-#CMD_ADDQ            = 0x12
-#CMD_REPLACEQ        = 0x13
-#CMD_DELETEQ         = 0x14
-#CMD_INCREMENTQ      = 0x15
-#CMD_DECREMENTQ      = 0x16
 #CMD_QUITQ           = 0x17
 #CMD_FLUSHQ          = 0x18
-#CMD_APPENDQ         = 0x19
-#CMD_PREPENDQ        = 0x1a
 #CMD_TOUCH           = 0x1c
 #CMD_GAT             = 0x1d
 #CMD_GATQ            = 0x1e
@@ -86,14 +87,80 @@ CMD_STAT            = 0x10
 # data type opcodes
 DATA_RAW             = 0x00
 
+# precompiled codecs
+HEADER          = struct.Struct('!BBHBBHLLQ')  # request and response header
+GET_EXTRAS      = struct.Struct('!L')          # flags
+SET_EXTRAS      = struct.Struct('!LL')         # flags, expiry
+INCRDECR_EXTRAS = struct.Struct('!QQL')        # delta, initial, expiry
+COUNTER         = struct.Struct('!Q')          # incr/decr result
+
+# quiet variant of each command that supports noreply
+QUIET_CMDS = {
+    CMD_SET: CMD_SETQ,
+    CMD_ADD: CMD_ADDQ,
+    CMD_REPLACE: CMD_REPLACEQ,
+    CMD_DELETE: CMD_DELETEQ,
+    CMD_INCR: CMD_INCREMENTQ,
+    CMD_DECR: CMD_DECREMENTQ,
+    CMD_APPEND: CMD_APPENDQ,
+    CMD_PREPEND: CMD_PREPENDQ,
+}
+
+# noreply commands get an opaque with this bit set, so their (error only)
+# responses can't be mistaken for those of the commands they precede.
+NOREPLY_OPAQUE = 0x80000000
+# max noreply commands in flight before forcing a sync, which bounds the
+# bookkeeping kept for them.
+MAX_NOREPLY_PENDING = 1024
+
+
+def _value(val):
+    # buffers are sent as is, anything else as its str
+    if isinstance(val, (str, bytearray, memoryview)):
+        return val
+    return str(val)
+
 
 class BinaryProtoDriver(TCPDriver):
+    def __init__(self, *args, **kwargs):
+        super(BinaryProtoDriver, self).__init__(*args, **kwargs)
+        self._reset_noreply()
+
+    def _reset_noreply(self):
+        # key of every noreply command that may still answer, by opaque
+        self._noreply_keys = {}
+        self._noreply_seq = 0
+        # keys of failed noreply commands, every one kept until collected
+        # by sync()
+        self._noreply_failed = []
+
+    def connect(self, reconnect=False):
+        if reconnect or not self.is_connected():
+            # noreply commands in flight died with the old connection
+            self._reset_noreply()
+        super(BinaryProtoDriver, self).connect(reconnect=reconnect)
+
     ###
     ### data readers
-    def _read_response(self):
-        header = self._read(24)
+    def _read_response(self, writable=None):
+        while True:
+            response = self._read_packet(writable)
+            opaque = response[7]
+            if opaque & NOREPLY_OPAQUE and opaque in self._noreply_keys:
+                # a noreply command failed. note it, and keep looking for
+                # the response that was asked for.
+                self._noreply_failed.append(self._noreply_keys.pop(opaque))
+                continue
+            return response
+
+    def _read_packet(self, writable=None):
+        """
+        read one response packet. if `writable` is given, the value of a
+        successful response with no flags set is read into it (see
+        Driver.get_into), and rval is None.
+        """
         (magic, opcode, keylen, extlen, datatype,
-         status, bodylen, opaque, cas) = struct.unpack('!BBHBBHLLQ', header)
+         status, bodylen, opaque, cas) = self._unpack(HEADER)
 
         if magic != MAGIC_RESPONSE:
             raise IOError("Protocol violation")
@@ -109,48 +176,16 @@ class BinaryProtoDriver(TCPDriver):
         rval = None
         if bodylen:
             vallen = bodylen - extlen - keylen
-            if vallen > 0:
+            if (writable is not None and status == RESPONSE_SUCCESS and
+                    extra == '\0\0\0\0'):
+                self._read_into(max(vallen, 0), writable)
+            elif vallen > 0:
                 rval = self._read(vallen)
 
         return (magic, opcode, keylen, extlen, datatype,
                 status, bodylen, opaque, cas, extra, rkey, rval)
 
-    ###
-    ### helpful internal abstractions
-    def _build_request(self, cmd, header_extra=None, opaque=0, cas=0,
-                       key=None, value=None):
-        extralen = 0
-        if header_extra:
-            extralen = len(header_extra)
-
-        keylen = 0
-        if key:
-            keylen = len(key)
-            packed_key = struct.pack('%ds' % keylen, key)
-
-        vallen = 0
-        if value:
-            vallen = len(value)
-            packed_value = struct.pack('%ds' % vallen, value)
-
-        header = [MAGIC_REQUEST, cmd, keylen, extralen, DATA_RAW,
-                  0, keylen+extralen+vallen, opaque, cas]
-        packed = struct.pack('!BBHBBHLLQ', *header)
-
-        if extralen:
-            packed += header_extra
-        if keylen:
-            packed += packed_key
-        if vallen:
-            packed += packed_value
-        return packed
-
-    def _incrdecr(self, cmd, key, val, time):
-        req = self._build_request(
-            cmd, key=key,
-            header_extra=struct.pack('!QQL', val, 0, time))
-        self._sendall(req)
-
+    def _read_incrdecr_response(self, cmd):
         (magic, opcode, keylen, extlen, datatype, status,
          bodylen, opaque, cas, extra, rkey, rval) = self._read_response()
 
@@ -163,52 +198,14 @@ class BinaryProtoDriver(TCPDriver):
         if status != RESPONSE_SUCCESS:
             return None
 
-        recval = struct.unpack('!Q', rval)[0]
+        recval = COUNTER.unpack(rval)[0]
 
         # if recval is 0, then that means it didn't incr/decr.
         # it could also mean that a decrement resulted in zero. not sure
         # if you can tell the difference....
         return int(recval)
 
-    def _get(self, keys, cas):
-        fullreq = ''
-        counter = len(keys)
-        while counter > 0:
-            counter -= 1
-            cmd = CMD_GETQ
-            if counter == 0:
-                cmd = CMD_GET
-            ## note: use opaque field to tell which response maps to which
-            ## key...
-            key = keys[counter]
-            req = self._build_request(cmd, opaque=counter, key=key)
-            fullreq += req
-
-        self._sendall(fullreq)
-        results = {}
-
-        while True:
-            (magic, opcode, keylen, extlen, datatype, status,
-             bodylen, opaque, cas_id, extra, rkey, rval
-             ) = self._read_response()
-
-            if opcode not in (CMD_GETQ, CMD_GET):
-                raise IOError('Unexpected response')
-
-            if status == RESPONSE_SUCCESS:
-                rvallen = bodylen - keylen - extlen
-                flags, val = struct.unpack('!L%ds' % rvallen, extra+rval)
-                results[keys[opaque]] = [val, flags]
-                if cas:
-                    results[keys[opaque]].append(cas_id)
-            if opaque == 0:
-                break
-        return results
-
-    def _append_prepend(self, cmd, key, val, time, flags):
-        req = self._build_request(cmd, key=key, value=val)
-        self._sendall(req)
-
+    def _read_status_response(self, cmd):
         (magic, opcode, keylen, extlen, datatype, status,
          bodylen, opaque, cas, extra, rkey, rval) = self._read_response()
 
@@ -218,28 +215,7 @@ class BinaryProtoDriver(TCPDriver):
             return True
         return False
 
-    def _set(self, cmd, key, val, time, flags, cas=0):
-        req = self._build_request(
-            cmd, cas=cas, key=key, value=str(val),
-            header_extra=struct.pack('!LL', flags, time))
-        self._sendall(req)
-
-        (magic, opcode, keylen, extlen,
-         datatype, status, bodylen, opaque, cas,
-         extra, rkey, rval) = self._read_response()
-
-        if opcode != cmd:
-            raise IOError('Unexpected response')
-        if status == RESPONSE_SUCCESS:
-            return True
-        return False
-
-    ###
-    ### exposed driver methods
-    def stats(self):
-        req = self._build_request(CMD_STAT)
-        self._sendall(req)
-
+    def _read_stats_response(self):
         results = {}
         while True:
             (magic, opcode, keylen, extlen, datatype, status,
@@ -250,103 +226,322 @@ class BinaryProtoDriver(TCPDriver):
             if keylen == 0:  # got the magic 'stats done' packet.
                 break
 
-            rvallen = bodylen - keylen - extlen
-            key, val = struct.unpack('%ds%ds' % (keylen,rvallen), rkey+rval)
-            results[key] = val
+            results[rkey] = rval or ''
         return results
 
-    def version(self):
-        req = self._build_request(CMD_VERSION)
-        self._sendall(req)
-
+    def _read_version_response(self):
         (magic, opcode, keylen, extlen, datatype, status,
          bodylen, opaque, cas, extra, rkey, rval) = self._read_response()
 
         if opcode != CMD_VERSION:
             raise IOError('Unexpected response')
 
-        rvallen = bodylen - keylen - extlen
-        val = struct.unpack('%ds' % rvallen, rval)[0]
-        return val
+        return rval or ''
 
-    def flush_all(self):
-        ## flush has an optional header_extra for sending a 'flush in future'
-        ## ... just support flushing immediately
-        #header_extra=struct.pack('!L', expiry),
-        req = self._build_request(CMD_FLUSH)
-        self._sendall(req)
+    ###
+    ### helpful internal abstractions
+    def _build_request(self, cmd, header_extra=None, opaque=0, cas=0,
+                       key=None, value=None):
+        return join_buffers(self._build_request_pieces(
+            cmd, header_extra, opaque, cas, key, value))
+
+    def _build_request_pieces(self, cmd, header_extra=None, opaque=0, cas=0,
+                              key=None, value=None):
+        """
+        returns list -- the request as a str of the header, extras and key,
+                        followed by `value` as is, so it is never copied.
+        """
+        extralen = len(header_extra) if header_extra else 0
+        keylen = len(key) if key else 0
+        vallen = len(value) if value else 0
+
+        packed = HEADER.pack(MAGIC_REQUEST, cmd, keylen, extralen, DATA_RAW,
+                             0, keylen+extralen+vallen, opaque, cas)
+        if extralen:
+            packed += header_extra
+        if keylen:
+            packed += key
+        if vallen:
+            return [packed, value]
+        return [packed]
+
+    def _incrdecr(self, cmd, key, val, time, noreply=False):
+        header_extra = INCRDECR_EXTRAS.pack(val, 0, time)
+        if noreply:
+            return self._send_noreply(
+                [(cmd, key, {'header_extra': header_extra})])
+        req = self._build_request(cmd, key=key, header_extra=header_extra)
+        return self._request(req, self._read_incrdecr_response, cmd)
+
+    def _build_get_request(self, keys):
+        ## GETKQ responses carry their key, and only hits respond. the
+        ## trailing NOOP always responds, and marks the end of the batch.
+        ## headers are packed inline and joined once, as multi gets of
+        ## thousands of keys are common.
+        pack = HEADER.pack
+        reqs = []
+        for opaque, key in enumerate(keys):
+            keylen = len(key)
+            reqs.append(pack(MAGIC_REQUEST, CMD_GETKQ, keylen, 0, DATA_RAW,
+                             0, keylen, opaque, 0))
+            reqs.append(key)
+        reqs.append(pack(MAGIC_REQUEST, CMD_NOOP, 0, 0, DATA_RAW, 0, 0, 0, 0))
+        return ''.join(reqs)
+
+    def _get(self, keys, cas):
+        return self._windows(self._get_batch, keys, cas)
+
+    def _get_batch(self, keys, cas):
+        if not keys:
+            # nothing to send, or to read
+            return self._request(None, dict)
+        return self._request(
+            self._build_get_request(keys), self._read_get_response, cas)
 
+    def _read_get_value(self, cas):
         (magic, opcode, keylen, extlen, datatype, status,
-         bodylen, opaque, cas, extra, rkey, rval) = self._read_response()
+         bodylen, opaque, cas_id, extra, rkey, rval
+         ) = self._read_response()
 
-        if opcode != CMD_FLUSH:
+        if opcode != CMD_GET:
             raise IOError('Unexpected response')
+        if status != RESPONSE_SUCCESS:
+            return None
+        result = [rval or '', GET_EXTRAS.unpack(extra)[0]]
+        if cas:
+            result.append(cas_id)
+        return result
 
-        if status == RESPONSE_SUCCESS:
-            return True
-        return False
+    def _read_get_into(self, writable):
+        (magic, opcode, keylen, extlen, datatype, status,
+         bodylen, opaque, cas_id, extra, rkey, rval
+         ) = self._read_response(writable)
 
-    def delete(self, key):
-        req = self._build_request(CMD_DELETE, key=key)
-        self._sendall(req)
+        if opcode != CMD_GET:
+            raise IOError('Unexpected response')
+        if status != RESPONSE_SUCCESS:
+            return None
+        flags = GET_EXTRAS.unpack(extra)[0]
+        return [bodylen - keylen - extlen, flags, rval]
+
+    def _read_get_response(self, cas):
+        return dict(self._iter_get_response(cas))
+
+    def _iter_get_response(self, cas):
+        while True:
+            (magic, opcode, keylen, extlen, datatype, status,
+             bodylen, opaque, cas_id, extra, rkey, rval
+             ) = self._read_response()
 
+            if opcode == CMD_NOOP:
+                return
+            if opcode != CMD_GETKQ:
+                raise IOError('Unexpected response')
+
+            if status == RESPONSE_SUCCESS:
+                # the value is used as read, only the flags are unpacked
+                result = [rval or '', GET_EXTRAS.unpack(extra)[0]]
+                if cas:
+                    result.append(cas_id)
+                yield rkey, result
+
+    def _send_noreply(self, commands, result=None):
+        """
+        send quiet commands, not waiting for any response. successful quiet
+        commands never respond, errors are picked up while reading later
+        responses.
+
+        param: commands
+               list of (cmd, key, _build_request kwargs)
+        param: result
+               called, reading nothing, for the result of the command, in a
+               pipeline too. None for no result.
+        """
+        reqs = []
+        opaques = []
+        for cmd, key, kwargs in commands:
+            self._noreply_seq = (self._noreply_seq + 1) & ~NOREPLY_OPAQUE
+            opaque = NOREPLY_OPAQUE | self._noreply_seq
+            reqs.extend(self._build_request_pieces(
+                QUIET_CMDS[cmd], opaque=opaque, key=key, **kwargs))
+            opaques.append((opaque, key))
+        response = self._request(reqs, result)
+        self._noreply_keys.update(opaques)
+        if (len(self._noreply_keys) >= MAX_NOREPLY_PENDING and
+                self._wbuf is None):
+            self._sync()
+        return response
+
+    def _sync(self):
+        sent = list(self._noreply_keys)
+        return self._request(
+            self._build_request(CMD_NOOP), self._read_noop_response, sent)
+
+    def _read_noop_response(self, sent):
         (magic, opcode, keylen, extlen, datatype, status,
          bodylen, opaque, cas, extra, rkey, rval) = self._read_response()
 
-        if opcode != CMD_DELETE:
+        if opcode != CMD_NOOP:
             raise IOError('Unexpected response')
+        # everything sent before the NOOP has been processed
+        for opaque in sent:
+            self._noreply_keys.pop(opaque, None)
+
+    def _quiet_multi(self, reqs, keys):
+        ## quiet commands only respond on failure. a trailing NOOP always
+        ## responds, and marks the end of the batch.
+        reqs.append(self._build_request(CMD_NOOP))
+        return self._request(reqs, self._read_quiet_response, keys)
+
+    def _read_quiet_response(self, keys):
+        failed = []
+        while True:
+            (magic, opcode, keylen, extlen, datatype, status,
+             bodylen, opaque, cas, extra, rkey, rval) = self._read_response()
 
-        ## not sure how useful this data point is, so just ignore it..
-        #if bodylen:
-        #    ## an attempt to delete a non-existent key returns
-        #    ## some garbage "Not Found" in the response.
-        #    ## ಠ_ಠ
-        #    rvallen = bodylen - keylen - extlen
-        #    val = struct.unpack('%ds' % rvallen, rval)[0]
-        if status == RESPONSE_SUCCESS:
-            return True
-        return False
+            if opcode == CMD_NOOP:
+                break
+            if opcode not in (CMD_SETQ, CMD_DELETEQ):
+                raise IOError('Unexpected response')
+            if status != RESPONSE_SUCCESS:
+                failed.append(keys[opaque])
+        return failed
+
+    def _append_prepend(self, cmd, key, val, time, flags, noreply=False):
+        val = _value(val)
+        if noreply:
+            return self._send_noreply([(cmd, key, {'value': val})])
+        req = self._build_request_pieces(cmd, key=key, value=val)
+        return self._request(req, self._read_status_response, cmd)
+
+    def _set(self, cmd, key, val, time, flags, cas=0, noreply=False):
+        header_extra = SET_EXTRAS.pack(flags, time)
+        val = _value(val)
+        if noreply:
+            return self._send_noreply([(cmd, key, {
+                'value': val, 'header_extra': header_extra})])
+        req = self._build_request_pieces(
+            cmd, cas=cas, key=key, value=val, header_extra=header_extra)
+        return self._request(req, self._read_status_response, cmd)
+
+    ###
+    ### exposed driver methods
+    def stats(self):
+        req = self._build_request(CMD_STAT)
+        return self._request(req, self._read_stats_response)
 
-    def incr(self, key, val, time=0):
-        return self._incrdecr(CMD_INCR, key, val, time)
+    def version(self):
+        req = self._build_request(CMD_VERSION)
+        return self._request(req, self._read_version_response)
+
+    def flush_all(self):
+        ## flush has an optional header_extra for sending a 'flush in future'
+        ## ... just support flushing immediately
+        #header_extra=struct.pack('!L', expiry),
+        req = self._build_request(CMD_FLUSH)
+        return self._request(req, self._read_status_response, CMD_FLUSH)
 
-    def decr(self, key, val, time=0):
-        return self._incrdecr(CMD_DECR, key, val, time)
+    def delete(self, key, noreply=False):
+        if noreply:
+            return self._send_noreply([(CMD_DELETE, key, {})])
+        req = self._build_request(CMD_DELETE, key=key)
+        ## an attempt to delete a non-existent key returns some garbage
+        ## "Not Found" in the response body. not sure how useful this data
+        ## point is, so the status is all that gets checked.
+        return self._request(req, self._read_status_response, CMD_DELETE)
+
+    def incr(self, key, val, time=0, noreply=False):
+        return self._incrdecr(CMD_INCR, key, val, time, noreply)
+
+    def decr(self, key, val, time=0, noreply=False):
+        return self._incrdecr(CMD_DECR, key, val, time, noreply)
+
+    def sync(self):
+        if self._noreply_keys:
+            self._sync()
+        failed, self._noreply_failed = self._noreply_failed, []
+        return failed
+
+    def set_multi(self, items, time, noreply=False):
+        return self._windows(self._set_multi_batch, items, time, noreply)
+
+    def _set_multi_batch(self, items, time, noreply):
+        if noreply:
+            return self._send_noreply([
+                (CMD_SET, key, {
+                    'value': _value(val),
+                    'header_extra': SET_EXTRAS.pack(flags, time)})
+                for key, val, flags in items], list)
+        reqs = []
+        for i, (key, val, flags) in enumerate(items):
+            reqs.extend(self._build_request_pieces(
+                CMD_SETQ, opaque=i, key=key, value=_value(val),
+                header_extra=SET_EXTRAS.pack(flags, time)))
+        return self._quiet_multi(reqs, [item[0] for item in items])
+
+    def delete_multi(self, keys, noreply=False):
+        return self._windows(self._delete_multi_batch, keys, noreply)
+
+    def _delete_multi_batch(self, keys, noreply):
+        if noreply:
+            return self._send_noreply(
+                [(CMD_DELETE, key, {}) for key in keys], list)
+        reqs = [self._build_request(CMD_DELETEQ, opaque=i, key=key)
+                for i, key in enumerate(keys)]
+        return self._quiet_multi(reqs, keys)
 
     def get(self, key):
-        keys = (key,)
-        resp = self._get(keys, cas=False)
-        if resp:
-            return resp.popitem()[1]
-        return None
+        return self._request(
+            self._build_request(CMD_GET, key=key), self._read_get_value, False)
+
+    def get_into(self, key, writable):
+        return self._request(
+            self._build_request(CMD_GET, key=key), self._read_get_into,
+            writable)
 
     def gets(self, key):
-        keys = (key,)
-        resp = self._get(keys, cas=True)
-        if resp:
-            return resp.popitem()[1]
-        return None
+        return self._request(
+            self._build_request(CMD_GET, key=key), self._read_get_value, True)
 
     def get_multi(self, keys):
         return self._get(keys, cas=False)
 
+    def iter_multi(self, keys):
+        keys = iter(keys)
+        done = False
+        try:
+            while True:
+                window = list(islice(keys, self.multi_window))
+                if not window:
+                    break
+                self._sendall(self._build_get_request(window))
+                for item in self._iter_get_response(False):
+                    yield item
+            done = True
+        finally:
+            if not done:
+                # responses may be left unread, so the connection is out of
+                # sync
+                self.close()
+
     def gets_multi(self, keys):
         return self._get(keys, cas=True)
 
-    def append(self, key, val, time, flags):
-        return self._append_prepend(CMD_APPEND, key, val, time, flags)
+    def append(self, key, val, time, flags, noreply=False):
+        return self._append_prepend(CMD_APPEND, key, val, time, flags, noreply)
 
-    def prepend(self, key, val, time, flags):
-        return self._append_prepend(CMD_PREPEND, key, val, time, flags)
+    def prepend(self, key, val, time, flags, noreply=False):
+        return self._append_prepend(
+            CMD_PREPEND, key, val, time, flags, noreply)
 
-    def add(self, key, val, time, flags):
-        return self._set(CMD_ADD, key, val, time, flags)
+    def add(self, key, val, time, flags, noreply=False):
+        return self._set(CMD_ADD, key, val, time, flags, noreply=noreply)
 
-    def replace(self, key, val, time, flags):
-        return self._set(CMD_REPLACE, key, val, time, flags)
+    def replace(self, key, val, time, flags, noreply=False):
+        return self._set(CMD_REPLACE, key, val, time, flags, noreply=noreply)
 
     def cas(self, key, val, cas_id, time, flags):
         return self._set(CMD_SET, key, val, time, flags, cas_id)
 
-    def set(self, key, val, time, flags):
-        return self._set(CMD_SET, key, val, time, flags)
+    def set(self, key, val, time, flags, noreply=False):
+        return self._set(CMD_SET, key, val, time, flags, noreply=noreply)
@@ -19,12 +19,14 @@ from .base import Driver
 
 class NoopDriver(Driver):
     def __init__(self, host, port, timeout, connect_timeout,
-                 disable_nagle=True):
+                 disable_nagle=True, recv_size=None, adaptive_recv=False):
         self.host = host
         self.port = port
         self.timeout = timeout
         self.connect_timeout = connect_timeout
         self.disable_nagle = disable_nagle
+        self.recv_size = recv_size
+        self.adaptive_recv = adaptive_recv
 
     ###
     ### connection handling
@@ -52,13 +54,13 @@ class NoopDriver(Driver):
     def flush_all(self):
         return
 
-    def delete(self, key):
+    def delete(self, key, noreply=False):
         return
 
-    def incr(self, key, val):
+    def incr(self, key, val, noreply=False):
         return val+1
 
-    def decr(self, key, val):
+    def decr(self, key, val, noreply=False):
         return val-1
 
     def cas(self, key, val, cas_id, time, flags):
@@ -76,17 +78,23 @@ class NoopDriver(Driver):
     def gets_multi(self, keys):
         return {}
 
-    def add(self, key, val, time, flags):
+    def add(self, key, val, time, flags, noreply=False):
         return True
 
-    def append(self, key, val, time, flags):
+    def append(self, key, val, time, flags, noreply=False):
         return True
 
-    def prepend(self, key, val, time, flags):
+    def prepend(self, key, val, time, flags, noreply=False):
         return True
 
-    def replace(self, key, val, time, flags):
+    def replace(self, key, val, time, flags, noreply=False):
         return True
 
-    def set(self, key, val, time, flags):
+    def set(self, key, val, time, flags, noreply=False):
         return True
+
+    def set_multi(self, items, time, noreply=False):
+        return []
+
+    def delete_multi(self, keys, noreply=False):
+        return []
@@ -19,6 +19,7 @@ Memcache text protocol backend
 """
 
 from .base import TCPDriver
+from itertools import islice
 
 OK           = 'OK'
 END          = 'END'
@@ -32,18 +33,27 @@ NOT_FOUND    = 'NOT_FOUND'
 CLIENT_ERROR = 'CLIENT_ERROR'
 SERVER_ERROR = 'SERVER_ERROR'
 
+# max length of a multi get line, longer ones are split. memcached copes with
+# longer lines, but proxies and older servers cap request lines at 2048.
+MAX_GET_LINE = 2048
+
 
 class TextProtoDriver(TCPDriver):
     ###
     ### data readers
     def _readline(self):
+        scanned = 0
         while True:
-            index = self._buffer.find('\r\n')
+            index = self._rbuf.find(
+                '\r\n', self._rstart + scanned, self._rend)
             if index >= 0:
                 break
+            # don't rescan what we have already seen. back up one byte in
+            # case a \r\n is split across reads.
+            scanned = max(self._rend - self._rstart - 1, 0)
             self._readbuffered()
-        b = self._buffer[:index]
-        self._buffer = self._buffer[index+2:]
+        b = self._consume(index - self._rstart)
+        self._consume(2)
         return b
 
     def _read_errors(self, line):
@@ -65,8 +75,8 @@ class TextProtoDriver(TCPDriver):
             if parts[0] == VALUE:
                 lp = len(parts)
                 if (lp == 4 and not cas) or (lp == 5 and cas):
-                    bytes_to_read = int(parts[3]) + 2  # 2 extra for \r\n
-                    data = self._read(bytes_to_read)[:-2]
+                    data = self._read(int(parts[3]))
+                    self._read(2)  # trailing \r\n
                     values[parts[1]] = [data, int(parts[2])]
                     if cas:
                         values[parts[1]].append(int(parts[4]))
@@ -82,6 +92,52 @@ class TextProtoDriver(TCPDriver):
                 self._read_errors(resp)
         return values
 
+    def _iter_values(self):
+        # VALUE blocks of a get, up to its END
+        while True:
+            resp = self._readline()
+            if resp == END:
+                return
+            parts = resp.split()
+            if parts[0] != VALUE:
+                self._read_errors(resp)
+                raise IOError('Unexpected response')
+            data = self._read(int(parts[3]))
+            self._read(2)  # trailing \r\n
+            yield parts[1], [data, int(parts[2])]
+
+    def _read_multi_get_response(self, lines, cas):
+        # each get line is answered with its values, then END
+        values = {}
+        for i in xrange(lines):
+            values.update(self._read_data_response(cas))
+        return values
+
+    def _read_value_response(self, cas=False):
+        resp = self._read_data_response(cas=cas)
+        if resp:
+            return resp.popitem()[1]
+        return None
+
+    def _read_value_into(self, writable):
+        resp = self._readline()
+        if resp == END:
+            return None
+        parts = resp.split()
+        if parts[0] != VALUE:
+            self._read_errors(resp)
+            raise IOError('Unexpected response')
+        flags, length = int(parts[2]), int(parts[3])
+        data = None
+        if flags:
+            # packed somehow, the caller has to unpack it first
+            data = self._read(length)
+        else:
+            self._read_into(length, writable)
+        self._read(2)  # trailing \r\n
+        self._readline()  # END
+        return [length, flags, data]
+
     def _read_expect_response(self, exp=None):
         resp = self._readline()
         if resp == exp:
@@ -89,93 +145,185 @@ class TextProtoDriver(TCPDriver):
         self._read_errors(resp)
         return False
 
+    def _read_incrdecr_response(self):
+        resp = self._readline()
+        if resp == NOT_FOUND:
+            return
+        self._read_errors(resp)
+        return int(resp)
+
+    def _read_multi_response(self, keys, exp):
+        failed = []
+        for key in keys:
+            resp = self._readline()
+            if resp == exp:
+                continue
+            # a server error only fails this key (eg. value too large), keep
+            # reading. other errors mean we are out of sync, so raise.
+            if not resp.startswith(SERVER_ERROR):
+                self._read_errors(resp)
+            failed.append(key)
+        return failed
+
     ###
     ### helpful internal abstractions
     def _sendall(self, data):
         ## textproto requires a \r\n trailer
-        super(TextProtoDriver, self)._sendall(data+'\r\n')
+        if isinstance(data, list):
+            super(TextProtoDriver, self)._sendall(data + ['\r\n'])
+        else:
+            super(TextProtoDriver, self)._sendall(data + '\r\n')
 
-    def _incrdecr(self, cmd, key, val):
+    def _incrdecr(self, cmd, key, val, noreply=False):
+        if noreply:
+            return self._request("%s %s %s noreply" % (cmd, key, val), None)
         fullcmd = "%s %s %s" % (cmd, key, val)
-        self._sendall(fullcmd)
-        resp = self._readline()
-        if resp == NOT_FOUND:
-            return
-        self._read_errors(resp)
-        return int(resp)
+        return self._request(fullcmd, self._read_incrdecr_response)
 
-    def _get(self, cmd, key, cas):
-        fullcmd = "%s %s" % (cmd, key)
-        self._sendall(fullcmd)
-        resp = self._read_data_response(cas=cas)
-        return resp
+    def _get_lines(self, cmd, keys):
+        """
+        returns list -- get lines for `keys`, each at most MAX_GET_LINE long
+        """
+        lines = []
+        line = [cmd]
+        length = len(cmd)
+        for key in keys:
+            if length + 1 + len(key) > MAX_GET_LINE and len(line) > 1:
+                lines.append(' '.join(line))
+                line = [cmd]
+                length = len(cmd)
+            line.append(key)
+            length += 1 + len(key)
+        if len(line) > 1:
+            lines.append(' '.join(line))
+        return lines
+
+    def _get(self, cmd, keys, cas):
+        return self._windows(self._get_batch, keys, cmd, cas)
 
-    def _set(self, cmd, key, val, time, flags):
-        fullcmd = "%s %s %d %d %d\r\n%s" % (
-            cmd, key, flags, time, len(val), val)
-        self._sendall(fullcmd)
-        return self._read_expect_response(STORED)
+    def _get_batch(self, keys, cmd, cas):
+        lines = self._get_lines(cmd, keys)
+        ## _sendall adds the final \r\n. with no keys there is nothing to
+        ## send, or to read.
+        return self._request(
+            '\r\n'.join(lines) if lines else None,
+            self._read_multi_get_response, len(lines), cas)
+
+    def _set(self, cmd, key, val, time, flags, noreply=False):
+        ## with noreply the server stays silent, failures included. so
+        ## unlike the binary driver, there is nothing for sync() to collect.
+        ## the value is sent as is, never copied into the command
+        fullcmd = ["%s %s %d %d %d%s\r\n" % (
+            cmd, key, flags, time, len(val), ' noreply' if noreply else ''),
+            val]
+        if noreply:
+            return self._request(fullcmd, None)
+        return self._request(fullcmd, self._read_expect_response, STORED)
+
+    def _multi(self, keys, data, exp, noreply):
+        ## _sendall adds the final \r\n. with noreply nothing is read, and
+        ## nothing is known to have failed, in a pipeline too.
+        if noreply:
+            return self._request(data, list)
+        return self._request(data, self._read_multi_response, keys, exp)
 
     ###
     ### exposed driver methods
     def stats(self):
-        self._sendall('stats')
-        return self._read_data_response()
+        return self._request('stats', self._read_data_response)
 
     def version(self):
-        self._sendall('version')
-        return self._read_data_response()
+        return self._request('version', self._read_data_response)
 
     def flush_all(self):
-        self._sendall('flush_all')
-        return self._read_expect_response(OK)
+        return self._request('flush_all', self._read_expect_response, OK)
 
-    def delete(self, key):
+    def delete(self, key, noreply=False):
+        if noreply:
+            return self._request("delete %s noreply" % key, None)
         fullcmd = "delete %s" % key
-        self._sendall(fullcmd)
-        return self._read_expect_response(DELETED)
+        return self._request(fullcmd, self._read_expect_response, DELETED)
 
-    def incr(self, key, val):
-        return self._incrdecr('incr', key, val)
+    def incr(self, key, val, noreply=False):
+        return self._incrdecr('incr', key, val, noreply)
 
-    def decr(self, key, val):
-        return self._incrdecr('decr', key, val)
+    def decr(self, key, val, noreply=False):
+        return self._incrdecr('decr', key, val, noreply)
 
     def cas(self, key, val, cas_id, time, flags):
-        fullcmd = "cas %s %d %d %d %d\r\n%s" % (
-            key, flags, time, len(val), cas_id, val)
-        self._sendall(fullcmd)
-        return self._read_expect_response(STORED)
+        fullcmd = ["cas %s %d %d %d %d\r\n" % (
+            key, flags, time, len(val), cas_id), val]
+        return self._request(fullcmd, self._read_expect_response, STORED)
+
+    def set_multi(self, items, time, noreply=False):
+        return self._windows(self._set_multi_batch, items, time, noreply)
+
+    def _set_multi_batch(self, items, time, noreply):
+        suffix = ' noreply' if noreply else ''
+        data = []
+        for key, val, flags in items:
+            if data:
+                data.append('\r\n')
+            data.append("set %s %d %d %d%s\r\n" % (
+                key, flags, time, len(val), suffix))
+            data.append(val)
+        return self._multi(
+            [item[0] for item in items], data, STORED, noreply)
+
+    def delete_multi(self, keys, noreply=False):
+        return self._windows(self._delete_multi_batch, keys, noreply)
+
+    def _delete_multi_batch(self, keys, noreply):
+        suffix = ' noreply' if noreply else ''
+        cmds = ["delete %s%s" % (key, suffix) for key in keys]
+        return self._multi(keys, '\r\n'.join(cmds), DELETED, noreply)
 
     def get(self, key):
-        resp = self._get('get', key, cas=False)
-        if resp:
-            return resp.popitem()[1]
-        return None
+        return self._request("get %s" % key, self._read_value_response, False)
 
     def gets(self, key):
-        resp = self._get('gets', key, cas=True)
-        if resp:
-            return resp.popitem()[1]
-        return None
+        return self._request("gets %s" % key, self._read_value_response, True)
+
+    def get_into(self, key, writable):
+        return self._request("get %s" % key, self._read_value_into, writable)
 
     def get_multi(self, keys):
-        return self._get('get', ' '.join(keys), cas=False)
+        return self._get('get', keys, cas=False)
+
+    def iter_multi(self, keys):
+        keys = iter(keys)
+        done = False
+        try:
+            while True:
+                window = list(islice(keys, self.multi_window))
+                if not window:
+                    break
+                lines = self._get_lines('get', window)
+                self._sendall('\r\n'.join(lines))
+                for i in xrange(len(lines)):
+                    for item in self._iter_values():
+                        yield item
+            done = True
+        finally:
+            if not done:
+                # responses may be left unread, so the connection is out of
+                # sync
+                self.close()
 
     def gets_multi(self, keys):
-        return self._get('gets', ' '.join(keys), cas=True)
+        return self._get('gets', keys, cas=True)
 
-    def add(self, key, val, time, flags):
-        return self._set('add', key, val, time, flags)
+    def add(self, key, val, time, flags, noreply=False):
+        return self._set('add', key, val, time, flags, noreply)
 
-    def append(self, key, val, time, flags):
-        return self._set('append', key, val, time, flags)
+    def append(self, key, val, time, flags, noreply=False):
+        return self._set('append', key, val, time, flags, noreply)
 
-    def prepend(self, key, val, time, flags):
-        return self._set('prepend', key, val, time, flags)
+    def prepend(self, key, val, time, flags, noreply=False):
+        return self._set('prepend', key, val, time, flags, noreply)
 
-    def replace(self, key, val, time, flags):
-        return self._set('replace', key, val, time, flags)
+    def replace(self, key, val, time, flags, noreply=False):
+        return self._set('replace', key, val, time, flags, noreply)
 
-    def set(self, key, val, time, flags):
-        return self._set('set', key, val, time, flags)
+    def set(self, key, val, time, flags, noreply=False):
+        return self._set('set', key, val, time, flags, noreply)
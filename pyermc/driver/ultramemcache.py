@@ -24,14 +24,24 @@ import errno
 import socket
 
 
+def _str(val):
+    # umemcache takes str values only
+    if isinstance(val, (bytearray, memoryview)):
+        return memoryview(val).tobytes()
+    return val
+
+
 class UMemcacheDriver(Driver):
     def __init__(self, host, port, timeout, connect_timeout,
-                 disable_nagle=True):
+                 disable_nagle=True, recv_size=None, adaptive_recv=False):
         self.host = host
         self.port = port
         self.timeout = timeout
         self.connect_timeout = connect_timeout
         self.disable_nagle = disable_nagle
+        # unused. umemcache does its own socket reads
+        self.recv_size = recv_size
+        self.adaptive_recv = adaptive_recv
         self._client = None
         self._connected = False
 
@@ -111,7 +121,8 @@ class UMemcacheDriver(Driver):
             self.connect()
         return self._client.flush_all()
 
-    def delete(self, key):
+    ## umemcache always waits for a reply, so noreply is accepted but ignored
+    def delete(self, key, noreply=False):
         if not self.is_connected():
             self.connect()
         response = self._client.delete(key)
@@ -119,7 +130,7 @@ class UMemcacheDriver(Driver):
             return False
         return True
 
-    def incr(self, key, val):
+    def incr(self, key, val, noreply=False):
         if not self.is_connected():
             self.connect()
         response = self._client.incr(key, val)
@@ -127,7 +138,7 @@ class UMemcacheDriver(Driver):
             return None
         return response
 
-    def decr(self, key, val):
+    def decr(self, key, val, noreply=False):
         if not self.is_connected():
             self.connect()
         response = self._client.decr(key, val)
@@ -138,7 +149,7 @@ class UMemcacheDriver(Driver):
     def cas(self, key, val, cas_id, time, flags):
         if not self.is_connected():
             self.connect()
-        return self._client.cas(key, val, cas_id, time, flags)
+        return self._client.cas(key, _str(val), cas_id, time, flags)
 
     def get(self, key):
         if not self.is_connected():
@@ -160,43 +171,51 @@ class UMemcacheDriver(Driver):
             self.connect()
         return self._client.gets_multi(keys)
 
-    def add(self, key, val, time, flags):
+    def add(self, key, val, time, flags, noreply=False):
         if not self.is_connected():
             self.connect()
-        response = self._client.add(key, val, time, flags)
+        response = self._client.add(key, _str(val), time, flags)
         if response == 'STORED':
             return True
         return False
 
-    def append(self, key, val, time, flags):
+    def append(self, key, val, time, flags, noreply=False):
         if not self.is_connected():
             self.connect()
-        response = self._client.append(key, val, time, flags)
+        response = self._client.append(key, _str(val), time, flags)
         if response == 'STORED':
             return True
         return False
 
-    def prepend(self, key, val, time, flags):
+    def prepend(self, key, val, time, flags, noreply=False):
         if not self.is_connected():
             self.connect()
-        response = self._client.prepend(key, val, time, flags)
+        response = self._client.prepend(key, _str(val), time, flags)
         if response == 'STORED':
             return True
         else:
             return False
 
-    def replace(self, key, val, time, flags):
+    def replace(self, key, val, time, flags, noreply=False):
         if not self.is_connected():
             self.connect()
-        response = self._client.replace(key, val, time, flags)
+        response = self._client.replace(key, _str(val), time, flags)
         if response == 'STORED':
             return True
         return False
 
-    def set(self, key, val, time, flags):
+    def set(self, key, val, time, flags, noreply=False):
         if not self.is_connected():
             self.connect()
-        response = self._client.set(key, val, time, flags)
+        response = self._client.set(key, _str(val), time, flags)
         if response == 'STORED':
             return True
         return False
+
+    ## umemcache has no pipelining, so these are plain loops
+    def set_multi(self, items, time, noreply=False):
+        return [key for key, val, flags in items
+                if not self.set(key, val, time, flags)]
+
+    def delete_multi(self, keys, noreply=False):
+        return [key for key in keys if not self.delete(key)]
@@ -0,0 +1,80 @@
+# -*- coding: utf8 -*-
+
+# Copyright 2013 Medium Entertainment, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Ketama consistent hash ring, compatible with libketama.
+"""
+
+import bisect
+import struct
+from hashlib import md5
+
+# points per server, per 4 hashes (libketama uses 40 * 4 = 160)
+POINTS_PER_SERVER = 40
+
+_point_struct = struct.Struct('<IIII')
+_float_struct = struct.Struct('f')
+
+
+def _float32(value):
+    """round `value` to single precision, like a C float"""
+    return _float_struct.unpack(_float_struct.pack(value))[0]
+
+
+class KetamaRing(object):
+    """
+    Maps keys to nodes on a weighted, ketama compatible, continuum.
+
+    Each node is a (name, weight, value) tuple. `name` is what gets hashed
+    onto the ring, and must be "host:port" to match libketama placement.
+    `value` is what `get_node` returns for keys landing on that node.
+    """
+    def __init__(self, nodes):
+        if not nodes:
+            raise ValueError("At least one node is required")
+        total_weight = float(sum(weight for name, weight, value in nodes))
+        if total_weight <= 0:
+            raise ValueError("Total node weight must be positive")
+        points = []
+        for name, weight, value in nodes:
+            # libketama keeps the weight share in a float; with doubles
+            # 1/7 * 40 * 7 floors to 39 instead of 40.
+            share = _float32(weight / total_weight)
+            count = int(_float32(share * POINTS_PER_SERVER * len(nodes)))
+            for i in xrange(count):
+                digest = md5("%s-%d" % (name, i)).digest()
+                for point in _point_struct.unpack(digest):
+                    points.append((point, value))
+        points.sort(key=lambda p: p[0])
+        self._points = [p[0] for p in points]
+        self._values = [p[1] for p in points]
+
+    def __len__(self):
+        return len(self._points)
+
+    @staticmethod
+    def hash(key):
+        """ketama hash of `key` (first 4 bytes of md5, little endian)"""
+        return _point_struct.unpack(md5(key).digest())[0]
+
+    def get_node(self, key):
+        """
+        return the node value that `key` maps to
+        """
+        index = bisect.bisect_left(self._points, self.hash(key))
+        if index == len(self._points):
+            index = 0
+        return self._values[index]
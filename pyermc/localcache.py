@@ -0,0 +1,202 @@
+# -*- coding: utf8 -*-
+
+# Copyright 2013 Medium Entertainment, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bounded in process cache, kept in front of memcached for very hot keys.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+# default number of seconds an entry is served locally
+LOCAL_TTL = 5
+
+# value returned by LocalCache.get for a key remembered as missing
+MISSING = object()
+
+
+class LocalCache(object):
+    """
+    LRU cache of unpacked values, with a per entry time to live.
+
+    A `Client` created with `local_cache=LocalCache(...)` answers `get` and
+    `get_multi` from here when it can, and drops keys written or deleted
+    through it. Writes by other processes are not seen until the local
+    entry expires, so keep `ttl` short, and well below the expiry times
+    used on the server.
+
+    With `miss_ttl` set, keys that were not found on the server are
+    remembered too, so repeated lookups of missing keys stay local.
+
+    Cached values are returned as is, not copies, and must not be mutated.
+
+    The cache is thread safe, and may be shared by several clients (eg. all
+    clients of a ClientPool, or of a ShardedClient).
+    """
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=LOCAL_TTL,
+                 miss_ttl=None):
+        """
+        Create a new, empty, LocalCache.
+
+        Keyword arguments:
+          max_entries -- max number of values to keep. None means no limit.
+                         default: 1000
+          max_bytes   -- max total size of values to keep, counted as their
+                         size on the server. None means no limit.
+                         default: None
+          ttl         -- seconds a value is served locally after being
+                         fetched. None means values are not cached (eg.
+                         to only cache misses).
+                         default: LOCAL_TTL
+          miss_ttl    -- seconds a key not found on the server is answered
+                         locally as a miss. None means misses are not
+                         cached.
+                         default: None
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+
+        self._lock = threading.Lock()
+        # key -> (value, size, expires_at), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False)[0]
+
+    @property
+    def bytes(self):
+        """total size of the cached values"""
+        return self._bytes
+
+    def reset_stats(self):
+        """
+        Zero the hit/miss/eviction counters
+        """
+        self.hits = 0
+        # hits on keys remembered as missing, included in hits
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def stats(self):
+        """
+        returns dict -- counters, current size, and the hit ratio
+        """
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def _remove(self, key):
+        # must hold self._lock
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+        return entry
+
+    def get(self, key, count=True):
+        """
+        Look up `key`.
+
+        Keyword arguments:
+          count -- whether the lookup counts towards hit/miss stats
+
+        returns tuple -- (found, value). value is `MISSING` if the key is
+                         remembered as not on the server.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[2] > time.time():
+                    # re-insert as most recently used
+                    self._entries[key] = entry
+                    if count:
+                        self.hits += 1
+                        if entry[0] is MISSING:
+                            self.negative_hits += 1
+                    return True, entry[0]
+                self._bytes -= entry[1]
+                self.expirations += 1
+            if count:
+                self.misses += 1
+            return False, None
+
+    def set(self, key, value, size):
+        """
+        Store `value` for `key`, evicting least recently used values as
+        needed to stay within bounds.
+
+        Arguments:
+          size -- size of the value on the server, in bytes
+        """
+        if self.ttl is None:
+            return
+        self._store(key, value, size, self.ttl)
+
+    def set_miss(self, key):
+        """
+        Remember that `key` was not found on the server, if `miss_ttl` is
+        set.
+        """
+        if self.miss_ttl is None:
+            return
+        self._store(key, MISSING, 0, self.miss_ttl)
+
+    def _store(self, key, value, size, ttl):
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, size, time.time() + ttl)
+            self._bytes += size
+            while ((self.max_entries is not None and
+                        len(self._entries) > self.max_entries) or
+                   (self.max_bytes is not None and
+                        self._bytes > self.max_bytes)):
+                key, entry = self._entries.popitem(last=False)
+                self._bytes -= entry[1]
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        Drop `key`, if present.
+        """
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """
+        Drop everything.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
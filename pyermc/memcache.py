@@ -21,15 +21,22 @@
 # Inspiration from memcache_client:
 #   https://github.com/mixpanel/memcache_client
 
-import lz4
-import cPickle as pickle
+import os
 import socket
 import re
+import threading
 from . import driver
+from .casids import CasIds, CAS_MAX_ENTRIES
+from .compressor import (
+    LZ4Compressor, ZlibCompressor, COMPRESSION_FLAGS)
+from .localcache import MISSING
+from .serializer import PickleSerializer, RESERVED_FLAGS
+from .pipeline import Pipeline
 
 
 CONNECT_TIMEOUT = 3
 SOCKET_TIMEOUT = 3
+RECV_SIZE = driver.RECV_SIZE
 MAX_KEY_LENGTH = 250
 # memcached max is 1MB, but
 # ultramemcache (driver specific max size) is 1MiB.
@@ -52,6 +59,20 @@ class MemcacheSocketException(Exception):
     pass
 
 
+def _chunk_key(generation, index):
+    # key of chunk `index` of a large value, see Client._split_value
+    return "pyermc:chunk:%s:%d" % (generation, index)
+
+
+def _write_into(writable, data):
+    # write str `data` the way a driver get_into would have
+    if hasattr(writable, 'write'):
+        writable.write(data)
+    else:
+        driver.writable_view(writable, len(data))[:] = data
+    return len(data)
+
+
 class Client(object):
     """
     Object representing a connection to a backend memcache protocol driver.
@@ -61,6 +82,8 @@ class Client(object):
     _FLAG_INTEGER    = 1<<1
     _FLAG_LONG       = 1<<2
     _FLAG_COMPRESSED = 1<<3
+    # value is a manifest of chunks, see large_values
+    _FLAG_CHUNKED    = 1<<6
     # regex for key validation
     _valid_key_re = re.compile('^[^\x00-\x20\x7f\n\s]+$')
 
@@ -71,7 +94,12 @@ class Client(object):
                  max_value_length=MAX_VALUE_LENGTH,
                  pickle=True, pickle_proto=2,
                  disable_nagle=True, cache_cas=False, error_as_miss=False,
-                 client_driver=driver.DEFAULT_DRIVER):
+                 recv_size=RECV_SIZE, adaptive_recv=False,
+                 thread_local=False, local_cache=None,
+                 cas_max_entries=CAS_MAX_ENTRIES, cas_max_age=None,
+                 serializer=None, compressor=None, decompressors=(),
+                 min_compress_len=0, adaptive_compression=None,
+                 large_values=False, client_driver=driver.DEFAULT_DRIVER):
         """
         Create a new Client object connecting to the host and port.
 
@@ -91,6 +119,32 @@ class Client(object):
           pickle           -- whether to support pickling objects or not
                               default: True
           pickle_proto     -- pickle protocol to use. default: 2 (highest)
+          serializer       -- a `pyermc.Serializer`, packing values for
+                              storage. `pickle` and `pickle_proto` only
+                              apply to the default one.
+                              default: PickleSerializer
+          compressor       -- a `pyermc.Compressor`, used to compress values
+                              longer than `min_compress_len`.
+                              default: LZ4Compressor
+          decompressors    -- more compressors, only used to read values
+                              (eg. the previous codec while migrating to a
+                              new one). lz4 and zlib compressed values can
+                              always be read.
+                              default: ()
+          min_compress_len -- compress values longer than this, for write
+                              calls that don't set `min_compress_len`.
+                              default: 0 (never compress)
+          adaptive_compression -- a `pyermc.AdaptiveCompression`, to stop
+                              compressing values of key prefixes that don't
+                              compress well.
+                              default: None
+          large_values     -- store values longer than `max_value_length`
+                              (after compression) by splitting them into
+                              chunks under separate keys, instead of
+                              raising MemcacheValueError. Not supported by
+                              `append` and `prepend`. Clients reading such
+                              values need it too.
+                              default: False
           disable_nagle    -- disable Nagle's algorithm for the tcp socket.
                               May help improve performance in some cases.
                               default: False
@@ -102,6 +156,34 @@ class Client(object):
                               where a driver/socket fault simply returns
                               a `None`, and masks all errors.
                               default: False
+          recv_size        -- max bytes requested from the socket per recv
+                              call.
+                              default: RECV_SIZE
+          adaptive_recv    -- when a response header announces a large
+                              value, read it with as few recv calls as
+                              possible instead of `recv_size` at a time.
+                              default: False
+          thread_local     -- keep a separate driver (and connection) for
+                              each thread, so a single client can be shared
+                              between threads. If gevent has monkey patched
+                              threading before the client is created, this
+                              is one driver per greenlet instead.
+                              default: False
+          local_cache      -- a `pyermc.LocalCache`, answering `get` and
+                              `get_multi` in process for recently fetched
+                              keys (and, if its `miss_ttl` is set,
+                              recently missed ones). Writes through this
+                              client invalidate it. May be shared between
+                              clients.
+                              default: None
+          cas_max_entries  -- max number of CAS_IDs kept with cache_cas.
+                              Least recently used ones are dropped first,
+                              and `cas` of a dropped key falls back to
+                              `set`. None means no limit.
+                              default: CAS_MAX_ENTRIES
+          cas_max_age      -- seconds a CAS_ID is kept with cache_cas. None
+                              means until dropped for space.
+                              default: None
           client_driver    -- backend driver class reference that must be a
                               a subclass of `pyermc.driver.Driver`.
                               default: pyermc.driver.TextProtoDriver
@@ -116,12 +198,36 @@ class Client(object):
 
         self.pickle = pickle
         self.pickle_proto = pickle_proto
+        if serializer is None:
+            serializer = PickleSerializer(pickle, pickle_proto)
+        self.serializer = serializer
+        if compressor is None:
+            compressor = LZ4Compressor()
+        self.compressor = compressor
+        self.min_compress_len = min_compress_len
+        self.adaptive_compression = adaptive_compression
+        self.large_values = large_values
+        # flag bit -> compressor reading values with that flag
+        self._decompressors = {}
+        for c in ((LZ4Compressor(), ZlibCompressor()) +
+                  tuple(decompressors) + (compressor,)):
+            self._decompressors[c.flag] = c
         self.disable_nagle = disable_nagle
         self.cache_cas = cache_cas
         self.error_as_miss = error_as_miss
-
+        self.recv_size = recv_size
+        self.adaptive_recv = adaptive_recv
+        self.local_cache = local_cache
+        self.cas_max_entries = cas_max_entries
+        self.cas_max_age = cas_max_age
+
+        self._local = None
+        if thread_local:
+            # created here, so this is gevent's greenlet local only if
+            # gevent patched threading before the client was built.
+            self._local = threading.local()
         self._client = None
-        self.cas_ids = {}
+        self.reset_cas()
         self._driver = None
 
         if client_driver and issubclass(client_driver, driver.Driver):
@@ -138,12 +244,41 @@ class Client(object):
         except:
             pass
 
+    def _get_client(self):
+        if self._local is not None:
+            return getattr(self._local, 'client', None)
+        return self._shared_client
+
+    def _set_client(self, client):
+        if self._local is not None:
+            self._local.client = client
+        else:
+            self._shared_client = client
+
+    def _del_client(self):
+        self._set_client(None)
+
+    # driver instance, either shared or per thread (see thread_local)
+    _client = property(_get_client, _set_client, _del_client)
+
+    @property
+    def thread_local(self):
+        return self._local is not None
+
     def _init_driver(self):
+        # read tuning is only passed when set, so drivers that don't take
+        # it (see docs/writing_backends.txt) keep working
+        kwargs = {}
+        if self.recv_size != RECV_SIZE:
+            kwargs['recv_size'] = self.recv_size
+        if self.adaptive_recv:
+            kwargs['adaptive_recv'] = self.adaptive_recv
         self._client = self._driver(
             self.host, self.port,
             timeout=self.timeout,
             connect_timeout=self.connect_timeout,
-            disable_nagle=self.disable_nagle)
+            disable_nagle=self.disable_nagle,
+            **kwargs)
 
     @property
     def socket(self):
@@ -176,6 +311,9 @@ class Client(object):
     def close(self):
         """
         Closes connection to the backend
+
+        When created with `thread_local=True`, only the calling thread's
+        connection is closed.
         """
         if self._client:
             self._client.close()
@@ -194,7 +332,22 @@ class Client(object):
         """
         Reset internal CAS associations
         """
-        self.cas_ids = {}
+        self.cas_ids = CasIds(self.cas_max_entries, self.cas_max_age)
+
+    def pipeline(self):
+        """
+        Create a Pipeline, which queues commands and then sends them all in
+        a single write when executed.
+
+            >>> with client.pipeline() as p:
+            ...     p.get('a')
+            ...     p.set('b', 1)
+            >>> p.results
+            [None, True]
+
+        returns Pipeline
+        """
+        return Pipeline(self)
 
     ##
     ## misc operations
@@ -215,7 +368,7 @@ class Client(object):
         """
         return self._call_driver("version")
 
-    def incr(self, key, delta=1):
+    def incr(self, key, delta=1, noreply=False):
         """
         Increment a stored number identified by `key`
 
@@ -223,17 +376,17 @@ class Client(object):
          key   -- string key
 
         Keyword Arguments:
-         delta -- value to increment by. default:1
+         delta   -- value to increment by. default:1
+         noreply -- don't wait for the server's response, and return None.
+                    failures are then only reported by `sync`.
+                    default:False
 
         returns int or None (on failure)
         """
-        if not isinstance(delta, int):
-            raise TypeError("An integer is required")
-        if delta < 0:
-            return self._call_driver("decr", key, abs(delta))
-        return self._call_driver("incr", key, delta)
+        cmd, args = self._incrdecr_args("incr", key, delta)
+        return self._call_write(cmd, noreply, *args)
 
-    def decr(self, key, delta=1):
+    def decr(self, key, delta=1, noreply=False):
         """
         Decrement a stored number identified by `key`
 
@@ -241,26 +394,55 @@ class Client(object):
          key   -- string key
 
         Keyword Arguments:
-         delta -- value to decrement by. default:1
+         delta   -- value to decrement by. default:1
+         noreply -- don't wait for the server's response, and return None.
+                    failures are then only reported by `sync`.
+                    default:False
 
         returns int or None (on failure)
         """
-        if not isinstance(delta, int):
-            raise TypeError("An integer is required")
-        if delta < 0:
-            return self._call_driver("incr", key, abs(delta))
-        return self._call_driver("decr", key, delta)
+        cmd, args = self._incrdecr_args("decr", key, delta)
+        return self._call_write(cmd, noreply, *args)
 
-    def delete(self, key):
+    def delete(self, key, noreply=False):
         """
         Delete a stored value identified by `key`
 
         Arguments:
           key  -- string key
 
+        Keyword arguments:
+          noreply -- don't wait for the server's response, and return None.
+                     failures are then only reported by `sync`.
+                     default:False
+
         returns bool
         """
-        return self._call_driver("delete", key)
+        return self._call_write("delete", noreply, key)
+
+    def delete_multi(self, keys, noreply=False):
+        """
+        Delete the stored value for each key in `keys`, sending all requests
+        at once instead of waiting for each response in turn.
+
+        Arguments:
+          keys -- iterable of str
+
+        Keyword arguments:
+          noreply -- don't wait for the server to acknowledge the deletes.
+                     failures are then only reported by `sync`.
+                     default:False
+
+        returns list -- keys from `keys` that were not deleted
+        """
+        keymap = dict((self.check_key(k), k) for k in keys)
+        if not keymap:
+            return []
+        try:
+            failed = self._call_driver('delete_multi', list(keymap), noreply)
+        finally:
+            self._forget(keymap)
+        return self._unpack_failed(keymap, failed)
 
     def flush_all(self):
         """
@@ -268,12 +450,25 @@ class Client(object):
 
         returns bool
         """
+        if self.local_cache is not None:
+            self.local_cache.clear()
         return self._call_driver("flush_all")
 
+    def sync(self):
+        """
+        Waits for the server to process every `noreply` command sent so far.
+
+        returns list -- keys of noreply commands that failed since the last
+                        sync. Drivers that can't tell (text protocol) or
+                        never skip responses (ultramemcache) return [].
+        """
+        return self._call_driver("sync") or []
+
     ##
     ## set operations
     ##
-    def add(self, key, val, time=0, min_compress_len=0):
+    def add(self, key, val, time=0, min_compress_len=None,
+            noreply=False):
         """
         Sets a value to server identified by `key`, iff it does not
         already exist.
@@ -285,13 +480,19 @@ class Client(object):
         Keyword arguments:
           time -- how far into the future to expire. default:0 (means never)
           min_compress_length -- minimum string size to attempt to compress.
-                                 default:0 (0 means never compress)
+                                 default:None (the client's
+                                 min_compress_len). 0 means never.
+          noreply -- don't wait for the server's response, and return None.
+                     failures are then only reported by `sync`.
+                     default:False
 
         returns bool
         """
-        return self._set("add", key, val, time, min_compress_len)
+        return self._set("add", key, val, time, min_compress_len,
+                         noreply)
 
-    def append(self, key, val, time=0, min_compress_len=0):
+    def append(self, key, val, time=0, min_compress_len=None,
+               noreply=False):
         """
         Appends `val` to stored data at `key`, iff `key` exists.
 
@@ -302,13 +503,19 @@ class Client(object):
         Keyword arguments:
           time -- how far into the future to expire. default:0 (means never)
           min_compress_length -- minimum string size to attempt to compress.
-                                 default:0 (0 means never compress)
+                                 default:None (the client's
+                                 min_compress_len). 0 means never.
+          noreply -- don't wait for the server's response, and return None.
+                     failures are then only reported by `sync`.
+                     default:False
 
         returns bool
         """
-        return self._set("append", key, val, time, min_compress_len)
+        return self._set("append", key, val, time, min_compress_len,
+                         noreply)
 
-    def prepend(self, key, val, time=0, min_compress_len=0):
+    def prepend(self, key, val, time=0, min_compress_len=None,
+                noreply=False):
         """
         Prepends `val` to stored data at `key`, iff `key` exists.
 
@@ -319,13 +526,19 @@ class Client(object):
         Keyword arguments:
           time -- how far into the future to expire. default:0 (means never)
           min_compress_length -- minimum string size to attempt to compress.
-                                 default:0 (0 means never compress)
+                                 default:None (the client's
+                                 min_compress_len). 0 means never.
+          noreply -- don't wait for the server's response, and return None.
+                     failures are then only reported by `sync`.
+                     default:False
 
         returns bool
         """
-        return self._set("prepend", key, val, time, min_compress_len)
+        return self._set("prepend", key, val, time, min_compress_len,
+                         noreply)
 
-    def replace(self, key, val, time=0, min_compress_len=0):
+    def replace(self, key, val, time=0, min_compress_len=None,
+                noreply=False):
         """
         Replaces currently stored value at `key` with `val`, iff `key` exists.
 
@@ -336,13 +549,19 @@ class Client(object):
         Keyword arguments:
           time -- how far into the future to expire. default:0 (means never)
           min_compress_length -- minimum string size to attempt to compress.
-                                 default:0 (0 means never compress)
+                                 default:None (the client's
+                                 min_compress_len). 0 means never.
+          noreply -- don't wait for the server's response, and return None.
+                     failures are then only reported by `sync`.
+                     default:False
 
         returns bool
         """
-        return self._set("replace", key, val, time, min_compress_len)
+        return self._set("replace", key, val, time, min_compress_len,
+                         noreply)
 
-    def set(self, key, val, time=0, min_compress_len=0):
+    def set(self, key, val, time=0, min_compress_len=None,
+            noreply=False):
         """
         Sets stored value at `key` to `val`
 
@@ -353,16 +572,46 @@ class Client(object):
         Keyword arguments:
           time -- how far into the future to expire. default:0 (means never)
           min_compress_length -- minimum string size to attempt to compress.
-                                 default:0 (0 means never compress)
+                                 default:None (the client's
+                                 min_compress_len). 0 means never.
+          noreply -- don't wait for the server's response, and return None.
+                     failures are then only reported by `sync`.
+                     default:False
 
         returns bool
         """
-        return self._set("set", key, val, time, min_compress_len)
+        return self._set("set", key, val, time, min_compress_len,
+                         noreply)
 
-    #def set_multi(self):
-    #    ## unsupport!
+    def set_multi(self, mapping, time=0, min_compress_len=None, noreply=False):
+        """
+        Sets stored value for each key in `mapping`, sending all requests
+        at once instead of waiting for each response in turn.
 
-    def cas(self, key, val, time=0, min_compress_len=0):
+        Arguments:
+          mapping -- dict of key to value to set
+
+        Keyword arguments:
+          time -- how far into the future to expire. default:0 (means never)
+          min_compress_length -- minimum string size to attempt to compress.
+                                 default:None (the client's
+                                 min_compress_len). 0 means never.
+          noreply -- don't wait for the server to acknowledge the writes.
+                     failures are then only reported by `sync`.
+                     default:False
+
+        returns list -- keys from `mapping` that were not stored
+        """
+        if not mapping:
+            return []
+        keymap, items = self._store_items(mapping, min_compress_len)
+        try:
+            failed = self._call_driver('set_multi', items, time, noreply)
+        finally:
+            self._forget(keymap)
+        return self._unpack_failed(keymap, failed)
+
+    def cas(self, key, val, time=0, min_compress_len=None):
         """
         Check-and-Set sets stored value at `key` to `val`, iff it has not
         been modified since it was retrieved via `gets` or `gets_multi`.
@@ -377,7 +626,8 @@ class Client(object):
         Keyword arguments:
           time -- how far into the future to expire. default:0 (means never)
           min_compress_length -- minimum string size to attempt to compress.
-                                 default:0 (0 means never compress)
+                                 default:None (the client's
+                                 min_compress_len). 0 means never.
 
         returns bool
         """
@@ -438,6 +688,103 @@ class Client(object):
         """
         return self._get_multi('gets_multi', keys)
 
+    def iter_multi(self, keys):
+        """
+        gets a stored value for each key in `keys`, like get_multi, but
+        yields each one as soon as it is read and unpacked, instead of
+        building a dict. Processing starts with the first response, and
+        only one value is held at a time (large values split in chunks are
+        joined, and yielded, at the end).
+
+        The client can't be used for anything else while iterating. Closing
+        the iterator early (eg. breaking out of a for loop) closes the
+        connection.
+
+        Arguments:
+          keys -- iterable of str
+
+        returns iterator of (key, value) tuples. keys not found are skipped.
+        """
+        keys = [self.check_key(k) for k in keys]
+        found, keys = self._local_get_multi(keys)
+        for item in found.iteritems():
+            yield item
+        if not keys:
+            return
+
+        local_cache = self.local_cache
+        seen = set()
+        manifests = {}
+        responses = None
+        try:
+            if not self._client:
+                self.connect()
+            responses = self._client.iter_multi(keys)
+            for key, (val, flags) in responses:
+                seen.add(key)
+                if self.large_values and flags & Client._FLAG_CHUNKED:
+                    # fetched once all responses are read
+                    manifests[key] = val
+                    continue
+                value = self._recv_value(val, flags)
+                if local_cache is not None:
+                    local_cache.set(key, value, len(val))
+                yield key, value
+        except (RuntimeError, IOError) as e:
+            # error_as_miss masked a fault, which is not known to be a miss
+            self._driver_error(e)
+            return
+        finally:
+            # generators drop the connection if closed before the end
+            if hasattr(responses, 'close'):
+                responses.close()
+
+        if local_cache is not None:
+            for key in keys:
+                if key not in seen:
+                    local_cache.set_miss(key)
+        if manifests:
+            for key, (val, flags) in self._join_chunks(manifests).iteritems():
+                value = self._recv_value(val, flags)
+                if local_cache is not None:
+                    local_cache.set(key, value, len(val))
+                yield key, value
+
+    def get_into(self, key, writable):
+        """
+        gets the str stored at `key`, writing it into `writable` instead of
+        returning it. Plain str values (not compressed) are read straight
+        from the socket into `writable`, so a large value is never held in
+        memory whole. Other values are unpacked first, and must unpack to
+        a str. The local cache is not used.
+
+        Arguments:
+          key      -- string key
+          writable -- bytearray (grown as needed), memoryview or other
+                      writable buffer, written from its start. Or a file
+                      like object, written at its current position.
+
+        returns int or None -- number of bytes written. None if not found,
+                               in which case part of a large value may have
+                               been written already.
+        """
+        key = self.check_key(key)
+        response = self._call_driver('get_into', key, writable)
+        if not response:
+            return None
+        length, flags, val = response
+        if val is None:
+            # already written by the driver
+            return length
+
+        if self.large_values and flags & Client._FLAG_CHUNKED:
+            return self._get_chunks_into(key, val, writable)
+        value = self._recv_value(val, flags)
+        if not isinstance(value, str):
+            raise MemcacheValueError(
+                "Value is not a str: %s" % type(value).__name__)
+        return _write_into(writable, value)
+
     ##
     ## data massaging methods
     ##
@@ -484,80 +831,242 @@ class Client(object):
             raise MemcacheKeyError("Control characters not allowed")
         return key
 
-    # flag logic from python-memcache
-    def _val_to_store_info(self, val, min_compress_len):
+    def _val_to_store_info(self, val, min_compress_len, key=None):
         """
         Transform val to a storable representation, returning a tuple of the
         flags, the length of the new value, and the new value itself.
         """
-        flags = 0
-        if isinstance(val, str):
-            pass
-        elif isinstance(val, int):
-            flags |= Client._FLAG_INTEGER
-            val = "%d" % val
-            # maxint is pretty tiny. just return
-            return (flags, val)
-        elif isinstance(val, long):
-            flags |= Client._FLAG_LONG
-            val = "%d" % val
-            # longs can be huge, so check length and compress if long enough
-        else:
-            if self.pickle:
-                flags |= Client._FLAG_PICKLE
-                val = pickle.dumps(val, self.pickle_proto)
+        flags, val = self.serializer.dumps(val)
 
         lv = len(val)
         #  do not store if value length exceeds maximum
-        if self.max_value_length and lv > self.max_value_length:
+        if (self.max_value_length and lv > self.max_value_length and
+                not self.large_values):
             raise MemcacheValueError(
                 "Value is larger than configured max_value_length. %d > %d" %
                 (lv, self.max_value_length))
 
         # We should try to compress if min_compress_len > 0 and this
         # string is longer than min threshold.
-        if min_compress_len and lv > min_compress_len:
-            comp_val = lz4.compress(val)
+        if min_compress_len is None:
+            min_compress_len = self.min_compress_len
+        adaptive = self.adaptive_compression
+        if (min_compress_len and lv > min_compress_len and
+                (adaptive is None or key is None or
+                 adaptive.should_compress(key))):
+            if isinstance(val, (bytearray, memoryview)):
+                # codecs take str only. compressing copies anyway.
+                comp_val = self.compressor.compress(memoryview(val).tobytes())
+            else:
+                comp_val = self.compressor.compress(val)
+            if adaptive is not None and key is not None:
+                adaptive.record(key, lv, len(comp_val))
             # Only actually compress if the compressed result is smaller
             # than the original.
             if len(comp_val) < lv:
-                flags |= Client._FLAG_COMPRESSED
+                flags |= self.compressor.flag
                 val = comp_val
         return (flags, val)
 
     def _recv_value(self, buf, flags):
-        if flags & Client._FLAG_COMPRESSED:
-            buf = lz4.decompress(buf)
-
-        if  flags == 0 or flags == Client._FLAG_COMPRESSED:
-            # Either a bare string or a compressed string now decompressed...
-            val = buf
-        elif flags & Client._FLAG_INTEGER:
-            val = int(buf)
-        elif flags & Client._FLAG_LONG:
-            val = long(buf)
-        elif flags & Client._FLAG_PICKLE:
-            val = pickle.loads(buf)
-        return val
+        if flags & Client._FLAG_CHUNKED:
+            raise MemcacheValueError(
+                "Value was split in chunks, reading it needs large_values")
+        compression = flags & COMPRESSION_FLAGS
+        if compression:
+            decompressor = self._decompressors.get(compression)
+            if decompressor is None:
+                raise MemcacheValueError(
+                    "No compressor for value flags %d" % flags)
+            buf = decompressor.decompress(buf)
+        return self.serializer.loads(buf, flags & ~RESERVED_FLAGS)
 
     ##
     ## client calling methods
     ##
-    def _set(self, cmd, key, val, time=0, min_compress_len=0):
+    def _set(self, cmd, key, val, time=0, min_compress_len=None,
+             noreply=False):
+        cmd, args, chunks = self._set_args(
+            cmd, key, val, time, min_compress_len)
+        if chunks:
+            return self._set_chunked(cmd, noreply, args, chunks)
+        return self._call_write(cmd, noreply, *args)
+
+    def _set_chunked(self, cmd, noreply, args, chunks):
+        """
+        write the chunks of a large value, then its manifest, in one batch.
+        """
+        kwargs = {'noreply': True} if noreply else {}
+        # args[-2] is always the expiry time
+        commands = [('set_multi', (chunks, args[-2]), kwargs),
+                    (cmd, args, kwargs)]
+        try:
+            responses = None
+            if self._call_driver('pipeline_send', commands):
+                responses = self._call_driver('pipeline_recv')
+        finally:
+            self._forget(args[:1])
+        if not responses or noreply:
+            return None
+        failed, stored = responses
+        # a manifest without all of its chunks reads as a miss
+        return stored and not failed
+
+    def _set_args(self, cmd, key, val, time, min_compress_len):
+        """
+        check key and pack value for a set style command.
+
+        returns tuple -- (driver method name, args, chunk items to store
+                          first if the value is split)
+        """
         key = self.check_key(key)
-        flags, sval = self._val_to_store_info(val, min_compress_len)
+        flags, sval = self._val_to_store_info(val, min_compress_len, key)
+        chunks = None
+        if self.large_values:
+            if cmd in ('append', 'prepend'):
+                self._check_length(sval)
+            else:
+                flags, sval, chunks = self._split_value(flags, sval)
 
         args = (key, sval, time, flags)
         if cmd == 'cas':
-            if key in self.cas_ids:
-                args = (key, sval, self.cas_ids[key], time, flags)
+            cas_id = self.cas_ids.get(key)
+            if cas_id is not None:
+                args = (key, sval, cas_id, time, flags)
             else:
                 cmd = 'set'  # key not in cas_ids, so just do a set instead
-        return self._call_driver(cmd, *args)
+        return cmd, args, chunks
+
+    def _check_length(self, sval):
+        if self.max_value_length and len(sval) > self.max_value_length:
+            raise MemcacheValueError(
+                "Value is larger than configured max_value_length. %d > %d" %
+                (len(sval), self.max_value_length))
+
+    def _split_value(self, flags, sval):
+        """
+        split a packed value longer than max_value_length into chunks.
+
+        Each chunk is stored under a key made of a random generation token
+        and its index, so chunks of concurrent writes never mix. The value
+        itself is replaced by a manifest of the token, the number of
+        chunks, the total length and the original flags.
+
+        returns tuple -- (flags, value, list of (key, val, flags) chunks).
+                         the chunk list is None for values short enough
+                         to store as is.
+        """
+        size = self.max_value_length
+        if not size or len(sval) <= size:
+            return flags, sval, None
+        generation = os.urandom(8).encode('hex')
+        # chunks are views of the value, not copies
+        view = memoryview(sval)
+        chunks = []
+        for i, offset in enumerate(xrange(0, len(sval), size)):
+            chunks.append((_chunk_key(generation, i),
+                           view[offset:offset + size], 0))
+        manifest = "%s %d %d %d" % (generation, len(chunks), len(sval), flags)
+        return Client._FLAG_CHUNKED, manifest, chunks
+
+    def _join_chunks(self, manifests):
+        """
+        fetch the chunks of large values with a single get_multi.
+
+        Arguments:
+          manifests -- dict of key to manifest
+
+        returns dict -- key to (packed value, flags), for the values whose
+                        chunks were all found
+        """
+        parsed = {}
+        chunk_keys = []
+        for key, manifest in manifests.iteritems():
+            generation, count, length, flags = manifest.split()
+            keys = [_chunk_key(generation, i) for i in xrange(int(count))]
+            parsed[key] = (keys, int(length), int(flags))
+            chunk_keys.extend(keys)
+        response = self._call_driver('get_multi', chunk_keys) or {}
+
+        joined = {}
+        for key, (keys, length, flags) in parsed.iteritems():
+            if not all(k in response for k in keys):
+                # some chunks were evicted, or belong to an overwritten
+                # generation that expired
+                continue
+            sval = ''.join([response[k][0] for k in keys])
+            if len(sval) == length:
+                joined[key] = (sval, flags)
+        return joined
+
+    def _get_chunks_into(self, key, manifest, writable):
+        """
+        write the large value described by `manifest` into `writable`, one
+        chunk at a time when it is a plain str.
+
+        returns int or None -- number of bytes written, None if a chunk is
+                               missing
+        """
+        generation, count, length, flags = manifest.split()
+        length = int(length)
+        if int(flags):
+            # packed as a whole, so it has to be joined to be unpacked
+            joined = self._join_chunks({key: manifest})
+            if key not in joined:
+                return None
+            value = self._recv_value(*joined[key])
+            if not isinstance(value, str):
+                raise MemcacheValueError(
+                    "Value is not a str: %s" % type(value).__name__)
+            return _write_into(writable, value)
+
+        view = None
+        if not hasattr(writable, 'write'):
+            view = driver.writable_view(writable, length)
+        offset = 0
+        for i in xrange(int(count)):
+            target = writable if view is None else view[offset:]
+            response = self._call_driver(
+                'get_into', _chunk_key(generation, i), target)
+            if not response or response[2] is not None:
+                return None
+            offset += response[0]
+        if offset != length:
+            return None
+        return length
+
+    def _incrdecr_args(self, cmd, key, delta):
+        """
+        returns tuple -- (driver method name, args) for an incr/decr by
+                         `delta`, flipping the command for negative deltas.
+        """
+        if not isinstance(delta, int):
+            raise TypeError("An integer is required")
+        if delta < 0:
+            cmd = 'decr' if cmd == 'incr' else 'incr'
+        return cmd, (key, abs(delta))
 
     def _get(self, cmd, key):
         key = self.check_key(key)
-        response = self._call_driver(cmd, key)
+        if cmd == 'get' and self.local_cache is not None:
+            found, value = self.local_cache.get(key)
+            if found:
+                return None if value is MISSING else value
+            response = self._call_driver_or(MISSING, cmd, key)
+            if response is MISSING:
+                # error_as_miss masked a fault, not known to be a miss
+                return None
+            if not response:
+                self.local_cache.set_miss(key)
+        else:
+            response = self._call_driver(cmd, key)
+        return self._unpack_get(cmd, key, response)
+
+    def _unpack_get(self, cmd, key, response):
+        """
+        unpack a get/gets driver response into a value, caching the CAS_ID
+        as needed.
+        """
         if not response:
             return None
 
@@ -571,14 +1080,120 @@ class Client(object):
         if not val:
             return None
 
+        if self.large_values and flags & Client._FLAG_CHUNKED:
+            joined = self._join_chunks({key: val})
+            if key not in joined:
+                return None
+            val, flags = joined[key]
+
         value = self._recv_value(val, flags)
+        if cmd == 'get' and self.local_cache is not None:
+            self.local_cache.set(key, value, len(val))
         return value
 
     def _get_multi(self, cmd, keys):
         keys = [self.check_key(k) for k in keys]
+        retvals = {}
+        if cmd == 'get_multi':
+            retvals, keys = self._local_get_multi(keys)
+            if not keys:
+                return retvals
         response = self._call_driver(cmd, keys)
-        if not response:
+        retvals.update(self._unpack_multi(cmd, response, keys))
+        return retvals
+
+    def _local_get_multi(self, keys):
+        """
+        look up checked `keys` in the local cache.
+
+        returns tuple -- (dict of values found, list of keys to fetch).
+                         keys remembered as misses are in neither.
+        """
+        if self.local_cache is None:
+            return {}, keys
+        found = {}
+        missing = []
+        for key in keys:
+            hit, value = self.local_cache.get(key)
+            if not hit:
+                missing.append(key)
+            elif value is not MISSING:
+                found[key] = value
+        return found, missing
+
+    def _forget(self, keys):
+        """
+        drop `keys`, which were just written, from the local cache.
+        """
+        if self.local_cache is None:
+            return
+        for key in keys:
+            if isinstance(key, unicode):
+                key = key.encode('utf-8')
+            self.local_cache.delete(key)
+
+    def _store_items(self, mapping, min_compress_len):
+        """
+        check keys and pack values of a set_multi `mapping`.
+
+        returns tuple -- (dict of checked key to caller's key,
+                          list of (key, val, flags) for the driver)
+        """
+        keymap = {}
+        items = []
+        for key, val in mapping.iteritems():
+            skey = self.check_key(key)
+            flags, sval = self._val_to_store_info(val, min_compress_len, skey)
+            if self.large_values:
+                flags, sval, chunks = self._split_value(flags, sval)
+                if chunks:
+                    # chunks go first, so the manifest never lands before
+                    # them. a failed chunk reports the caller's key.
+                    for chunk in chunks:
+                        keymap[chunk[0]] = key
+                    items.extend(chunks)
+            keymap[skey] = key
+            items.append((skey, sval, flags))
+        return keymap, items
+
+    def _unpack_failed(self, keymap, failed):
+        """
+        map the failed keys of a set_multi/delete_multi driver response
+        back to the keys the caller passed in.
+        """
+        if failed is None:
+            # error_as_miss masked a fault. nothing is known to have worked.
+            failed = keymap
+        # chunks of a large value map to the same key
+        seen = set()
+        keys = []
+        for k in failed:
+            key = keymap[k]
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+        return keys
+
+    def _unpack_multi(self, cmd, response, keys=()):
+        """
+        unpack a get_multi/gets_multi driver response into a dict of values,
+        caching CAS_IDs as needed. `keys` not in a get_multi response are
+        remembered as misses.
+        """
+        if response is None:
+            # error_as_miss masked a fault, not known to be a miss
             return {}
+        if cmd == 'get_multi' and self.local_cache is not None:
+            for k in keys:
+                if k not in response:
+                    self.local_cache.set_miss(k)
+
+        manifests = {}
+        if self.large_values:
+            manifests = dict((k, v[0]) for k, v in response.iteritems()
+                             if v[1] & Client._FLAG_CHUNKED)
+        if manifests:
+            joined = self._join_chunks(manifests)
 
         retvals = {}
         for k in response:
@@ -588,26 +1203,53 @@ class Client(object):
                     self.cas_ids[k] = cas_id
             else:
                 value, flags = response[k]
+            if k in manifests:
+                if k not in joined:
+                    continue
+                value, flags = joined[k]
             val = self._recv_value(value, flags)
             retvals[k] = val
+            if cmd == 'get_multi' and self.local_cache is not None:
+                self.local_cache.set(k, val, len(value))
         return retvals
 
-    def _call_driver(self, cmd, *args):
+    def _call_write(self, cmd, noreply, *args):
+        # only pass noreply along when set, the common case stays a plain
+        # positional call.
+        try:
+            if noreply:
+                return self._call_driver(cmd, *args, noreply=True)
+            return self._call_driver(cmd, *args)
+        finally:
+            # args[0] is always the key
+            self._forget(args[:1])
+
+    def _call_driver(self, cmd, *args, **kwargs):
+        return self._call_driver_or(None, cmd, *args, **kwargs)
+
+    def _call_driver_or(self, masked, cmd, *args, **kwargs):
+        """
+        call driver method `cmd`, returning `masked` if error_as_miss masks
+        an error.
+        """
         try:
             if not self._client:
                 self.connect()
-            return getattr(self._client, cmd)(*args)
-        except socket.error as e:
-            self.close()
-            if self.error_as_miss:
-                return None
-            ## reraise wrapped, but with original exception included in args
-            ## to provide for callers to introspect.
-            raise MemcacheSocketException(str(e), e)
+            return getattr(self._client, cmd)(*args, **kwargs)
         except (RuntimeError, IOError) as e:
-            self.close()
-            if self.error_as_miss:
-                return None
-            ## reraise wrapped, but with original exception included in args
-            ## to provide for callers to introspect.
-            raise MemcacheDriverException(str(e), e)
+            self._driver_error(e)
+            return masked
+
+    def _driver_error(self, e):
+        """
+        close the connection after driver error `e`, and reraise it wrapped
+        unless error_as_miss masks it.
+        """
+        self.close()
+        if self.error_as_miss:
+            return
+        ## reraise wrapped, but with original exception included in args
+        ## to provide for callers to introspect.
+        if isinstance(e, socket.error):
+            raise MemcacheSocketException(str(e), e)
+        raise MemcacheDriverException(str(e), e)
@@ -0,0 +1,254 @@
+# -*- coding: utf8 -*-
+
+# Copyright 2013 Medium Entertainment, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batches of mixed commands, sent to the server in a single write.
+"""
+
+from functools import partial
+
+# unpacker of commands whose result is left out of Pipeline.results
+_HIDDEN = object()
+
+
+def _no_failures(response):
+    # noreply writes are never acknowledged, so none is known to have failed
+    return []
+
+
+class Pipeline(object):
+    """
+    Queues commands for a `Client`, then sends them all in one write and
+    reads every response in order, so a burst of commands costs a single
+    round trip. Create one with `Client.pipeline()`.
+
+        >>> with client.pipeline() as p:
+        ...     p.get('a')
+        ...     p.incr('b')
+        ...     p.set('c', 'x')
+        ...     p.delete('d')
+        >>> p.results
+        ['a value', 2, True, False]
+
+    Queuing methods take the same arguments as the `Client` methods, and
+    return the pipeline. Key and value checks happen when a command is
+    queued. Like `Client.cas`, a queued `cas` uses the CAS_ID known at the
+    time it is queued, not one fetched by a `gets` earlier in the pipeline.
+    """
+    def __init__(self, client):
+        self.client = client
+        # results of the last execute()
+        self.results = None
+        self._commands = []
+        self._unpackers = []
+        # keys written by queued commands, dropped from the local cache
+        self._written = []
+        # key of each queued get, remembered in the local cache on a miss
+        self._misses = []
+
+    def __len__(self):
+        """number of queued commands"""
+        return len(self._commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        else:
+            self.reset()
+
+    def reset(self):
+        """
+        Drop all queued commands
+        """
+        self._commands = []
+        self._unpackers = []
+        self._written = []
+        self._misses = []
+
+    def execute(self):
+        """
+        Send all queued commands in a single write, then read the response
+        to each one. The pipeline is empty, and can be reused, afterwards.
+
+        returns list -- result of each queued command in order, as the
+                        matching Client method would have returned it.
+                        Also stored as `results`.
+        """
+        commands, unpackers = self._commands, self._unpackers
+        written, misses = self._written, self._misses
+        self.reset()
+        # commands that turned out to need no server round trip are None
+        send = [command for command in commands if command]
+        responses = None
+        if send:
+            client = self.client
+            try:
+                if client._call_driver('pipeline_send', send):
+                    responses = client._call_driver('pipeline_recv')
+            finally:
+                client._forget(written)
+        local_cache = self.client.local_cache
+        if responses is None:
+            # error_as_miss masked a fault, which is not known to be a miss
+            responses = [None] * len(send)
+            local_cache = None
+        responses = iter(responses)
+
+        self.results = []
+        for command, unpack, miss in zip(commands, unpackers, misses):
+            response = next(responses) if command else None
+            if unpack is _HIDDEN:
+                continue
+            if miss and not response and local_cache is not None:
+                local_cache.set_miss(miss)
+            if unpack:
+                response = unpack(response)
+            self.results.append(response)
+        return self.results
+
+    def _queue(self, cmd, args, unpack=None, noreply=False, written=(),
+               miss=None):
+        self._written.extend(written)
+        self._misses.append(miss)
+        if cmd is None:
+            self._commands.append(None)
+        elif noreply:
+            self._commands.append((cmd, args, {'noreply': True}))
+        else:
+            self._commands.append((cmd, args))
+        self._unpackers.append(unpack)
+        return self
+
+    ##
+    ## misc operations
+    ##
+    def stats(self):
+        """queue Client.stats"""
+        return self._queue('stats', ())
+
+    def version(self):
+        """queue Client.version"""
+        return self._queue('version', ())
+
+    def flush_all(self):
+        """queue Client.flush_all"""
+        if self.client.local_cache is not None:
+            self.client.local_cache.clear()
+        return self._queue('flush_all', ())
+
+    def incr(self, key, delta=1, noreply=False):
+        """queue Client.incr"""
+        cmd, args = self.client._incrdecr_args('incr', key, delta)
+        return self._queue(cmd, args, noreply=noreply, written=(key,))
+
+    def decr(self, key, delta=1, noreply=False):
+        """queue Client.decr"""
+        cmd, args = self.client._incrdecr_args('decr', key, delta)
+        return self._queue(cmd, args, noreply=noreply, written=(key,))
+
+    def delete(self, key, noreply=False):
+        """queue Client.delete"""
+        return self._queue(
+            'delete', (key,), noreply=noreply, written=(key,))
+
+    def delete_multi(self, keys, noreply=False):
+        """queue Client.delete_multi"""
+        keymap = dict((self.client.check_key(k), k) for k in keys)
+        unpack = partial(self.client._unpack_failed, keymap)
+        if noreply:
+            unpack = _no_failures
+        return self._queue(
+            'delete_multi' if keymap else None, (list(keymap), noreply),
+            unpack, written=keymap)
+
+    ##
+    ## set operations
+    ##
+    def _set(self, cmd, key, val, time, min_compress_len, noreply=False):
+        cmd, args, chunks = self.client._set_args(
+            cmd, key, val, time, min_compress_len)
+        if chunks:
+            # the chunks of a large value go first, with no result of
+            # their own. a missing chunk makes the value read as a miss.
+            self._queue('set_multi', (chunks, time, noreply), _HIDDEN)
+        return self._queue(cmd, args, noreply=noreply, written=args[:1])
+
+    def add(self, key, val, time=0, min_compress_len=None, noreply=False):
+        """queue Client.add"""
+        return self._set('add', key, val, time, min_compress_len, noreply)
+
+    def append(self, key, val, time=0, min_compress_len=None, noreply=False):
+        """queue Client.append"""
+        return self._set('append', key, val, time, min_compress_len, noreply)
+
+    def prepend(self, key, val, time=0, min_compress_len=None, noreply=False):
+        """queue Client.prepend"""
+        return self._set('prepend', key, val, time, min_compress_len, noreply)
+
+    def replace(self, key, val, time=0, min_compress_len=None, noreply=False):
+        """queue Client.replace"""
+        return self._set('replace', key, val, time, min_compress_len, noreply)
+
+    def set(self, key, val, time=0, min_compress_len=None, noreply=False):
+        """queue Client.set"""
+        return self._set('set', key, val, time, min_compress_len, noreply)
+
+    def set_multi(self, mapping, time=0, min_compress_len=None, noreply=False):
+        """queue Client.set_multi"""
+        keymap, items = self.client._store_items(mapping, min_compress_len)
+        unpack = partial(self.client._unpack_failed, keymap)
+        if noreply:
+            unpack = _no_failures
+        return self._queue(
+            'set_multi' if items else None, (items, time, noreply),
+            unpack, written=keymap)
+
+    def cas(self, key, val, time=0, min_compress_len=None):
+        """queue Client.cas"""
+        return self._set('cas', key, val, time, min_compress_len)
+
+    ##
+    ## get operations
+    ##
+    def get(self, key):
+        """queue Client.get"""
+        key = self.client.check_key(key)
+        return self._queue(
+            'get', (key,), partial(self.client._unpack_get, 'get', key),
+            miss=key)
+
+    def gets(self, key):
+        """queue Client.gets"""
+        key = self.client.check_key(key)
+        return self._queue(
+            'gets', (key,), partial(self.client._unpack_get, 'gets', key))
+
+    def get_multi(self, keys):
+        """queue Client.get_multi"""
+        keys = [self.client.check_key(k) for k in keys]
+        return self._queue(
+            'get_multi', (keys,),
+            partial(self.client._unpack_multi, 'get_multi', keys=keys))
+
+    def gets_multi(self, keys):
+        """queue Client.gets_multi"""
+        keys = [self.client.check_key(k) for k in keys]
+        return self._queue(
+            'gets_multi', (keys,),
+            partial(self.client._unpack_multi, 'gets_multi'))
@@ -0,0 +1,201 @@
+# -*- coding: utf8 -*-
+
+# Copyright 2013 Medium Entertainment, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bounded pool of Client objects, for sharing a few connections between
+many threads (or greenlets, when gevent has patched threading).
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from .memcache import Client
+
+
+class MemcachePoolExhausted(Exception):
+    pass
+
+
+class ClientPool(object):
+    """
+    Pool of `Client` objects, each owning a single driver connection.
+
+    Clients are created lazily, up to `max_size`, and handed out one caller
+    at a time. A client must not be used after it has been put back.
+
+        >>> pool = ClientPool(max_size=4, host='127.0.0.1', port=11211)
+        >>> with pool.reserve() as client:
+        ...     client.get('foo')
+    """
+    def __init__(self, max_size=10, idle_timeout=None, max_lifetime=None,
+                 client_class=Client, **client_args):
+        """
+        Create a new, empty, ClientPool.
+
+        Keyword arguments:
+          max_size     -- max number of clients (connections) to create
+                          default: 10
+          idle_timeout -- seconds a client may sit unused in the pool before
+                          it is closed and discarded. None means forever.
+                          default: None
+          max_lifetime -- seconds after creation that a client is closed and
+                          replaced, regardless of use. None means forever.
+                          default: None
+          client_class -- class used to create clients
+                          default: pyermc.Client
+          client_args  -- any remaining keyword arguments are passed to
+                          `client_class` when creating a client.
+        """
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.client_class = client_class
+        self.client_args = client_args
+
+        self._cond = threading.Condition()
+        # idle clients as [client, released_at], most recently released last
+        self._idle = []
+        # creation time of every live client, checked out or not
+        self._created = {}
+        self._closed = False
+
+    def __len__(self):
+        """number of live clients, idle or checked out"""
+        return len(self._created)
+
+    @property
+    def idle(self):
+        """number of clients sitting idle in the pool"""
+        return len(self._idle)
+
+    def _expired(self, client, now):
+        if self.max_lifetime is None:
+            return False
+        return now - self._created[client] >= self.max_lifetime
+
+    def _discard(self, client):
+        # must hold self._cond
+        del self._created[client]
+        try:
+            client.close()
+        except:
+            pass
+        self._cond.notify()
+
+    def _prune(self, now):
+        # must hold self._cond
+        if self.idle_timeout is None:
+            return
+        while self._idle and now - self._idle[0][1] >= self.idle_timeout:
+            self._discard(self._idle.pop(0)[0])
+
+    def get(self, block=True, timeout=None):
+        """
+        Check a client out of the pool, creating one if none are idle and
+        the pool is not yet full.
+
+        Keyword arguments:
+          block   -- wait for a client to be put back if the pool is full.
+                     If False, raise MemcachePoolExhausted instead.
+                     default: True
+          timeout -- max seconds to block. None means forever.
+                     default: None
+
+        returns Client
+        raises MemcachePoolExhausted -- when no client became available
+        """
+        deadline = None
+        if block and timeout is not None:
+            deadline = time.time() + timeout
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise MemcachePoolExhausted("Pool is closed")
+                now = time.time()
+                self._prune(now)
+                while self._idle:
+                    client = self._idle.pop()[0]
+                    if self._expired(client, now):
+                        self._discard(client)
+                        continue
+                    return client
+                if len(self._created) < self.max_size:
+                    break
+                if not block:
+                    raise MemcachePoolExhausted("No clients available")
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise MemcachePoolExhausted(
+                            "Timed out waiting for a client")
+                    self._cond.wait(remaining)
+
+            # reserve the slot, then build the client outside the lock
+            placeholder = object()
+            self._created[placeholder] = now
+
+        try:
+            client = self.client_class(**self.client_args)
+        except:
+            with self._cond:
+                del self._created[placeholder]
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created[client] = self._created.pop(placeholder)
+        return client
+
+    def put(self, client):
+        """
+        Return a client, previously checked out with `get`, to the pool.
+        """
+        with self._cond:
+            if client not in self._created:
+                raise ValueError("Client does not belong to this pool")
+            now = time.time()
+            if self._closed or self._expired(client, now):
+                self._discard(client)
+                return
+            self._idle.append([client, now])
+            self._cond.notify()
+
+    @contextmanager
+    def reserve(self, block=True, timeout=None):
+        """
+        Context manager that checks out a client, and puts it back when
+        the block exits. Arguments are the same as `get`.
+        """
+        client = self.get(block=block, timeout=timeout)
+        try:
+            yield client
+        finally:
+            self.put(client)
+
+    def close(self):
+        """
+        Close all idle clients. Clients that are checked out are closed
+        when they are put back. The pool can not be used afterwards.
+        """
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._discard(self._idle.pop()[0])
+            self._cond.notify_all()
@@ -0,0 +1,97 @@
+# -*- coding: utf8 -*-
+
+# Copyright 2013 Medium Entertainment, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Serializers, turning values into the bytes and flags stored in memcached.
+"""
+
+import cPickle as pickle
+
+# flag bits of PickleSerializer, compatible with python-memcache
+FLAG_PICKLE = 1<<0
+FLAG_INTEGER = 1<<1
+FLAG_LONG = 1<<2
+# flag bits kept by Client: 3 to 5 for compression codecs, 6 for chunked
+# large values, and 7 for future use
+RESERVED_FLAGS = 0xf8
+
+
+class Serializer(object):
+    """
+    Interface of the `serializer` a `Client` uses to pack values before
+    storing them, and unpack them after fetching.
+
+    Flag bits are stored alongside each value. `Client` keeps the bits in
+    `RESERVED_FLAGS` for itself, so a serializer must not use them, and
+    never sees them set in `loads`.
+    """
+    def dumps(self, val):
+        """
+        pack `val` for storage.
+
+        returns tuple -- (flags, str)
+        """
+        raise NotImplementedError
+
+    def loads(self, buf, flags):
+        """
+        unpack a value packed by `dumps`.
+
+        returns object
+        """
+        raise NotImplementedError
+
+
+# flag logic from python-memcache
+class PickleSerializer(Serializer):
+    """
+    The default serializer. str values, and buffers (bytearray, memoryview)
+    are stored as is, int and long as decimal strings, and anything else
+    pickled. Buffers read back as str.
+    """
+    def __init__(self, pickle=True, pickle_proto=2):
+        """
+        Keyword arguments:
+          pickle       -- whether to pickle values that are not a str, int
+                          or long. If False, such values are passed to the
+                          driver as is.
+                          default: True
+          pickle_proto -- pickle protocol to use. default: 2 (highest)
+        """
+        self.pickle = pickle
+        self.pickle_proto = pickle_proto
+
+    def dumps(self, val):
+        if isinstance(val, (str, bytearray, memoryview)):
+            return 0, val
+        elif isinstance(val, int):
+            return FLAG_INTEGER, "%d" % val
+        elif isinstance(val, long):
+            return FLAG_LONG, "%d" % val
+        elif self.pickle:
+            return FLAG_PICKLE, pickle.dumps(val, self.pickle_proto)
+        return 0, val
+
+    def loads(self, buf, flags):
+        if flags == 0:
+            return buf
+        elif flags & FLAG_INTEGER:
+            return int(buf)
+        elif flags & FLAG_LONG:
+            return long(buf)
+        elif flags & FLAG_PICKLE:
+            return pickle.loads(buf)
+        raise ValueError("Unknown value flags: %d" % flags)
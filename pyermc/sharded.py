@@ -0,0 +1,424 @@
+# -*- coding: utf8 -*-
+
+# Copyright 2013 Medium Entertainment, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Client for a set of memcached servers, with keys distributed by a ketama
+consistent hash ring.
+"""
+
+from .driver.base import MULTI_WINDOW, merge_responses, split_command
+from .ketama import KetamaRing
+from .memcache import Client
+
+
+def _parse_server(server):
+    """
+    normalize a server spec to a (host, port, weight) tuple.
+
+    accepts "host:port", "host:port:weight", (host, port) and
+    (host, port, weight).
+    """
+    if isinstance(server, basestring):
+        parts = server.split(':')
+        if len(parts) not in (2, 3):
+            raise ValueError("Bad server spec: %r" % server)
+        server = parts
+    if len(server) == 2:
+        host, port = server
+        weight = 1
+    elif len(server) == 3:
+        host, port, weight = server
+    else:
+        raise ValueError("Bad server spec: %r" % (server,))
+    return (host, int(port), int(weight))
+
+
+class ShardedClient(object):
+    """
+    Object representing connections to several memcache servers. Every key
+    lives on exactly one server, chosen by a libketama compatible hash
+    ring, so adding or removing a server only moves about 1/N of the keys.
+
+    The command methods mirror those of `Client`.
+    """
+    def __init__(self, servers, client_class=Client, **client_args):
+        """
+        Create a new ShardedClient.
+
+        Arguments:
+          servers      -- list of servers as "host:port", "host:port:weight",
+                          (host, port) or (host, port, weight). Servers with
+                          a higher weight get proportionally more keys.
+
+        Keyword arguments:
+          client_class -- class used to create the per server clients
+                          default: pyermc.Client
+          client_args  -- any remaining keyword arguments (timeouts,
+                          client_driver, etc) are passed to `client_class`
+                          for every server.
+        """
+        if not servers:
+            raise ValueError("At least one server is required")
+        self.servers = [_parse_server(s) for s in servers]
+        self.clients = []
+        nodes = []
+        for host, port, weight in self.servers:
+            client = client_class(host=host, port=port, **client_args)
+            self.clients.append(client)
+            nodes.append(("%s:%d" % (host, port), weight, client))
+        self._ring = KetamaRing(nodes)
+
+    def __del__(self):
+        ## try to close/cleanup on GC/delete
+        try:
+            self.close()
+        except:
+            pass
+
+    def get_client(self, key):
+        """
+        Get the client of the server that `key` maps to.
+
+        Arguments:
+          key -- string key
+
+        returns Client
+        """
+        return self._ring.get_node(self.clients[0].check_key(key))
+
+    def _group_keys(self, keys):
+        """
+        split `keys` per server, keeping the order of `keys`.
+
+        returns list of (Client, [key, ...])
+        """
+        check_key = self.clients[0].check_key
+        groups = {}
+        order = []
+        for key in keys:
+            key = check_key(key)
+            client = self._ring.get_node(key)
+            if client not in groups:
+                groups[client] = []
+                order.append(client)
+            groups[client].append(key)
+        return [(client, groups[client]) for client in order]
+
+    ##
+    ## connection handling
+    ##
+    def connect(self, reconnect=False):
+        """
+        Connects all backends to their servers
+
+        Keyword arguments:
+          reconnect -- Reconnect to the server if connected.
+                       (defaut: False)
+        """
+        for client in self.clients:
+            client.connect(reconnect=reconnect)
+
+    def is_connected(self):
+        """
+        Checks to see if all backends are connected
+
+        returns bool
+        """
+        return all(client.is_connected() for client in self.clients)
+
+    def close(self):
+        """
+        Closes all connections to the backends
+        """
+        for client in self.clients:
+            client.close()
+
+    # alias close to disconnect
+    disconnect = close
+
+    def reset_client(self):
+        """
+        Reset internal client state
+        """
+        for client in self.clients:
+            client.reset_client()
+
+    def reset_cas(self):
+        """
+        Reset internal CAS associations
+        """
+        for client in self.clients:
+            client.reset_cas()
+
+    ##
+    ## misc operations
+    ##
+    def stats(self):
+        """
+        Get stats from every backend server
+
+        returns dict -- "host:port" mapped to that server's stats dict
+        """
+        return dict(("%s:%d" % (client.host, client.port), client.stats())
+                    for client in self.clients)
+
+    def version(self):
+        """
+        Get version from every backend server
+
+        returns dict -- "host:port" mapped to that server's version string
+        """
+        return dict(("%s:%d" % (client.host, client.port), client.version())
+                    for client in self.clients)
+
+    def flush_all(self):
+        """
+        Flushes all stored values in every backend server
+
+        returns bool -- True if all servers were flushed
+        """
+        results = [client.flush_all() for client in self.clients]
+        return all(results)
+
+    def sync(self):
+        """
+        see Client.sync. waits on every backend server.
+
+        returns list -- keys of noreply commands that failed since the last
+                        sync, on any server
+        """
+        failed = []
+        for client in self.clients:
+            failed.extend(client.sync())
+        return failed
+
+    def incr(self, key, delta=1, noreply=False):
+        """see Client.incr"""
+        return self.get_client(key).incr(key, delta, noreply)
+
+    def decr(self, key, delta=1, noreply=False):
+        """see Client.decr"""
+        return self.get_client(key).decr(key, delta, noreply)
+
+    def delete(self, key, noreply=False):
+        """see Client.delete"""
+        return self.get_client(key).delete(key, noreply)
+
+    def delete_multi(self, keys, noreply=False):
+        """
+        see Client.delete_multi. keys are grouped per server, and the
+        requests to every server are sent before any response is read.
+        """
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.get_client(key), []).append(key)
+        if not groups:
+            return []
+        if len(groups) == 1:
+            client, client_keys = groups.popitem()
+            return client.delete_multi(client_keys, noreply)
+
+        calls = []
+        keymaps = []
+        for client, client_keys in groups.iteritems():
+            keymap = dict((client.check_key(k), k) for k in client_keys)
+            calls.append((client, 'delete_multi', (list(keymap), noreply)))
+            keymaps.append(keymap)
+        return self._fan_out_writes(calls, keymaps)
+
+    ##
+    ## set operations
+    ##
+    def add(self, key, val, time=0, min_compress_len=None,
+            noreply=False):
+        """see Client.add"""
+        return self.get_client(key).add(
+            key, val, time, min_compress_len, noreply)
+
+    def append(self, key, val, time=0, min_compress_len=None,
+               noreply=False):
+        """see Client.append"""
+        return self.get_client(key).append(
+            key, val, time, min_compress_len, noreply)
+
+    def prepend(self, key, val, time=0, min_compress_len=None,
+                noreply=False):
+        """see Client.prepend"""
+        return self.get_client(key).prepend(
+            key, val, time, min_compress_len, noreply)
+
+    def replace(self, key, val, time=0, min_compress_len=None,
+                noreply=False):
+        """see Client.replace"""
+        return self.get_client(key).replace(
+            key, val, time, min_compress_len, noreply)
+
+    def set(self, key, val, time=0, min_compress_len=None,
+            noreply=False):
+        """see Client.set"""
+        return self.get_client(key).set(
+            key, val, time, min_compress_len, noreply)
+
+    def set_multi(self, mapping, time=0, min_compress_len=None, noreply=False):
+        """
+        see Client.set_multi. keys are grouped per server, and the requests
+        to every server are sent before any response is read.
+        """
+        groups = {}
+        for key, val in mapping.iteritems():
+            groups.setdefault(self.get_client(key), {})[key] = val
+        if not groups:
+            return []
+        if len(groups) == 1:
+            client, client_mapping = groups.popitem()
+            return client.set_multi(
+                client_mapping, time, min_compress_len, noreply)
+
+        calls = []
+        keymaps = []
+        for client, client_mapping in groups.iteritems():
+            keymap, items = client._store_items(
+                client_mapping, min_compress_len)
+            calls.append((client, 'set_multi', (items, time, noreply)))
+            keymaps.append(keymap)
+        return self._fan_out_writes(calls, keymaps)
+
+    def cas(self, key, val, time=0, min_compress_len=None):
+        """see Client.cas"""
+        return self.get_client(key).cas(key, val, time, min_compress_len)
+
+    ##
+    ## get operations
+    ##
+    def get(self, key):
+        """see Client.get"""
+        return self.get_client(key).get(key)
+
+    def gets(self, key):
+        """see Client.gets"""
+        return self.get_client(key).gets(key)
+
+    def iter_multi(self, keys):
+        """
+        see Client.iter_multi. servers are read one after the other.
+        """
+        for client, client_keys in self._group_keys(keys):
+            for item in client.iter_multi(client_keys):
+                yield item
+
+    def get_into(self, key, writable):
+        """see Client.get_into"""
+        return self.get_client(key).get_into(key, writable)
+
+    def get_multi(self, keys):
+        """
+        see Client.get_multi. keys are grouped per server, and the request
+        to every server is sent before any response is read, so servers
+        work in parallel.
+        """
+        return self._get_multi('get_multi', keys)
+
+    def gets_multi(self, keys):
+        """
+        see Client.gets_multi. keys are grouped per server, and the request
+        to every server is sent before any response is read, so servers
+        work in parallel.
+        """
+        return self._get_multi('gets_multi', keys)
+
+    def _get_multi(self, cmd, keys):
+        groups = self._group_keys(keys)
+        if len(groups) == 1:
+            client, client_keys = groups[0]
+            return getattr(client, cmd)(client_keys)
+
+        retvals = {}
+        calls = []
+        for client, client_keys in groups:
+            if cmd == 'get_multi':
+                found, client_keys = client._local_get_multi(client_keys)
+                retvals.update(found)
+                if not client_keys:
+                    continue
+            calls.append((client, cmd, (client_keys,)))
+        for (client, cmd, args), response in zip(
+                calls, self._fan_out(calls)):
+            retvals.update(client._unpack_multi(cmd, response, args[0]))
+        return retvals
+
+    def _fan_out_writes(self, calls, keymaps):
+        """
+        fan out set_multi/delete_multi calls, returning the failed keys
+        """
+        try:
+            responses = self._fan_out(calls)
+        finally:
+            for (client, cmd, args), keymap in zip(calls, keymaps):
+                client._forget(keymap)
+        failed = []
+        for (client, cmd, args), keymap, response in zip(
+                calls, keymaps, responses):
+            failed.extend(client._unpack_failed(keymap, response))
+        return failed
+
+    def _fan_out(self, calls):
+        """
+        run one driver command on each of several clients, sending every
+        request first and only then collecting the responses. total latency
+        is then roughly that of the slowest server, rather than the sum over
+        all of them.
+
+        multi commands go out in rounds of one window per server, and each
+        round is read before the next is sent, so no server ever has more
+        than a window of requests in flight.
+
+        Arguments:
+          calls -- list of (client, driver method name, args)
+
+        returns list -- driver response for each call, or None where an
+                        error was masked by error_as_miss
+        """
+        windows = [
+            split_command((cmd, args), getattr(
+                client._driver, 'multi_window', MULTI_WINDOW))
+            for client, cmd, args in calls]
+        responses = [[] for call in calls]
+        masked = set()
+        for n in xrange(max([len(w) for w in windows] or [0])):
+            pending = []
+            try:
+                for i, (client, cmd, args) in enumerate(calls):
+                    if i in masked or n >= len(windows[i]):
+                        continue
+                    if client._call_driver('pipeline_send', [windows[i][n]]):
+                        pending.append(i)
+                    else:
+                        masked.add(i)
+                while pending:
+                    client = calls[pending[0]][0]
+                    response = client._call_driver('pipeline_recv')
+                    i = pending.pop(0)
+                    if response:
+                        responses[i].append(response[0])
+                    else:
+                        masked.add(i)
+            finally:
+                # anything still pending has unread responses on the wire,
+                # and can't be reused.
+                for i in pending:
+                    calls[i][0].close()
+        return [None if i in masked else merge_responses(responses[i])
+                for i in xrange(len(calls))]
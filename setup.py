@@ -15,10 +15,10 @@ protocol driver, and a wrapped ultramemcached driver.
 While pyermc is somewhat compatible with python-memcached, full
 compatibility is not a design goal.
 
-pyermc supports connecting to a single memcached instance (or server
-that speaks the memcached protocol). If you require multiple servers,
-consistent hashing, etc, then it is recommended to use twemproxy or
-similar.
+pyermc's Client connects to a single memcached instance (or server
+that speaks the memcached protocol). For multiple servers, ShardedClient
+distributes keys with a ketama (libketama compatible) consistent hash
+ring. Proxies such as twemproxy also work.
 
 pyermc exposes connectivity faults, via exceptions, to the calling
 code. This is in contrast to python-memcached, which simply enters an
@@ -44,7 +44,6 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 2.6',
         'Topic :: Internet',
         'Topic :: Software Development :: Libraries :: Python Modules',
         'License :: OSI Approved :: Apache Software License',
@@ -55,7 +54,8 @@ setup(
     ],
     extras_require={
         'umemcache_driver': ['umemcache'],
-        'tests': ['mock==1.0.1', 'nose', 'unittest2'],
+        'zstd': ['zstandard'],
+        'tests': ['mock==1.0.1', 'nose'],
     },
     zip_safe=False,
 )
@@ -0,0 +1,27 @@
+# -*- coding: utf8 -*-
+
+"""
+Client fixtures shared by the unit tests. Clients run on the NoopDriver,
+and `make_client` swaps the driver for a mock, so tests can set driver
+responses and check the calls made.
+"""
+
+import mock
+from pyermc import memcache, pool, sharded
+from pyermc.driver.noop import NoopDriver
+
+
+def make_client(**kwargs):
+    client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver,
+                             **kwargs)
+    client._client = mock.Mock()
+    return client
+
+
+def make_sharded_client(servers, **kwargs):
+    return sharded.ShardedClient(servers, client_driver=NoopDriver, **kwargs)
+
+
+def make_pool(**kwargs):
+    return pool.ClientPool(host='1.2.3.4', port=5678,
+                           client_driver=NoopDriver, **kwargs)
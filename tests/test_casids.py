@@ -0,0 +1,85 @@
+# -*- coding: utf8 -*-
+
+import sys
+import mock
+from pyermc import memcache
+from pyermc.casids import CasIds, CAS_MAX_ENTRIES
+from pyermc.driver.noop import NoopDriver
+## we use some test harness stuff from python2.7.
+## if not on 2.7, try importing unittest2 for compat
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class TestCasIds(unittest.TestCase):
+    def test_mapping(self):
+        cas_ids = CasIds()
+        self.assertEqual(cas_ids.max_entries, CAS_MAX_ENTRIES)
+        self.assertEqual(cas_ids, {})
+        cas_ids['a'] = 1
+        cas_ids['b'] = 2
+        self.assertEqual(cas_ids, {'a': 1, 'b': 2})
+        self.assertNotEqual(cas_ids, {'a': 1})
+        self.assertEqual(cas_ids['a'], 1)
+        self.assertEqual(cas_ids.get('c'), None)
+        self.assertIn('b', cas_ids)
+        self.assertEqual(len(cas_ids), 2)
+        self.assertEqual(sorted(cas_ids), ['a', 'b'])
+        del cas_ids['a']
+        with self.assertRaises(KeyError):
+            cas_ids['a']
+        cas_ids.clear()
+        self.assertEqual(len(cas_ids), 0)
+
+    def test_max_entries(self):
+        """least recently used keys should be evicted first.
+        """
+        cas_ids = CasIds(max_entries=2)
+        cas_ids['a'] = 1
+        cas_ids['b'] = 2
+        cas_ids.get('a')
+        cas_ids['c'] = 3
+        self.assertEqual(cas_ids, {'a': 1, 'c': 3})
+        self.assertEqual(cas_ids.stats(),
+                         {'entries': 2, 'evictions': 1, 'expirations': 0})
+
+    def test_max_age(self):
+        cas_ids = CasIds(max_age=10)
+        with mock.patch('time.time', return_value=100):
+            cas_ids['a'] = 1
+        with mock.patch('time.time', return_value=109):
+            self.assertEqual(cas_ids.get('a'), 1)
+        with mock.patch('time.time', return_value=110):
+            self.assertNotIn('a', cas_ids)
+        self.assertEqual(len(cas_ids), 0)
+        self.assertEqual(cas_ids.expirations, 1)
+
+
+class TestClientCasIds(unittest.TestCase):
+    def test_client(self):
+        """dropped CAS_IDs should make cas fall back to set.
+        """
+        client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver,
+                                 cache_cas=True, cas_max_entries=1,
+                                 cas_max_age=30)
+        self.assertIsInstance(client.cas_ids, CasIds)
+        self.assertEqual(client.cas_ids.max_entries, 1)
+        self.assertEqual(client.cas_ids.max_age, 30)
+        client._client = mock.Mock()
+        client._client.gets_multi.return_value = {
+            'a': ['x', 0, 7], 'b': ['y', 0, 8]}
+        client.gets_multi(['a', 'b'])
+        self.assertEqual(len(client.cas_ids), 1)
+        self.assertEqual(client.cas_ids.evictions, 1)
+        key = list(client.cas_ids)[0]
+        other = 'b' if key == 'a' else 'a'
+        client.cas(key, 'z')
+        self.assertTrue(client._client.cas.called)
+        client.cas(other, 'z')
+        self.assertTrue(client._client.set.called)
+
+        client.reset_cas()
+        self.assertEqual(client.cas_ids, {})
+        self.assertEqual(client.cas_ids.max_entries, 1)
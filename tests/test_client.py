@@ -6,10 +6,13 @@ import pickle
 import mock
 import errno
 import socket
+import StringIO
+import threading
 from mock import sentinel
 from pyermc import memcache
 from pyermc.driver import Driver
 from pyermc.driver.noop import NoopDriver
+from tests.helpers import make_client
 ## we use some test harness stuff from python2.7.
 ## if not on 2.7, try importing unittest2 for compat
 if sys.version_info < (2, 7):
@@ -23,7 +26,8 @@ class TestClient(unittest.TestCase):
         client = memcache.Client('1.2.3.4', 5678, connect_timeout=11,
                                  timeout=22, max_key_length=33,
                                  max_value_length=44, pickle=False,
-                                 cache_cas=True, client_driver=NoopDriver)
+                                 cache_cas=True, recv_size=55,
+                                 adaptive_recv=True, client_driver=NoopDriver)
         self.assertEqual(client.host, '1.2.3.4')
         self.assertEqual(client.port, 5678)
         self.assertEqual(client.connect_timeout, 11)
@@ -32,10 +36,29 @@ class TestClient(unittest.TestCase):
         self.assertEqual(client.max_value_length, 44)
         self.assertFalse(client.pickle)
         self.assertTrue(client.cache_cas)
+        self.assertEqual(client.recv_size, 55)
+        self.assertTrue(client.adaptive_recv)
         self.assertIsNotNone(client._client)
         self.assertIsInstance(client._client, Driver)
+        self.assertEqual(client._client.recv_size, 55)
+        self.assertTrue(client._client.adaptive_recv)
         self.assertEqual({}, client.cas_ids)
 
+    def test_init_custom_driver(self):
+        """drivers without the read tuning arguments should still work,
+        as long as the client leaves them at their defaults.
+        """
+        class CustomDriver(Driver):
+            def __init__(self, host, port, timeout, connect_timeout,
+                         disable_nagle=True):
+                self.host = host
+
+        client = memcache.Client('1.2.3.4', 5678, client_driver=CustomDriver)
+        self.assertIsInstance(client._client, CustomDriver)
+        with self.assertRaises(TypeError):
+            memcache.Client('1.2.3.4', 5678, recv_size=55,
+                            client_driver=CustomDriver)
+
     def test_init_defaults(self):
         client = memcache.Client('1.2.3.4', 5678, client_driver=NoopDriver)
         self.assertEqual(client.host, '1.2.3.4')
@@ -48,6 +71,10 @@ class TestClient(unittest.TestCase):
                          memcache.MAX_VALUE_LENGTH)
         self.assertTrue(client.pickle)
         self.assertFalse(client.cache_cas)
+        self.assertEqual(client.recv_size, memcache.RECV_SIZE)
+        self.assertFalse(client.adaptive_recv)
+        self.assertFalse(client.thread_local)
+        self.assertIsNone(client.local_cache)
         self.assertIsNotNone(client._client)
         self.assertIsInstance(client._client, Driver)
         self.assertEqual({}, client.cas_ids)
@@ -58,6 +85,45 @@ class TestClient(unittest.TestCase):
         self.assertEqual(memcache.Client._FLAG_LONG, 1<<2)
         self.assertEqual(memcache.Client._FLAG_COMPRESSED, 1<<3)
 
+    def test_thread_local(self):
+        """thread_local clients should use a separate driver per thread.
+        """
+        client = memcache.Client('127.0.0.1', 11211, thread_local=True,
+                                 client_driver=NoopDriver)
+        self.assertTrue(client.thread_local)
+        main_driver = client._client
+        self.assertIsInstance(main_driver, NoopDriver)
+        drivers = []
+        def run():
+            client.version()
+            drivers.append(client._client)
+            client.version()
+            drivers.append(client._client)
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertIsInstance(drivers[0], NoopDriver)
+        self.assertIs(drivers[0], drivers[1])
+        self.assertIsNot(drivers[0], main_driver)
+        self.assertIs(client._client, main_driver)
+
+    def test_thread_local_close(self):
+        """close() should only close the calling thread's driver when
+        thread_local is set.
+        """
+        client = memcache.Client('127.0.0.1', 11211, thread_local=True,
+                                 client_driver=NoopDriver)
+        main_driver = client._client
+        def run():
+            client.version()
+            client.close()
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertIs(client._client, main_driver)
+        client.close()
+        self.assertIsNone(client._client)
+
     def test_get_socket(self):
         client = memcache.Client('127.0.0.1', 11211,
                                  connect_timeout=sentinel.connect_timeout,
@@ -244,6 +310,66 @@ class TestClient(unittest.TestCase):
         self.assertIs(client.delete('foo'), sentinel.delete_result)
         client._client.delete.assert_called_with('foo')
 
+    def test_delete_noreply(self):
+        """delete() should pass noreply to the driver only when set.
+        """
+        client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
+        client._client = mock.Mock()
+        client._client.delete.return_value = None
+        self.assertIsNone(client.delete('foo', noreply=True))
+        client._client.delete.assert_called_with('foo', noreply=True)
+        client.incr('foo', -2, noreply=True)
+        client._client.decr.assert_called_with('foo', 2, noreply=True)
+
+    def test_sync(self):
+        """sync() should return the failed keys from _client.sync()
+        """
+        client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
+        self.assertEqual(client.sync(), [])
+        client._client = mock.Mock()
+        client._client.sync.return_value = ['foo']
+        self.assertEqual(client.sync(), ['foo'])
+
+    def test_delete_multi(self):
+        """delete_multi() should pass checked keys to _client.delete_multi()
+        and map failed keys back to the keys given.
+        """
+        client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
+        client._client = mock.Mock()
+        client._client.delete_multi.return_value = ['bar']
+        self.assertEqual(client.delete_multi([u'foo', u'bar']), [u'bar'])
+        keys, noreply = client._client.delete_multi.call_args[0]
+        self.assertEqual(sorted(keys), ['bar', 'foo'])
+        self.assertFalse(noreply)
+        self.assertEqual(client.delete_multi([]), [])
+
+    def test_set_multi(self):
+        """set_multi() should pack every value, pass them to
+        _client.set_multi(), and return the failed keys.
+        """
+        client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
+        client._client = mock.Mock()
+        client._client.set_multi.return_value = ['bar']
+        result = client.set_multi({'foo': 'x', 'bar': 1}, 10, noreply=True)
+        self.assertEqual(result, ['bar'])
+        items, time, noreply = client._client.set_multi.call_args[0]
+        self.assertEqual(sorted(items), [
+            ('bar', '1', memcache.Client._FLAG_INTEGER),
+            ('foo', 'x', 0)])
+        self.assertEqual(time, 10)
+        self.assertTrue(noreply)
+
+    def test_set_multi_error_as_miss(self):
+        """set_multi() should report every key as failed when an error
+        is masked.
+        """
+        client = memcache.Client('127.0.0.1', 11211, error_as_miss=True,
+                                 client_driver=NoopDriver)
+        client._client = mock.Mock()
+        client._client.set_multi.side_effect = IOError('boom')
+        self.assertEqual(sorted(client.set_multi({'foo': 1, 'bar': 2})),
+                         ['bar', 'foo'])
+
     def test_flush_all(self):
         """flush_all() should pass through to _client.flush_all()
         """
@@ -260,47 +386,62 @@ class TestClient(unittest.TestCase):
         with mock.patch.object(client, '_set') as mock_set:
             client.add('foo', 1)
             client.add('foo', 1, time=2, min_compress_len=3)
-            mock_set.assert_has_calls([mock.call('add', 'foo', 1, 0, 0),
-                                       mock.call('add', 'foo', 1, 2, 3)])
+            client.add('foo', 1, noreply=True)
+            mock_set.assert_has_calls([
+                mock.call('add', 'foo', 1, 0, None, False),
+                mock.call('add', 'foo', 1, 2, 3, False),
+                mock.call('add', 'foo', 1, 0, None, True)])
 
     def test_append(self):
         client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
         with mock.patch.object(client, '_set') as mock_set:
             client.append('foo', 1)
             client.append('foo', 1, time=2, min_compress_len=3)
-            mock_set.assert_has_calls([mock.call('append', 'foo', 1, 0, 0),
-                                       mock.call('append', 'foo', 1, 2, 3)])
+            client.append('foo', 1, noreply=True)
+            mock_set.assert_has_calls([
+                mock.call('append', 'foo', 1, 0, None, False),
+                mock.call('append', 'foo', 1, 2, 3, False),
+                mock.call('append', 'foo', 1, 0, None, True)])
 
     def test_prepend(self):
         client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
         with mock.patch.object(client, '_set') as mock_set:
             client.prepend('foo', 1)
             client.prepend('foo', 1, time=2, min_compress_len=3)
-            mock_set.assert_has_calls([mock.call('prepend', 'foo', 1, 0, 0),
-                                       mock.call('prepend', 'foo', 1, 2, 3)])
+            client.prepend('foo', 1, noreply=True)
+            mock_set.assert_has_calls([
+                mock.call('prepend', 'foo', 1, 0, None, False),
+                mock.call('prepend', 'foo', 1, 2, 3, False),
+                mock.call('prepend', 'foo', 1, 0, None, True)])
 
     def test_replace(self):
         client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
         with mock.patch.object(client, '_set') as mock_set:
             client.replace('foo', 1)
             client.replace('foo', 1, time=2, min_compress_len=3)
-            mock_set.assert_has_calls([mock.call('replace', 'foo', 1, 0, 0),
-                                       mock.call('replace', 'foo', 1, 2, 3)])
+            client.replace('foo', 1, noreply=True)
+            mock_set.assert_has_calls([
+                mock.call('replace', 'foo', 1, 0, None, False),
+                mock.call('replace', 'foo', 1, 2, 3, False),
+                mock.call('replace', 'foo', 1, 0, None, True)])
 
     def test_set(self):
         client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
         with mock.patch.object(client, '_set') as mock_set:
             client.set('foo', 1)
             client.set('foo', 1, time=2, min_compress_len=3)
-            mock_set.assert_has_calls([mock.call('set', 'foo', 1, 0, 0),
-                                       mock.call('set', 'foo', 1, 2, 3)])
+            client.set('foo', 1, noreply=True)
+            mock_set.assert_has_calls([
+                mock.call('set', 'foo', 1, 0, None, False),
+                mock.call('set', 'foo', 1, 2, 3, False),
+                mock.call('set', 'foo', 1, 0, None, True)])
 
     def test_cas(self):
         client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
         with mock.patch.object(client, '_set') as mock_set:
             client.cas('foo', 1)
             client.cas('foo', 1, time=2, min_compress_len=3)
-            mock_set.assert_has_calls([mock.call('cas', 'foo', 1, 0, 0),
+            mock_set.assert_has_calls([mock.call('cas', 'foo', 1, 0, None),
                                        mock.call('cas', 'foo', 1, 2, 3)])
 
     def test_val_to_store_info(self):
@@ -390,7 +531,8 @@ class TestClient(unittest.TestCase):
                                  check_key=mock_check_key):
             result = client._set('some_cmd', 'some_key', 'some_value', 1, 2)
             mock_check_key.assert_called_with('some_key')
-            mock_val_to_store_info.assert_called_with('some_value', 2)
+            mock_val_to_store_info.assert_called_with('some_value', 2,
+                                                    'some_key')
             mock_client.some_cmd.assert_called_with('some_key', sentinel.sval,
                                                     1, sentinel.flags)
             self.assertIs(result, sentinel.some_cmd_return_value)
@@ -434,6 +576,84 @@ class TestClient(unittest.TestCase):
             client.get_multi(['foo', 'bar'])
             mock_get_multi.assert_called_with('get_multi', ['foo', 'bar'])
 
+    def test_iter_multi(self):
+        """iter_multi() should unpack each value as soon as the driver
+        yields it, and close the driver iterator when done.
+        """
+        client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
+        client._client = mock.Mock()
+        read = []
+        closed = []
+        def iter_multi(keys):
+            try:
+                for key in keys[:2]:
+                    read.append(key)
+                    yield key, [key * 2, 0]
+            finally:
+                closed.append(True)
+        client._client.iter_multi.side_effect = iter_multi
+        it = client.iter_multi(['a', 'b', 'c'])
+        self.assertEqual(next(it), ('a', 'aa'))
+        self.assertEqual(read, ['a'])
+        self.assertEqual(list(it), [('b', 'bb')])
+        client._client.iter_multi.assert_called_with(['a', 'b', 'c'])
+        self.assertEqual(closed, [True])
+        # closing early closes the driver iterator too
+        it = client.iter_multi(['a', 'b'])
+        next(it)
+        it.close()
+        self.assertEqual(closed, [True, True])
+
+    def test_iter_multi_error(self):
+        """iter_multi() should wrap driver errors, or stop on them with
+        error_as_miss.
+        """
+        def iter_multi(keys):
+            yield 'a', ['x', 0]
+            raise IOError('boom')
+        client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
+        client._client = mock.Mock()
+        client._client.iter_multi.side_effect = iter_multi
+        it = client.iter_multi(['a', 'b'])
+        self.assertEqual(next(it), ('a', 'x'))
+        with self.assertRaisesRegexp(memcache.MemcacheDriverException, 'boom'):
+            next(it)
+        self.assertIsNone(client._client)
+
+        client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver,
+                                 error_as_miss=True)
+        client._client = mock.Mock()
+        client._client.iter_multi.side_effect = iter_multi
+        self.assertEqual(list(client.iter_multi(['a', 'b'])), [('a', 'x')])
+
+    def test_get_into(self):
+        """streamed values should be left alone, others unpacked and
+        written.
+        """
+        client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
+        client._client = mock.Mock()
+        buf = bytearray()
+        client._client.get_into.return_value = [5, 0, None]
+        self.assertEqual(client.get_into('a', buf), 5)
+        client._client.get_into.assert_called_with('a', buf)
+        self.assertEqual(buf, bytearray())
+
+        client._client.get_into.return_value = [
+            4, memcache.Client._FLAG_COMPRESSED, lz4.compress('data')]
+        self.assertEqual(client.get_into('a', buf), 4)
+        self.assertEqual(buf, bytearray('data'))
+        out = StringIO.StringIO()
+        self.assertEqual(client.get_into('a', out), 4)
+        self.assertEqual(out.getvalue(), 'data')
+
+        client._client.get_into.return_value = None
+        self.assertIsNone(client.get_into('a', buf))
+        # only str values can be written
+        client._client.get_into.return_value = [
+            1, memcache.Client._FLAG_INTEGER, '1']
+        with self.assertRaises(memcache.MemcacheValueError):
+            client.get_into('a', buf)
+
     def test_gets_multi(self):
         client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
         with mock.patch.object(client, '_get_multi') as mock_get_multi:
@@ -697,3 +917,124 @@ class TestClient(unittest.TestCase):
         client.close = mock.Mock()
         self.assertIsNone(client._call_driver('version'))
         client.close.assert_called()
+
+
+class TestLargeValues(unittest.TestCase):
+    def test_split_value(self):
+        client = make_client(max_value_length=10, large_values=True)
+        self.assertEqual(client._split_value(2, 'x' * 10), (2, 'x' * 10, None))
+        flags, manifest, chunks = client._split_value(2, 'abcdefghijklmnopqrstu')
+        self.assertEqual(flags, memcache.Client._FLAG_CHUNKED)
+        generation = manifest.split()[0]
+        self.assertEqual(manifest, '%s 3 21 2' % generation)
+        self.assertEqual(chunks, [
+            ('pyermc:chunk:%s:0' % generation, 'abcdefghij', 0),
+            ('pyermc:chunk:%s:1' % generation, 'klmnopqrst', 0),
+            ('pyermc:chunk:%s:2' % generation, 'u', 0)])
+        # every write gets a new generation
+        self.assertNotEqual(client._split_value(0, 'x' * 11)[1].split()[0],
+                            client._split_value(0, 'x' * 11)[1].split()[0])
+
+    def test_set(self):
+        """chunks and manifest should be sent in one batch, chunks first.
+        """
+        client = make_client(max_value_length=10, large_values=True)
+        client._client.pipeline_send.return_value = True
+        client._client.pipeline_recv.return_value = [[], True]
+        self.assertTrue(client.set('a', 'x' * 15, 5))
+        commands = client._client.pipeline_send.call_args[0][0]
+        self.assertEqual(len(commands), 2)
+        self.assertEqual(commands[0][0], 'set_multi')
+        self.assertEqual(len(commands[0][1][0]), 2)
+        self.assertEqual(commands[0][1][1], 5)
+        self.assertEqual(commands[1][0], 'set')
+        self.assertEqual(commands[1][1][0], 'a')
+        self.assertEqual(commands[1][1][2:],
+                         (5, memcache.Client._FLAG_CHUNKED))
+        # a failed chunk fails the set
+        client._client.pipeline_recv.return_value = [['x'], True]
+        self.assertFalse(client.set('a', 'x' * 15))
+        # short values are set as usual
+        client._client.set.return_value = True
+        self.assertTrue(client.set('a', 'x'))
+        client._client.set.assert_called_with('a', 'x', 0, 0)
+
+    def test_append(self):
+        client = make_client(max_value_length=10, large_values=True)
+        with self.assertRaises(memcache.MemcacheValueError):
+            client.append('a', 'x' * 11)
+
+    def test_get(self):
+        client = make_client(max_value_length=10, large_values=True)
+        manifest = 'abc 2 15 %d' % memcache.Client._FLAG_INTEGER
+        client._client.get.return_value = [
+            manifest, memcache.Client._FLAG_CHUNKED]
+        client._client.get_multi.return_value = {
+            'pyermc:chunk:abc:0': ['1' * 10, 0],
+            'pyermc:chunk:abc:1': ['2' * 5, 0]}
+        self.assertEqual(client.get('a'), int('1' * 10 + '2' * 5))
+        client._client.get_multi.assert_called_with(
+            ['pyermc:chunk:abc:0', 'pyermc:chunk:abc:1'])
+        del client._client.get_multi.return_value['pyermc:chunk:abc:1']
+        self.assertIsNone(client.get('a'))
+
+    def test_get_into(self):
+        """chunks of plain str values should be streamed one by one.
+        """
+        client = make_client(max_value_length=10, large_values=True)
+        chunks = {'pyermc:chunk:abc:0': '1' * 10,
+                  'pyermc:chunk:abc:1': '2' * 5}
+        def get_into(key, writable):
+            if key == 'a':
+                return [9, memcache.Client._FLAG_CHUNKED, 'abc 2 15 0']
+            if key not in chunks:
+                return None
+            writable[:len(chunks[key])] = chunks[key]
+            return [len(chunks[key]), 0, None]
+        client._client.get_into.side_effect = get_into
+        buf = bytearray()
+        self.assertEqual(client.get_into('a', buf), 15)
+        self.assertEqual(str(buf), '1' * 10 + '2' * 5)
+        del chunks['pyermc:chunk:abc:1']
+        self.assertIsNone(client.get_into('a', buf))
+
+    def test_iter_multi(self):
+        """large values should be joined, and yielded, after the others.
+        """
+        client = make_client(max_value_length=10, large_values=True)
+        chunked = memcache.Client._FLAG_CHUNKED
+        client._client.iter_multi.return_value = iter(
+            [('a', ['g1 1 3 0', chunked]), ('b', ['b', 0])])
+        client._client.get_multi.return_value = {
+            'pyermc:chunk:g1:0': ['aaa', 0]}
+        self.assertEqual(list(client.iter_multi(['a', 'b'])),
+                         [('b', 'b'), ('a', 'aaa')])
+
+    def test_get_multi(self):
+        """chunks of all large values should be fetched at once.
+        """
+        client = make_client(max_value_length=10, large_values=True)
+        chunked = memcache.Client._FLAG_CHUNKED
+        client._client.get_multi.side_effect = [
+            {'a': ['g1 1 3 0', chunked], 'b': ['g2 1 3 0', chunked],
+             'c': ['c', 0]},
+            {'pyermc:chunk:g1:0': ['aaa', 0]}]
+        self.assertEqual(client.get_multi(['a', 'b', 'c']),
+                         {'a': 'aaa', 'c': 'c'})
+        self.assertEqual(
+            sorted(client._client.get_multi.call_args[0][0]),
+            ['pyermc:chunk:g1:0', 'pyermc:chunk:g2:0'])
+
+    def test_set_multi(self):
+        """a failed chunk should report the key of its value, once.
+        """
+        client = make_client(max_value_length=10, large_values=True)
+        def set_multi(items, time, noreply):
+            return [k for k, v, f in items if k.startswith('pyermc:')]
+        client._client.set_multi.side_effect = set_multi
+        self.assertEqual(client.set_multi({'a': 'x' * 15, 'b': 'y'}), ['a'])
+
+    def test_not_enabled(self):
+        client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver)
+        with self.assertRaises(memcache.MemcacheValueError):
+            client._recv_value('abc 2 15 0', memcache.Client._FLAG_CHUNKED)
@@ -0,0 +1,154 @@
+# -*- coding: utf8 -*-
+
+import os
+import sys
+import lz4
+import zlib
+import mock
+from pyermc import memcache
+from pyermc import compressor
+from pyermc.compressor import (
+    LZ4Compressor, ZlibCompressor, ZstdCompressor, AdaptiveCompression,
+    FLAG_LZ4, FLAG_ZLIB, FLAG_ZSTD)
+from tests.helpers import make_client
+## we use some test harness stuff from python2.7.
+## if not on 2.7, try importing unittest2 for compat
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+VALUE = '{"user": 1234, "name": "someone", "tags": ["a", "b"]}' * 20
+
+
+class TestCompressors(unittest.TestCase):
+    def test_flags(self):
+        self.assertEqual(FLAG_LZ4, memcache.Client._FLAG_COMPRESSED)
+        self.assertEqual(LZ4Compressor.flag, FLAG_LZ4)
+        self.assertEqual(ZlibCompressor.flag, FLAG_ZLIB)
+        self.assertEqual(ZstdCompressor.flag, FLAG_ZSTD)
+
+    def test_lz4(self):
+        c = LZ4Compressor()
+        self.assertEqual(c.compress(VALUE), lz4.compress(VALUE))
+        self.assertEqual(c.decompress(c.compress(VALUE)), VALUE)
+
+    def test_zlib(self):
+        c = ZlibCompressor(level=9)
+        self.assertEqual(c.compress(VALUE), zlib.compress(VALUE, 9))
+        self.assertEqual(c.decompress(c.compress(VALUE)), VALUE)
+
+    @unittest.skipIf(compressor.zstandard is not None, 'zstandard installed')
+    def test_zstd_missing(self):
+        with self.assertRaises(ImportError):
+            ZstdCompressor()
+
+    @unittest.skipIf(compressor.zstandard is None, 'requires zstandard')
+    def test_zstd(self):
+        c = ZstdCompressor()
+        self.assertEqual(c.decompress(c.compress(VALUE)), VALUE)
+
+    @unittest.skipIf(compressor.zstandard is None, 'requires zstandard')
+    def test_zstd_dictionary(self):
+        samples = ['{"user": %d, "name": "user%d", "tags": ["t%d"]}' %
+                   (i, i, i % 7) for i in xrange(2000)]
+        dict_data = ZstdCompressor.train_dictionary(samples, 1024)
+        plain = ZstdCompressor()
+        c = ZstdCompressor(dict_data=dict_data)
+        self.assertLess(len(c.compress(samples[0])),
+                        len(plain.compress(samples[0])))
+        self.assertEqual(c.decompress(c.compress(samples[0])), samples[0])
+
+
+class TestAdaptiveCompression(unittest.TestCase):
+    def test_skip(self):
+        """prefixes that don't compress should be skipped, then retried
+        after retry_every values.
+        """
+        adaptive = AdaptiveCompression(samples=2, retry_every=3)
+        for i in xrange(2):
+            self.assertTrue(adaptive.should_compress('img:%d' % i))
+            adaptive.record('img:%d' % i, 100, 99)
+            self.assertTrue(adaptive.should_compress('doc:%d' % i))
+            adaptive.record('doc:%d' % i, 100, 30)
+        self.assertTrue(adaptive.should_compress('doc:3'))
+        self.assertFalse(adaptive.should_compress('img:3'))
+        self.assertFalse(adaptive.should_compress('img:4'))
+        self.assertTrue(adaptive.should_compress('img:5'))
+        self.assertEqual(adaptive.stats(), {
+            'img': {'samples': 0, 'ratio': 1.0, 'skipped': False},
+            'doc': {'samples': 2, 'ratio': 0.3, 'skipped': False}})
+
+    def test_prefix(self):
+        adaptive = AdaptiveCompression(
+            samples=1, prefix=lambda key: key[:2], max_prefixes=2)
+        adaptive.record('ab1', 10, 10)
+        self.assertFalse(adaptive.should_compress('ab2'))
+        self.assertTrue(adaptive.should_compress('cd1'))
+        # tracking restarts once there are too many prefixes
+        self.assertTrue(adaptive.should_compress('ef1'))
+        self.assertEqual(sorted(adaptive.stats()), ['ef'])
+
+
+class TestClientCompressor(unittest.TestCase):
+    def test_default(self):
+        client = make_client()
+        self.assertIsInstance(client.compressor, LZ4Compressor)
+
+    def test_codecs_coexist(self):
+        """values written with one codec should be readable by a client
+        writing with another.
+        """
+        lz4_client = make_client()
+        zlib_client = make_client(compressor=ZlibCompressor())
+        flags, val = zlib_client._val_to_store_info(VALUE, 1)
+        self.assertEqual(flags, FLAG_ZLIB)
+        self.assertEqual(zlib.decompress(val), VALUE)
+        self.assertEqual(lz4_client._recv_value(val, flags), VALUE)
+        flags, val = lz4_client._val_to_store_info({'a': VALUE}, 1)
+        self.assertEqual(flags, FLAG_LZ4 | memcache.Client._FLAG_PICKLE)
+        self.assertEqual(zlib_client._recv_value(val, flags), {'a': VALUE})
+
+    def test_decompressors(self):
+        """values compressed with an unknown codec can't be read, unless
+        its compressor is given.
+        """
+        class Reversed(ZlibCompressor):
+            flag = FLAG_ZSTD
+
+            def decompress(self, data):
+                return data[::-1]
+
+        with self.assertRaises(memcache.MemcacheValueError):
+            make_client()._recv_value('cba', FLAG_ZSTD)
+        client = make_client(decompressors=[Reversed()])
+        self.assertEqual(client._recv_value('cba', FLAG_ZSTD), 'abc')
+        self.assertIsInstance(client.compressor, LZ4Compressor)
+
+    def test_min_compress_len(self):
+        """the client's min_compress_len should apply unless overridden.
+        """
+        client = make_client(min_compress_len=10)
+        self.assertEqual(client._val_to_store_info(VALUE, None)[0], FLAG_LZ4)
+        self.assertEqual(client._val_to_store_info(VALUE, 0)[0], 0)
+        self.assertEqual(client._val_to_store_info('x' * 20, None)[0],
+                         FLAG_LZ4)
+        self.assertEqual(client._val_to_store_info('x' * 10, None)[0], 0)
+        self.assertEqual(make_client()._val_to_store_info(VALUE, None),
+                         (0, VALUE))
+
+    def test_adaptive(self):
+        """values of prefixes that don't compress should not be compressed.
+        """
+        adaptive = AdaptiveCompression(samples=1)
+        client = make_client(min_compress_len=10,
+                                  adaptive_compression=adaptive)
+        noise = os.urandom(100)
+        self.assertEqual(client._val_to_store_info(noise, None, 'a:1'),
+                         (0, noise))
+        with mock.patch('lz4.compress') as mock_compress:
+            self.assertEqual(client._val_to_store_info(VALUE, None, 'a:2'),
+                             (0, VALUE))
+            self.assertFalse(mock_compress.called)
+        self.assertEqual(client._val_to_store_info(VALUE, None, 'b:1')[0],
+                         FLAG_LZ4)
@@ -6,10 +6,11 @@ the integration tests.
 
 import sys
 import mock
+import StringIO
 import socket
 import struct
 from mock import sentinel
-from pyermc.driver import binaryproto, textproto
+from pyermc.driver import base, binaryproto, textproto
 from pyermc.driver.base import Driver, TCPDriver
 from pyermc.driver.binaryproto import BinaryProtoDriver
 from pyermc.driver.textproto import TextProtoDriver
@@ -21,6 +22,23 @@ else:
     import unittest
 
 
+class FakeSocket(object):
+    """
+    socket stand-in that hands out `data` at most `chunk` bytes per recv.
+    """
+    def __init__(self, data, chunk=1000):
+        self.data = data
+        self.chunk = chunk
+        self.requested = []
+
+    def recv_into(self, buf, nbytes=0):
+        self.requested.append(nbytes)
+        nbytes = min(nbytes or len(buf), len(buf), self.chunk)
+        count = min(nbytes, len(self.data))
+        buf[:count] = self.data[:count]
+        self.data = self.data[count:]
+        return count
+
 
 class TestDriver(unittest.TestCase):
     def test_not_implemented(self):
@@ -45,7 +63,9 @@ class TestDriver(unittest.TestCase):
                  'append': ['foo', 1, 2, 3],
                  'prepend': ['foo', 1, 2, 3],
                  'replace': ['foo', 1, 2, 3],
-                 'set': ['foo', 1, 2, 3]}
+                 'set': ['foo', 1, 2, 3],
+                 'set_multi': [[('foo', 1, 2)], 3],
+                 'delete_multi': [['foo', 'bar']]}
         for method_name, args in calls.iteritems():
             method = getattr(driver, method_name, None)
             self.assertIsNotNone(method, ("Driver should have method %s" %
@@ -91,12 +111,130 @@ class TestTCPDriver(unittest.TestCase):
         """
         driver = TCPDriver('127.0.0.1', 55555, 1, 1)
         driver._sock = mock.Mock()
-        driver._sock.recv = mock.Mock(return_value=None)
+        driver._sock.recv_into = mock.Mock(return_value=0)
         driver.close = mock.Mock()
         with self.assertRaisesRegexp(socket.error, 'Socket died'):
             driver._readbuffered()
         driver.close.assert_called()
 
+    def test_read_across_recvs(self):
+        """_read() should assemble values spanning many recv() calls, and
+        keep leftover data buffered for the next read.
+        """
+        data = 'x' * (base.BUFFER_SIZE * 3) + 'tail'
+        driver = TCPDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket(data)
+        self.assertEqual(driver._read(len(data) - 4), data[:-4])
+        self.assertEqual(driver._read(4), 'tail')
+        # oversized buffer should be dropped once drained
+        self.assertEqual(len(driver._rbuf), base.BUFFER_SIZE)
+
+    def test_read_recv_size(self):
+        """_read() should never ask for more than recv_size per recv().
+        """
+        data = 'x' * 10000
+        driver = TCPDriver('127.0.0.1', 55555, 1, 1, recv_size=100)
+        driver._sock = FakeSocket(data, chunk=len(data))
+        self.assertEqual(driver._read(len(data)), data)
+        self.assertEqual(len(driver._sock.requested), 100)
+        self.assertEqual(max(driver._sock.requested), 100)
+
+    def test_read_adaptive_recv(self):
+        """_read() should ask for the whole remaining value per recv() when
+        adaptive_recv is set.
+        """
+        data = 'x' * (base.BUFFER_SIZE * 4)
+        driver = TCPDriver('127.0.0.1', 55555, 1, 1, recv_size=100,
+                           adaptive_recv=True)
+        driver._sock = FakeSocket(data, chunk=len(data))
+        self.assertEqual(driver._read(len(data)), data)
+        self.assertEqual(driver._sock.requested, [len(data)])
+
+    def test_read_compacts_buffer(self):
+        """_read() should slide unconsumed data to the front of the buffer
+        instead of growing it.
+        """
+        data = ''.join(chr(65 + i % 26) for i in range(base.BUFFER_SIZE * 2))
+        driver = TCPDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket(data, chunk=base.BUFFER_SIZE - 10)
+        out = []
+        for i in range(0, len(data), 1000):
+            out.append(driver._read(min(1000, len(data) - i)))
+        self.assertEqual(''.join(out), data)
+        self.assertEqual(len(driver._rbuf), base.BUFFER_SIZE)
+
+    def test_read_into_buffer(self):
+        """_read_into() should fill buffers straight from the socket, after
+        whatever was buffered already, growing bytearrays as needed.
+        """
+        data = 'x' * (base.BUFFER_SIZE * 3) + 'tail'
+        driver = TCPDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket('ab' + data + 'rest', chunk=1000)
+        self.assertEqual(driver._read(2), 'ab')
+        buf = bytearray()
+        driver._read_into(len(data), buf)
+        self.assertEqual(str(buf), data)
+        self.assertEqual(driver._read(4), 'rest')
+        # nothing but the read ahead went through the internal buffer
+        self.assertEqual(len(driver._rbuf), base.BUFFER_SIZE)
+
+        driver._sock = FakeSocket('1234rest')
+        buf = bytearray('.' * 6)
+        driver._read_into(4, memoryview(buf)[1:])
+        self.assertEqual(str(buf), '.1234.')
+        self.assertEqual(driver._read(4), 'rest')
+
+    def test_read_into_too_small(self):
+        """_read_into() should close the connection and raise when the
+        buffer can't hold the value.
+        """
+        driver = TCPDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket('1234')
+        driver.close = mock.Mock()
+        with self.assertRaisesRegexp(ValueError, 'Buffer too small'):
+            driver._read_into(4, memoryview(bytearray(3)))
+        driver.close.assert_called()
+
+    def test_read_into_file(self):
+        """_read_into() should write to file like objects in pieces.
+        """
+        data = 'x' * (base.BUFFER_SIZE * 3) + 'tail'
+        driver = TCPDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket(data + 'rest')
+        out = mock.Mock()
+        driver._read_into(len(data), out)
+        self.assertEqual(''.join(c[0][0] for c in out.write.call_args_list),
+                         data)
+        self.assertTrue(all(len(c[0][0]) <= base.BUFFER_SIZE
+                            for c in out.write.call_args_list))
+        self.assertEqual(driver._read(4), 'rest')
+
+    def test_unpack(self):
+        """_unpack() should unpack straight from the buffer, reading as
+        needed, and consume what it unpacked.
+        """
+        codec = struct.Struct('!HL')
+        driver = TCPDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket(codec.pack(1, 2) * 2 + 'rest', chunk=4)
+        self.assertEqual(driver._unpack(codec), (1, 2))
+        self.assertEqual(driver._unpack(codec), (1, 2))
+        self.assertEqual(driver._read(4), 'rest')
+
+    def test_sendpieces(self):
+        """_sendall() of a list should join small pieces, and send large
+        ones as they are.
+        """
+        driver = TCPDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = mock.Mock()
+        driver.is_connected = mock.Mock(return_value=True)
+        big = memoryview(bytearray(base.SEND_COPY_LIMIT))
+        driver._sendall(['a', bytearray('b'), big, 'c', memoryview('d')])
+        calls = [c[0][0] for c in driver._sock.sendall.call_args_list]
+        self.assertEqual(calls[0], 'ab')
+        self.assertIs(calls[1], big)
+        self.assertEqual(calls[2], 'cd')
+        self.assertEqual(len(calls), 3)
+
     def test_sendall_connect(self):
         """sendall() should connect if necessary
         """
@@ -124,13 +262,143 @@ class TestTCPDriver(unittest.TestCase):
 
 
 class TestBinaryProtoDriver(unittest.TestCase):
+    @staticmethod
+    def getkq_response(key, value, status=binaryproto.RESPONSE_SUCCESS):
+        return struct.pack(
+            '!BBHBBHLLQ', binaryproto.MAGIC_RESPONSE, binaryproto.CMD_GETKQ,
+            len(key), 4, 0, status, 4 + len(key) + len(value), 0, 7
+        ) + struct.pack('!L', 3) + key + value
+
+    @staticmethod
+    def noop_response():
+        return struct.pack('!BBHBBHLLQ', binaryproto.MAGIC_RESPONSE,
+                           binaryproto.CMD_NOOP, 0, 0, 0, 0, 0, 0, 0)
+
+    def test_build_get_request(self):
+        """_build_get_request() should send a quiet get for every key,
+        then a NOOP.
+        """
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        self.assertEqual(
+            driver._build_get_request(['a', 'bb']),
+            driver._build_request(binaryproto.CMD_GETKQ, opaque=0, key='a') +
+            driver._build_request(binaryproto.CMD_GETKQ, opaque=1, key='bb') +
+            driver._build_request(binaryproto.CMD_NOOP))
+
+    def test_read_get_response(self):
+        """_read_get_response() should map responses to their keys,
+        including empty values, and stop at the NOOP.
+        """
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        missing = self.getkq_response('a', '', binaryproto.RESPONSE_KEY_ENOENT)
+        driver._sock = FakeSocket(
+            self.getkq_response('c', 'cc') + self.getkq_response('b', '') +
+            missing + self.noop_response() + 'rest')
+        self.assertEqual(driver._read_get_response(True),
+                         {'b': ['', 3, 7], 'c': ['cc', 3, 7]})
+        self.assertEqual(driver._read(4), 'rest')
+
+    def test_iter_multi(self):
+        """iter_multi() should yield values as they are read, a window at
+        a time.
+        """
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver.multi_window = 2
+        driver._sock = FakeSocket(
+            self.getkq_response('a', '1') + self.getkq_response('b', '2') +
+            self.noop_response() +
+            self.getkq_response('c', '3') + self.noop_response(), chunk=1)
+        driver._sock.sendall = mock.Mock()
+        it = driver.iter_multi(['a', 'b', 'c'])
+        self.assertEqual(next(it), ('a', ['1', 3]))
+        self.assertEqual(driver._sock.data, self.getkq_response('b', '2') +
+                         self.noop_response() + self.getkq_response('c', '3') +
+                         self.noop_response())
+        self.assertEqual(list(it), [('b', ['2', 3]), ('c', ['3', 3])])
+        self.assertEqual(driver._sock.sendall.call_count, 2)
+
+    def test_get_multi_windows(self):
+        """get_multi() should send at most multi_window keys at a time,
+        and read their responses before sending more.
+        """
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver.multi_window = 2
+        driver._sock = FakeSocket(
+            self.getkq_response('a', '1') + self.noop_response() +
+            self.noop_response() +
+            self.getkq_response('e', '5') + self.noop_response(), chunk=1)
+        sent = []
+        def sendall(data):
+            # nothing may be left unread when the next window goes out
+            self.assertEqual(driver._rend, driver._rstart)
+            sent.append(data)
+        driver._sock.sendall = sendall
+        keys = (k for k in ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(driver.get_multi(keys),
+                         {'a': ['1', 3], 'e': ['5', 3]})
+        self.assertEqual(sent, [driver._build_get_request(['a', 'b']),
+                                driver._build_get_request(['c', 'd']),
+                                driver._build_get_request(['e'])])
+        self.assertEqual(driver.get_multi([]), {})
+
+    def test_pipeline_windows(self):
+        """pipeline_send() should split long multi gets into windows,
+        reading the responses to each before sending the next, and
+        pipeline_recv() should merge them back into one result.
+        """
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver.multi_window = 2
+        driver._sock = FakeSocket(
+            self.getkq_response('a', '1') + self.noop_response() +
+            self.noop_response() +
+            self.getkq_response('e', '5') + self.noop_response() +
+            self.getkq_response('f', '6') + self.noop_response(), chunk=1)
+        sent = []
+        def sendall(data):
+            # nothing may be left unread when the next window goes out
+            self.assertEqual(driver._rend, driver._rstart)
+            sent.append(data)
+        driver._sock.sendall = sendall
+        self.assertTrue(driver.pipeline_send([
+            ('get_multi', (['a', 'b', 'c', 'd', 'e'],)),
+            ('get_multi', (['f'],))]))
+        self.assertEqual(driver.pipeline_recv(),
+                         [{'a': ['1', 3], 'e': ['5', 3]}, {'f': ['6', 3]}])
+        self.assertEqual(sent, [
+            driver._build_get_request(['a', 'b']),
+            driver._build_get_request(['c', 'd']),
+            driver._build_get_request(['e']) +
+            driver._build_get_request(['f'])])
+        self.assertEqual(driver._sock.data, '')
+
+    def test_get_into(self):
+        """get_into() should stream values with no flags, and return any
+        other value.
+        """
+        def response(flags, value, status=binaryproto.RESPONSE_SUCCESS):
+            extra = struct.pack('!L', flags)
+            return struct.pack(
+                '!BBHBBHLLQ', binaryproto.MAGIC_RESPONSE, binaryproto.CMD_GET,
+                0, 4, 0, status, 4 + len(value), 0, 1) + extra + value
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket(
+            response(0, 'hello') + response(1, 'xy') +
+            response(0, 'Not found', binaryproto.RESPONSE_KEY_ENOENT))
+        driver._sock.sendall = mock.Mock()
+        buf = bytearray()
+        self.assertEqual(driver.get_into('a', buf), [5, 0, None])
+        self.assertEqual(str(buf), 'hello')
+        self.assertEqual(driver.get_into('b', buf), [2, 1, 'xy'])
+        self.assertIsNone(driver.get_into('c', buf))
+        self.assertEqual(str(buf), 'hello')
+
     def test_read_response_bad_magic(self):
         """_read_response() should raise when magic is not the expected value.
         """
         bad_magic = 42
         header = struct.pack('!BBHBBHLLQ', bad_magic, 0, 0, 0, 0, 0, 0, 0, 0)
         driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
-        driver._read = mock.Mock(return_value=header)
+        driver._sock = FakeSocket(header)
         with self.assertRaisesRegexp(IOError, 'Protocol violation'):
             driver._read_response()
 
@@ -176,7 +444,7 @@ class TestBinaryProtoDriver(unittest.TestCase):
         self.assertIsNone(driver._incrdecr(binaryproto.CMD_INCR, 'foo', 1, 2))
 
     def test_get_bad_opcode(self):
-        """_get() should raise if opcode is not CMD_GETQ or CMD_GET.
+        """_get() should raise if opcode is not CMD_GETKQ or CMD_NOOP.
         """
         opcode = binaryproto.CMD_SET
         driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
@@ -184,7 +452,7 @@ class TestBinaryProtoDriver(unittest.TestCase):
         driver._read_response = mock.Mock(return_value=[0, opcode, 0, 0, 0,
                                                         0, 0, 0, 0, 0, 0, 0])
         with self.assertRaisesRegexp(IOError, 'Unexpected response'):
-            driver._get([], None)
+            driver._get(['foo'], None)
 
     def test_append_prepend_bad_opcode(self):
         """_append_prepend() should raise if opcode doesn't match cmd.
@@ -264,8 +532,407 @@ class TestBinaryProtoDriver(unittest.TestCase):
         with self.assertRaisesRegexp(IOError, 'Unexpected response'):
             driver.delete('foo')
 
+    def test_set_multi(self):
+        """set_multi() should send quiet sets and a NOOP in one write, and
+        return keys of any error responses read before the NOOP.
+        """
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sendall = mock.Mock()
+        driver._read_response = mock.Mock(side_effect=[
+            [0, binaryproto.CMD_SETQ, 0, 0, 0, binaryproto.RESPONSE_E2BIG,
+             0, 1, 0, 0, 0, 0],
+            [0, binaryproto.CMD_NOOP, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]])
+        result = driver.set_multi([('a', '1', 0), ('b', '2', 0)], 0)
+        self.assertEqual(result, ['b'])
+        self.assertEqual(driver._sendall.call_count, 1)
+        sent = base.join_buffers(driver._sendall.call_args[0][0])
+        self.assertEqual(sent[1], chr(binaryproto.CMD_SETQ))
+        self.assertEqual(sent[-24:],
+                         driver._build_request(binaryproto.CMD_NOOP))
+
+    def test_multi_windows(self):
+        """set_multi() and delete_multi() should send at most
+        multi_window items and a NOOP at a time, and read the responses
+        before sending more.
+        """
+        def response(opcode, status, opaque):
+            return struct.pack('!BBHBBHLLQ', binaryproto.MAGIC_RESPONSE,
+                               opcode, 0, 0, 0, status, 0, opaque, 0)
+        noop = response(binaryproto.CMD_NOOP, 0, 0)
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver.multi_window = 2
+        driver._sock = FakeSocket(
+            noop + response(binaryproto.CMD_SETQ,
+                            binaryproto.RESPONSE_E2BIG, 0) + noop +
+            response(binaryproto.CMD_DELETEQ,
+                     binaryproto.RESPONSE_KEY_ENOENT, 1) + noop + noop,
+            chunk=1)
+        sent = []
+        def sendall(data):
+            # nothing may be left unread when the next window goes out
+            self.assertEqual(driver._rend, driver._rstart)
+            sent.append(data)
+        driver._sock.sendall = sendall
+        items = [('a', '1', 0), ('b', '2', 0), ('c', '3', 0)]
+        self.assertEqual(driver.set_multi(items, 0), ['c'])
+        self.assertEqual(driver.delete_multi(['a', 'b', 'c']), ['b'])
+        self.assertEqual(len(sent), 4)
+        for data in sent:
+            self.assertEqual(data[-24:],
+                             driver._build_request(binaryproto.CMD_NOOP))
+        self.assertEqual(driver._sock.data, '')
+
+    def test_set_buffer(self):
+        """set() should send large values without copying them.
+        """
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket(struct.pack(
+            '!BBHBBHLLQ', binaryproto.MAGIC_RESPONSE, binaryproto.CMD_SET,
+            0, 0, 0, 0, 0, 0, 1))
+        driver._sock.sendall = mock.Mock()
+        val = memoryview('x' * base.SEND_COPY_LIMIT)
+        self.assertTrue(driver.set('a', val, 0, 0))
+        calls = [c[0][0] for c in driver._sock.sendall.call_args_list]
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0][-1:], 'a')
+        self.assertIs(calls[1], val)
+
+    def test_noreply(self):
+        """noreply commands should be sent quiet, without reading, and
+        failures should be picked up while reading later responses.
+        """
+        def response(opcode, status, opaque):
+            return struct.pack('!BBHBBHLLQ', binaryproto.MAGIC_RESPONSE,
+                               opcode, 0, 0, 0, status, 0, opaque, 0)
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = mock.Mock()
+        self.assertIsNone(driver.set('a', '1', 0, 0, noreply=True))
+        self.assertIsNone(driver.delete('b', noreply=True))
+        self.assertFalse(driver._sock.recv_into.called)
+        sent = [c[0][0] for c in driver._sock.sendall.call_args_list]
+        self.assertEqual([ord(s[1]) for s in sent],
+                         [binaryproto.CMD_SETQ, binaryproto.CMD_DELETEQ])
+        delete_opaque = struct.unpack('!L', sent[1][12:16])[0]
+        self.assertTrue(delete_opaque & binaryproto.NOREPLY_OPAQUE)
+
+        driver._sock = FakeSocket(
+            response(binaryproto.CMD_DELETEQ, binaryproto.RESPONSE_KEY_ENOENT,
+                     delete_opaque) +
+            response(binaryproto.CMD_FLUSH, 0, 0) +
+            response(binaryproto.CMD_NOOP, 0, 0))
+        driver._sock.sendall = mock.Mock()
+        self.assertTrue(driver.flush_all())
+        self.assertEqual(driver.sync(), ['b'])
+        self.assertEqual(driver._noreply_keys, {})
+        self.assertEqual(driver.sync(), [])
+
+    def test_pipeline_multi_noreply(self):
+        """noreply set_multi() and delete_multi() should give no failed
+        keys in a pipeline too, without reading anything.
+        """
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = mock.Mock()
+        self.assertTrue(driver.pipeline_send([
+            ('set_multi', ([('a', '1', 0)], 0, True)),
+            ('delete_multi', (['a'], True))]))
+        self.assertEqual(driver.pipeline_recv(), [[], []])
+        self.assertFalse(driver._sock.recv_into.called)
+
+    def test_noreply_max_pending(self):
+        """noreply commands should sync once too many are in flight.
+        """
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sendall = mock.Mock()
+        driver._read_response = mock.Mock(return_value=[
+            0, binaryproto.CMD_NOOP, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])
+        for i in xrange(binaryproto.MAX_NOREPLY_PENDING - 1):
+            driver.delete('a', noreply=True)
+        self.assertFalse(driver._read_response.called)
+        driver.delete('a', noreply=True)
+        self.assertEqual(driver._read_response.call_count, 1)
+        self.assertEqual(driver._noreply_keys, {})
+
+    def test_noreply_failures_kept(self):
+        """sync() should return every noreply failure since the last sync,
+        however many there were.
+        """
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sendall = mock.Mock()
+        def read_packet(writable=None):
+            # every noreply add in flight fails, then the NOOP answers
+            for opaque in sorted(driver._noreply_keys):
+                return [0, binaryproto.CMD_ADDQ, 0, 0, 0,
+                        binaryproto.RESPONSE_KEY_EEXISTS, 0, opaque, 0,
+                        0, 0, 0]
+            return [0, binaryproto.CMD_NOOP, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+        driver._read_packet = read_packet
+        keys = ['key_%d' % i for i in xrange(3000)]
+        for key in keys:
+            self.assertIsNone(driver.add(key, '1', 0, 0, noreply=True))
+        self.assertEqual(driver.sync(), keys)
+        self.assertEqual(driver.sync(), [])
+
+    def test_delete_multi_bad_opcode(self):
+        """delete_multi() should raise on a response that is neither a
+        quiet delete nor the NOOP.
+        """
+        driver = BinaryProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sendall = mock.Mock()
+        driver._read_response = mock.Mock(return_value=[0, binaryproto.CMD_GET,
+                                                        0, 0, 0, 0, 0, 0, 0,
+                                                        0, 0, 0])
+        with self.assertRaisesRegexp(IOError, 'Unexpected response'):
+            driver.delete_multi(['foo'])
+
 
 class TestTextProtoDriver(unittest.TestCase):
+    def test_pipeline(self):
+        """pipeline_send() should send all commands in one write, and
+        pipeline_recv() should parse each response in order.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket('VALUE a 0 1\r\n1\r\nEND\r\n'
+                                  'END\r\n'
+                                  'VALUE c 2 1\r\n3\r\nEND\r\n')
+        driver._sock.sendall = mock.Mock()
+        self.assertTrue(driver.pipeline_send([('get_multi', (['a', 'b'],)),
+                                              ('get', ('b',)),
+                                              ('get', ('c',))]))
+        driver._sock.sendall.assert_called_once_with(
+            'get a b\r\nget b\r\nget c\r\n')
+        self.assertEqual(driver.pipeline_recv(),
+                         [{'a': ['1', 0]}, None, ['3', 2]])
+        self.assertEqual(driver.pipeline_recv(), [])
+
+    def test_iter_multi(self):
+        """iter_multi() should yield values as they are read, and close
+        the connection if closed early.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket('VALUE a 0 1\r\n1\r\n'
+                                  'VALUE b 2 1\r\n2\r\nEND\r\n', chunk=1)
+        driver._sock.sendall = mock.Mock()
+        it = driver.iter_multi(['a', 'b', 'c'])
+        self.assertEqual(next(it), ('a', ['1', 0]))
+        self.assertTrue(driver._sock.data.startswith('VALUE b'))
+        self.assertEqual(list(it), [('b', ['2', 2])])
+        driver._sock.sendall.assert_called_once_with('get a b c\r\n')
+
+        driver._sock = FakeSocket('VALUE a 0 1\r\n1\r\nEND\r\n')
+        driver._sock.sendall = mock.Mock()
+        driver.close = mock.Mock()
+        it = driver.iter_multi(['a', 'b'])
+        next(it)
+        self.assertFalse(driver.close.called)
+        it.close()
+        driver.close.assert_called()
+
+    @mock.patch('pyermc.driver.textproto.MAX_GET_LINE', 9)
+    def test_get_lines(self):
+        """_get_lines() should split keys over lines of at most
+        MAX_GET_LINE, but never leave a line without keys.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        self.assertEqual(driver._get_lines('get', ['a', 'bb', 'c', 'longkey']),
+                         ['get a bb', 'get c', 'get longkey'])
+        self.assertEqual(driver._get_lines('get', []), [])
+
+    @mock.patch('pyermc.driver.textproto.MAX_GET_LINE', 9)
+    def test_get_multi_windows(self):
+        """get_multi() should send at most multi_window keys at a time,
+        and read their responses before sending more.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver.multi_window = 3
+        driver._sock = FakeSocket('VALUE a 0 1\r\n1\r\nEND\r\nEND\r\n'
+                                  'VALUE e 2 1\r\n5\r\nEND\r\n', chunk=1)
+        sent = []
+        def sendall(data):
+            # nothing may be left unread when the next window goes out
+            self.assertEqual(driver._rend, driver._rstart)
+            sent.append(data)
+        driver._sock.sendall = sendall
+        keys = (k for k in ['a', 'bb', 'c', 'd', 'e'])
+        self.assertEqual(driver.get_multi(keys),
+                         {'a': ['1', 0], 'e': ['5', 2]})
+        self.assertEqual(sent, ['get a bb\r\nget c\r\n', 'get d e\r\n'])
+        # nothing to send for no keys, even in a pipeline
+        self.assertEqual(driver.get_multi([]), {})
+        driver.pipeline_send([('get_multi', ([],))])
+        self.assertEqual(driver.pipeline_recv(), [{}])
+        self.assertEqual(len(sent), 2)
+
+    @mock.patch('pyermc.driver.textproto.MAX_GET_LINE', 9)
+    def test_pipeline_windows(self):
+        """pipeline_send() should split long multi gets into windows,
+        reading the responses to each before sending the next, and
+        pipeline_recv() should merge them back into one result.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver.multi_window = 3
+        driver._sock = FakeSocket('VALUE a 0 1\r\n1\r\nEND\r\nEND\r\n'
+                                  'VALUE e 2 1\r\n5\r\nEND\r\n'
+                                  'DELETED\r\n', chunk=1)
+        sent = []
+        def sendall(data):
+            # nothing may be left unread when the next window goes out
+            self.assertEqual(driver._rend, driver._rstart)
+            sent.append(data)
+        driver._sock.sendall = sendall
+        self.assertTrue(driver.pipeline_send([
+            ('get_multi', (['a', 'bb', 'c', 'd', 'e'],)),
+            ('delete', ('f',))]))
+        self.assertEqual(driver.pipeline_recv(),
+                         [{'a': ['1', 0], 'e': ['5', 2]}, True])
+        self.assertEqual(sent, ['get a bb\r\nget c\r\n',
+                                'get d e\r\ndelete f\r\n'])
+        self.assertEqual(driver._sock.data, '')
+
+    def test_pipeline_connect(self):
+        """pipeline_send() should connect before queuing any reader.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        def connect():
+            driver._pending = []
+            driver._sock = FakeSocket('END\r\n')
+            driver._sock.sendall = mock.Mock()
+        with mock.patch.object(driver, 'connect', side_effect=connect):
+            self.assertTrue(driver.pipeline_send([('get', ('a',))]))
+        self.assertEqual(driver.pipeline_recv(), [None])
+
+    def test_get_into(self):
+        """get_into() should stream values with no flags, and return any
+        other value.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket('VALUE a 0 5\r\nhello\r\nEND\r\n'
+                                  'VALUE b 1 2\r\nxy\r\nEND\r\n'
+                                  'END\r\n')
+        driver._sock.sendall = mock.Mock()
+        out = StringIO.StringIO()
+        self.assertEqual(driver.get_into('a', out), [5, 0, None])
+        self.assertEqual(out.getvalue(), 'hello')
+        self.assertEqual(driver.get_into('b', out), [2, 1, 'xy'])
+        self.assertIsNone(driver.get_into('c', out))
+        self.assertEqual(out.getvalue(), 'hello')
+        self.assertEqual(
+            [c[0][0] for c in driver._sock.sendall.call_args_list],
+            ['get a\r\n', 'get b\r\n', 'get c\r\n'])
+
+    def test_set_buffer(self):
+        """set() should send large values without copying them.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket('STORED\r\n')
+        driver._sock.sendall = mock.Mock()
+        val = bytearray('x' * base.SEND_COPY_LIMIT)
+        self.assertTrue(driver.set('a', val, 0, 0))
+        calls = [c[0][0] for c in driver._sock.sendall.call_args_list]
+        self.assertEqual(calls[0], 'set a 0 0 %d\r\n' % len(val))
+        self.assertIs(calls[1], val)
+        self.assertEqual(calls[2], '\r\n')
+
+    def test_set_multi(self):
+        """set_multi() should send every set in one write, and return the
+        keys that were not stored.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket('STORED\r\nSERVER_ERROR too large\r\n')
+        driver._sock.sendall = mock.Mock()
+        result = driver.set_multi([('a', '1', 0), ('b', '22', 2)], 10)
+        self.assertEqual(result, ['b'])
+        driver._sock.sendall.assert_called_once_with(
+            'set a 0 10 1\r\n1\r\nset b 2 10 2\r\n22\r\n')
+
+    def test_set_multi_noreply(self):
+        """set_multi(noreply=True) should not read any response.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = mock.Mock()
+        self.assertEqual(driver.set_multi([('a', '1', 0)], 0, True), [])
+        driver._sock.sendall.assert_called_once_with(
+            'set a 0 0 1 noreply\r\n1\r\n')
+        self.assertFalse(driver._sock.recv_into.called)
+
+    def test_pipeline_multi_noreply(self):
+        """noreply set_multi() and delete_multi() should give no failed
+        keys in a pipeline too, without reading anything.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = mock.Mock()
+        self.assertTrue(driver.pipeline_send([
+            ('set_multi', ([('a', '1', 0)], 0, True)),
+            ('delete_multi', (['a'], True))]))
+        self.assertEqual(driver.pipeline_recv(), [[], []])
+        driver._sock.sendall.assert_called_once_with(
+            'set a 0 0 1 noreply\r\n1\r\ndelete a noreply\r\n')
+        self.assertFalse(driver._sock.recv_into.called)
+
+    def test_noreply(self):
+        """noreply commands should ask for no reply, and read nothing.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = mock.Mock()
+        self.assertIsNone(driver.add('a', '1', 10, 2, noreply=True))
+        self.assertIsNone(driver.delete('a', noreply=True))
+        self.assertIsNone(driver.incr('a', 3, noreply=True))
+        self.assertEqual(
+            [c[0][0] for c in driver._sock.sendall.call_args_list],
+            ['add a 2 10 1 noreply\r\n1\r\n', 'delete a noreply\r\n',
+             'incr a 3 noreply\r\n'])
+        self.assertFalse(driver._sock.recv_into.called)
+        self.assertEqual(driver.sync(), [])
+
+    def test_delete_multi(self):
+        """delete_multi() should return the keys that were not deleted,
+        and raise on a protocol error.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket('NOT_FOUND\r\nDELETED\r\n')
+        driver._sock.sendall = mock.Mock()
+        self.assertEqual(driver.delete_multi(['a', 'b']), ['a'])
+        driver._sock.sendall.assert_called_once_with(
+            'delete a\r\ndelete b\r\n')
+
+        driver._sock = FakeSocket('CLIENT_ERROR bad_command\r\n')
+        driver._sock.sendall = mock.Mock()
+        with self.assertRaisesRegexp(IOError, 'bad_command'):
+            driver.delete_multi(['a'])
+
+    def test_multi_windows(self):
+        """set_multi() and delete_multi() should send at most
+        multi_window items at a time, and read the responses before
+        sending more.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver.multi_window = 2
+        driver._sock = FakeSocket('STORED\r\nSTORED\r\nNOT_STORED\r\n'
+                                  'DELETED\r\nNOT_FOUND\r\nDELETED\r\n',
+                                  chunk=1)
+        sent = []
+        def sendall(data):
+            # nothing may be left unread when the next window goes out
+            self.assertEqual(driver._rend, driver._rstart)
+            sent.append(data)
+        driver._sock.sendall = sendall
+        items = [('a', '1', 0), ('b', '2', 0), ('c', '3', 0)]
+        self.assertEqual(driver.set_multi(items, 0), ['c'])
+        self.assertEqual(driver.delete_multi(['a', 'b', 'c']), ['b'])
+        self.assertEqual(sent, [
+            'set a 0 0 1\r\n1\r\nset b 0 0 1\r\n2\r\n',
+            'set c 0 0 1\r\n3\r\n',
+            'delete a\r\ndelete b\r\n', 'delete c\r\n'])
+
+    def test_readline(self):
+        """_readline() should find line endings split across recv() calls.
+        """
+        driver = TextProtoDriver('127.0.0.1', 55555, 1, 1)
+        driver._sock = FakeSocket('VALUE foo 0 3\r\nbar\r\nEND\r\n', chunk=1)
+        self.assertEqual(driver._readline(), 'VALUE foo 0 3')
+        self.assertEqual(driver._read(3), 'bar')
+        self.assertEqual(driver._readline(), '')
+        self.assertEqual(driver._readline(), 'END')
+
     def test_read_data_response_error(self):
         """_read_data_response() should raise on an error.
         """
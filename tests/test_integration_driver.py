@@ -7,6 +7,7 @@ import inspect
 import struct
 import copy
 import socket
+import StringIO
 ## we use some test harness stuff from python2.7.
 ## if not on 2.7, try importing unittest2 for compat
 if sys.version_info < (2, 7):
@@ -303,6 +304,27 @@ class _IntegrationBase(unittest.TestCase):
         self.client.reset_client()
         self.client.cache_cas = False
 
+    def test_get_into(self):
+        self.client.flush_all()
+        key = 'test_get_into'
+        val = os.urandom(200000)
+        self.assertTrue(self.client.set(key, val))
+        buf = bytearray()
+        self.assertEqual(self.client.get_into(key, buf), len(val))
+        self.assertEqual(str(buf), val)
+        out = StringIO.StringIO()
+        self.assertEqual(self.client.get_into(key, out), len(val))
+        self.assertEqual(out.getvalue(), val)
+        # compressed values are unpacked first
+        self.assertTrue(self.client.set(key, 'x' * 1000, min_compress_len=1))
+        buf = bytearray(1000)
+        self.assertEqual(self.client.get_into(key, memoryview(buf)), 1000)
+        self.assertEqual(str(buf), 'x' * 1000)
+        self.assertIsNone(self.client.get_into(key + '_missing', buf))
+        # the connection is still in sync afterwards
+        self.assertTrue(self.client.set(key, 'small'))
+        self.assertEqual(self.client.get(key), 'small')
+
     def test_get_multi(self):
         self.client.flush_all()
         data = dict(('test_get_multi_%s'%x,x) for x in xrange(10))
@@ -346,6 +368,189 @@ class _IntegrationBase(unittest.TestCase):
         self.client.reset_client()
         self.client.cache_cas = False
 
+    def test_get_multi_many(self):
+        self.client.flush_all()
+        data = dict(('test_get_multi_many_%d' % x, str(x))
+                    for x in xrange(2500))
+        self.assertEqual(self.client.set_multi(data), [])
+        missing = ['test_get_multi_many_missing_%d' % x for x in xrange(500)]
+        self.assertDictEqual(self.client.get_multi(data.keys() + missing),
+                             data)
+        self.assertDictEqual(
+            dict(self.client.iter_multi(data.keys() + missing)), data)
+        # stopping early leaves the client usable
+        for key, value in self.client.iter_multi(data.keys()):
+            break
+        self.assertEqual(self.client.get(key), value)
+
+    def test_set_buffers(self):
+        self.client.flush_all()
+        big = os.urandom(100000)
+        for val in [bytearray('small'), memoryview('small'),
+                    bytearray(big), memoryview(big)[1:]]:
+            self.assertTrue(self.client.set('test_set_buffers', val))
+            self.assertEqual(self.client.get('test_set_buffers'),
+                             memoryview(val).tobytes())
+        data = {'test_set_buffers_a': bytearray(big),
+                'test_set_buffers_b': memoryview('b')}
+        self.assertEqual(self.client.set_multi(data), [])
+        self.assertDictEqual(self.client.get_multi(data.keys()),
+                             {'test_set_buffers_a': big,
+                              'test_set_buffers_b': 'b'})
+        with self.client.pipeline() as p:
+            p.set('test_set_buffers', memoryview(big))
+            p.get('test_set_buffers')
+        self.assertEqual(p.results, [True, big])
+        # compressed values work too
+        self.assertTrue(self.client.set('test_set_buffers', bytearray(big),
+                                        min_compress_len=1))
+        self.assertEqual(self.client.get('test_set_buffers'), big)
+
+    def test_set_multi(self):
+        self.client.flush_all()
+        data = dict(('test_set_multi_%s' % x, x) for x in xrange(100))
+        data['test_set_multi_big'] = 'x' * (self.client.max_value_length - 1)
+        self.assertEqual(self.client.set_multi(data), [])
+        self.assertDictEqual(self.client.get_multi(data.keys()), data)
+
+        self.assertEqual(self.client.set_multi(data, noreply=True), [])
+        self.assertDictEqual(self.client.get_multi(data.keys()), data)
+
+    def test_large_values(self):
+        self.client.flush_all()
+        client = pyermc.Client(self.host, self.port, max_value_length=1000,
+                               large_values=True,
+                               client_driver=self.client._driver)
+        key = 'test_large_values'
+        val = os.urandom(2500)
+        self.assertTrue(client.set(key, val))
+        self.assertEqual(client.get(key), val)
+        buf = bytearray()
+        self.assertEqual(client.get_into(key, buf), len(val))
+        self.assertEqual(str(buf), val)
+        data = {'test_large_values_a': {'a': 'a' * 2500},
+                'test_large_values_b': 'b'}
+        self.assertEqual(client.set_multi(data), [])
+        self.assertDictEqual(client.get_multi(data.keys() + [key]),
+                             dict(data, test_large_values=val))
+        with client.pipeline() as p:
+            p.set(key, val[::-1])
+            p.get(key)
+        self.assertEqual(p.results, [True, val[::-1]])
+        with self.assertRaises(pyermc.MemcacheValueError):
+            client.append(key, val)
+        with self.assertRaises(pyermc.MemcacheValueError):
+            self.client.get(key)
+
+        # a missing chunk makes the value a miss
+        generation = client._client.get(key)[0].split()[0]
+        client.delete('pyermc:chunk:%s:1' % generation)
+        self.assertIsNone(client.get(key))
+        self.assertEqual(client.get_multi([key]), {})
+        client.close()
+
+    def test_delete_multi(self):
+        self.client.flush_all()
+        data = dict(('test_delete_multi_%s' % x, x) for x in xrange(10))
+        self.client.set_multi(data)
+        keys = data.keys() + ['test_delete_multi_junk']
+        self.assertEqual(self.client.delete_multi(keys),
+                         ['test_delete_multi_junk'])
+        self.assertDictEqual(self.client.get_multi(keys), {})
+
+    def test_pipeline(self):
+        self.client.flush_all()
+        self.client.set('test_pipeline_a', 'a')
+        self.client.set('test_pipeline_b', 1)
+        self.client.set('test_pipeline_d', 'd')
+        with self.client.pipeline() as p:
+            p.get('test_pipeline_a')
+            p.incr('test_pipeline_b', 2)
+            p.set('test_pipeline_c', {'c': 1})
+            p.delete('test_pipeline_d')
+            p.delete('test_pipeline_junk')
+            p.get_multi(['test_pipeline_c', 'test_pipeline_d'])
+            p.set('test_pipeline_e', 'e', noreply=True)
+            p.version()
+        self.assertEqual(p.results, [
+            'a', 3, True, True, False, {'test_pipeline_c': {'c': 1}},
+            None, self.client.version()])
+        self.assertEqual(self.client.get('test_pipeline_e'), 'e')
+
+    def test_noreply_writes(self):
+        self.client.flush_all()
+        key = 'test_noreply_writes'
+        self.assertIsNone(self.client.set(key, 1, noreply=True))
+        self.assertIsNone(self.client.incr(key, 5, noreply=True))
+        self.assertIsNone(self.client.decr(key, 2, noreply=True))
+        self.assertIsNone(self.client.prepend(key, '1', noreply=True))
+        self.assertEqual(self.client.get(key), 14)
+        self.assertIsNone(self.client.delete(key, noreply=True))
+        self.assertIsNone(self.client.get(key))
+        self.client.sync()
+
+    def test_first_call_pipelined(self):
+        self.client.flush_all()
+        data = dict(('test_first_call_pipelined_%s' % x, x) for x in xrange(20))
+        self.client.set_multi(data)
+        # the first fan out and pipeline of a client that never connected
+        client = pyermc.ShardedClient(
+            [(self.host, self.port), ('localhost', self.port)],
+            client_driver=self.client._driver)
+        self.assertDictEqual(client.get_multi(data.keys()), data)
+        client.close()
+        client = pyermc.Client(self.host, self.port,
+                               client_driver=self.client._driver)
+        with client.pipeline() as p:
+            p.get('test_first_call_pipelined_1')
+            p.get_multi(['test_first_call_pipelined_2'])
+        self.assertEqual(p.results, [1, {'test_first_call_pipelined_2': 2}])
+        client.close()
+
+    def test_sharded_get_multi(self):
+        self.client.flush_all()
+        # two "servers" that are really the same memcached
+        client = pyermc.ShardedClient(
+            [(self.host, self.port), ('localhost', self.port)],
+            client_driver=self.client._driver)
+        data = dict(('test_sharded_get_multi_%s' % x, x) for x in xrange(50))
+        for k, v in data.iteritems():
+            client.set(k, v)
+        self.assertEqual(len(client._group_keys(data.keys())), 2)
+        data2 = client.get_multi(data.keys() + ['test_sharded_junk'])
+        self.assertDictEqual(data, data2)
+        client.close()
+
+    def test_sharded_multi_noreply(self):
+        self.client.flush_all()
+        client = pyermc.ShardedClient(
+            [(self.host, self.port), ('localhost', self.port)],
+            client_driver=self.client._driver)
+        data = dict(('test_sharded_multi_noreply_%s' % x, x)
+                    for x in xrange(20))
+        self.assertEqual(len(client._group_keys(data.keys())), 2)
+        self.assertEqual(client.set_multi(data, noreply=True), [])
+        self.assertDictEqual(client.get_multi(data.keys()), data)
+        self.assertEqual(client.delete_multi(data.keys(), noreply=True), [])
+        self.assertDictEqual(client.get_multi(data.keys()), {})
+        client.sync()
+        client.close()
+
+    def test_sharded_multi_many(self):
+        self.client.flush_all()
+        # enough long keys that sending each server its whole batch before
+        # reading any response would leave both sides blocked on writes
+        client = pyermc.ShardedClient(
+            [(self.host, self.port), ('localhost', self.port)],
+            client_driver=self.client._driver, error_as_miss=False)
+        data = dict(('test_sharded_multi_many_%0200d' % x, str(x))
+                    for x in xrange(100000))
+        self.assertEqual(client.set_multi(data), [])
+        self.assertDictEqual(client.get_multi(data.keys()), data)
+        self.assertEqual(client.delete_multi(data.keys()), [])
+        self.assertDictEqual(client.get_multi(data.keys()), {})
+        client.close()
+
     def test_get_logic(self):
         self.client.flush_all()
         key = 'test_get_logic'
@@ -659,3 +864,19 @@ class TestPyErMCNativeBinaryProto(_IntegrationBase):
         self.client.decr(key4, -5)
         val = self.client.get(key4)
         self.assertEqual(val, 7)
+
+    def test_noreply(self):
+        self.client.flush_all()
+        key = 'test_noreply'
+        self.assertIsNone(self.client.set(key, 1, noreply=True))
+        self.assertIsNone(self.client.incr(key, 2, noreply=True))
+        # fails: key exists
+        self.client.add(key, 5, noreply=True)
+        self.client.append(key, '0', noreply=True)
+        self.assertEqual(self.client.get(key), 30)
+        # fails: key doesn't exist
+        self.client.replace(key + '_2', 1, noreply=True)
+        self.client.delete(key, noreply=True)
+        self.assertEqual(self.client.sync(), [key, key + '_2'])
+        self.assertIsNone(self.client.get(key))
+        self.assertEqual(self.client.sync(), [])
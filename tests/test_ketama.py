@@ -0,0 +1,85 @@
+# -*- coding: utf8 -*-
+
+import sys
+import struct
+from hashlib import md5
+from pyermc import ketama
+## we use some test harness stuff from python2.7.
+## if not on 2.7, try importing unittest2 for compat
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+def make_ring(*names_weights):
+    return ketama.KetamaRing([(n, w, n) for n, w in names_weights])
+
+
+class TestKetamaRing(unittest.TestCase):
+    def test_no_nodes(self):
+        with self.assertRaises(ValueError):
+            ketama.KetamaRing([])
+        with self.assertRaises(ValueError):
+            make_ring(('a:1', 0))
+
+    def test_hash(self):
+        """hash() should be the first 4 bytes of md5, little endian.
+        """
+        digest = md5('foo').digest()
+        expected = struct.unpack('<I', digest[:4])[0]
+        self.assertEqual(ketama.KetamaRing.hash('foo'), expected)
+
+    def test_points(self):
+        """each node should get 160 points per equal weight share.
+        """
+        ring = make_ring(('a:1', 1), ('b:1', 1), ('c:1', 1))
+        self.assertEqual(len(ring), 3 * 160)
+        self.assertEqual(ring._points, sorted(ring._points))
+
+    def test_points_float_rounding(self):
+        """shares that doubles round down (1/7, 1/14, 1/28) should still
+        get 160 points, like libketama's float math.
+        """
+        for count in (7, 14, 28):
+            ring = make_ring(*[('s%d:1' % i, 1) for i in xrange(count)])
+            self.assertEqual(len(ring), count * 160)
+            for i in xrange(count):
+                self.assertEqual(ring._values.count('s%d:1' % i), 160)
+
+    def test_weights(self):
+        """points should be handed out proportionally to weight.
+        """
+        ring = make_ring(('a:1', 1), ('b:1', 3))
+        counts = {'a:1': 0, 'b:1': 0}
+        for value in ring._values:
+            counts[value] += 1
+        self.assertEqual(counts, {'a:1': 80, 'b:1': 240})
+
+    def test_get_node(self):
+        """keys should map to the first point at or after their hash,
+        wrapping around the ring.
+        """
+        ring = make_ring(('a:1', 1), ('b:1', 1))
+        for i in range(100):
+            key = 'key_%d' % i
+            h = ketama.KetamaRing.hash(key)
+            after = [(p, v) for p, v in zip(ring._points, ring._values)
+                     if p >= h]
+            expected = after[0][1] if after else ring._values[0]
+            self.assertEqual(ring.get_node(key), expected)
+
+    def test_consistency(self):
+        """adding a node should only move keys onto the new node.
+        """
+        ring1 = make_ring(('a:1', 1), ('b:1', 1), ('c:1', 1))
+        ring2 = make_ring(('a:1', 1), ('b:1', 1), ('c:1', 1), ('d:1', 1))
+        moved = 0
+        for i in range(1000):
+            key = 'key_%d' % i
+            node1 = ring1.get_node(key)
+            node2 = ring2.get_node(key)
+            if node1 != node2:
+                self.assertEqual(node2, 'd:1')
+                moved += 1
+        self.assertTrue(100 < moved < 400)
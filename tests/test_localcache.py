@@ -0,0 +1,249 @@
+# -*- coding: utf8 -*-
+
+import sys
+import mock
+from pyermc import memcache
+from pyermc.localcache import LocalCache, MISSING
+from tests.helpers import make_client
+## we use some test harness stuff from python2.7.
+## if not on 2.7, try importing unittest2 for compat
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class TestLocalCache(unittest.TestCase):
+    def test_get_set(self):
+        cache = LocalCache()
+        self.assertEqual(cache.get('a'), (False, None))
+        cache.set('a', {'x': 1}, 10)
+        self.assertEqual(cache.get('a'), (True, {'x': 1}))
+        self.assertIn('a', cache)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.bytes, 10)
+        cache.set('a', 2, 3)
+        self.assertEqual(cache.bytes, 3)
+        cache.delete('a')
+        cache.delete('a')
+        self.assertEqual(cache.get('a'), (False, None))
+        self.assertEqual(cache.bytes, 0)
+
+    def test_ttl(self):
+        cache = LocalCache(ttl=10)
+        with mock.patch('time.time', return_value=100):
+            cache.set('a', 1, 1)
+        with mock.patch('time.time', return_value=109):
+            self.assertEqual(cache.get('a'), (True, 1))
+        with mock.patch('time.time', return_value=110):
+            self.assertEqual(cache.get('a'), (False, None))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.bytes, 0)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_max_entries(self):
+        """least recently used entries should be evicted first.
+        """
+        cache = LocalCache(max_entries=2)
+        cache.set('a', 1, 1)
+        cache.set('b', 2, 1)
+        cache.get('a')
+        cache.set('c', 3, 1)
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.get('c'), (True, 3))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_max_bytes(self):
+        cache = LocalCache(max_entries=None, max_bytes=10)
+        cache.set('a', 1, 6)
+        cache.set('b', 2, 4)
+        self.assertEqual(len(cache), 2)
+        cache.set('c', 3, 1)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.bytes, 5)
+        # too big to ever fit
+        cache.set('d', 4, 11)
+        self.assertNotIn('d', cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_stats(self):
+        cache = LocalCache()
+        self.assertEqual(cache.stats()['hit_ratio'], 0.0)
+        cache.set('a', 1, 2)
+        cache.get('a')
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual(cache.stats(), {
+            'entries': 1, 'bytes': 2, 'hits': 3, 'negative_hits': 0,
+            'misses': 1, 'hit_ratio': 0.75, 'evictions': 0, 'expirations': 0})
+        cache.reset_stats()
+        self.assertEqual(cache.hits, 0)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.bytes, 0)
+
+    def test_set_miss(self):
+        cache = LocalCache(miss_ttl=2)
+        with mock.patch('time.time', return_value=100):
+            cache.set_miss('a')
+            self.assertEqual(cache.get('a'), (True, MISSING))
+        self.assertEqual(cache.bytes, 0)
+        self.assertEqual(cache.negative_hits, 1)
+        self.assertEqual(cache.hits, 1)
+        with mock.patch('time.time', return_value=102):
+            self.assertEqual(cache.get('a'), (False, None))
+        # misses are not remembered by default
+        cache = LocalCache()
+        cache.set_miss('a')
+        self.assertNotIn('a', cache)
+
+    def test_misses_only(self):
+        cache = LocalCache(ttl=None, miss_ttl=2)
+        cache.set('a', 1, 1)
+        cache.set_miss('b')
+        self.assertNotIn('a', cache)
+        self.assertIn('b', cache)
+
+
+class TestClientLocalCache(unittest.TestCase):
+    def test_get(self):
+        """get() should be answered locally after the first fetch.
+        """
+        client = make_client(local_cache=LocalCache())
+        client._client.get.return_value = ['1', client._FLAG_INTEGER]
+        self.assertEqual(client.get('a'), 1)
+        self.assertEqual(client.get('a'), 1)
+        self.assertEqual(client._client.get.call_count, 1)
+        self.assertEqual(client.local_cache.hits, 1)
+        # gets always goes to the server
+        client._client.gets.return_value = ['2', 0, 5]
+        self.assertEqual(client.gets('a'), '2')
+
+    def test_get_multi(self):
+        """get_multi() should only fetch the keys not cached locally.
+        """
+        client = make_client(local_cache=LocalCache())
+        client.local_cache.set('a', 'x', 1)
+        client._client.get_multi.return_value = {'b': ['y', 0]}
+        self.assertEqual(client.get_multi(['a', 'b', 'c']),
+                         {'a': 'x', 'b': 'y'})
+        client._client.get_multi.assert_called_once_with(['b', 'c'])
+        self.assertEqual(client.get_multi(['a', 'b']), {'a': 'x', 'b': 'y'})
+        self.assertEqual(client._client.get_multi.call_count, 1)
+
+    def test_invalidate(self):
+        """writes through the client should drop the local copy.
+        """
+        client = make_client(local_cache=LocalCache())
+        client._client.set_multi.return_value = []
+        client._client.delete_multi.return_value = []
+        writes = [('set', ('a', 1)), ('add', ('a', 1)),
+                  ('replace', ('a', 1)), ('append', ('a', '1')),
+                  ('prepend', ('a', '1')), ('cas', ('a', 1)),
+                  ('delete', ('a',)), ('incr', ('a',)), ('decr', ('a',)),
+                  ('set_multi', ({'a': 1},)), ('delete_multi', (['a'],))]
+        for cmd, args in writes:
+            client.local_cache.set('a', 'x', 1)
+            getattr(client, cmd)(*args)
+            self.assertNotIn('a', client.local_cache, cmd)
+
+        client.local_cache.set('a', 'x', 1)
+        client.flush_all()
+        self.assertEqual(len(client.local_cache), 0)
+
+    def test_invalidate_error(self):
+        """a failed write should still drop the local copy.
+        """
+        client = make_client(local_cache=LocalCache())
+        client.local_cache.set('a', 'x', 1)
+        client._client.set.side_effect = IOError('boom')
+        with self.assertRaises(memcache.MemcacheDriverException):
+            client.set('a', 1)
+        self.assertNotIn('a', client.local_cache)
+
+    def test_pipeline(self):
+        client = make_client(local_cache=LocalCache())
+        client._client.pipeline_send.return_value = True
+        client._client.pipeline_recv.return_value = [['y', 0], True]
+        client.local_cache.set('b', 'x', 1)
+        with client.pipeline() as p:
+            p.get('a')
+            p.set('b', 1)
+            self.assertIn('b', client.local_cache)
+        self.assertEqual(p.results, ['y', True])
+        self.assertNotIn('b', client.local_cache)
+        self.assertEqual(client.local_cache.get('a'), (True, 'y'))
+
+    def test_get_miss(self):
+        """a miss should be answered locally, until written.
+        """
+        client = make_client(local_cache=LocalCache(miss_ttl=2))
+        client._client.get.return_value = None
+        self.assertIsNone(client.get('a'))
+        self.assertIsNone(client.get('a'))
+        self.assertEqual(client._client.get.call_count, 1)
+        self.assertEqual(client.local_cache.negative_hits, 1)
+        client._client.set.return_value = True
+        client.set('a', 'x')
+        client._client.get.return_value = ['x', 0]
+        self.assertEqual(client.get('a'), 'x')
+        self.assertEqual(client._client.get.call_count, 2)
+
+    def test_get_miss_error(self):
+        """a masked error is not a miss.
+        """
+        client = make_client(local_cache=LocalCache(miss_ttl=2))
+        client.error_as_miss = True
+        client._client.get.side_effect = IOError('boom')
+        self.assertIsNone(client.get('a'))
+        self.assertNotIn('a', client.local_cache)
+
+    def test_get_multi_miss(self):
+        client = make_client(local_cache=LocalCache(miss_ttl=2))
+        client._client.get_multi.return_value = {'a': ['x', 0]}
+        self.assertEqual(client.get_multi(['a', 'b']), {'a': 'x'})
+        self.assertEqual(client.get_multi(['a', 'b']), {'a': 'x'})
+        self.assertEqual(client._client.get_multi.call_count, 1)
+        self.assertIsNone(client.get('b'))
+        self.assertFalse(client._client.get.called)
+        client.delete('b')
+        client._client.get_multi.return_value = {'b': ['y', 0]}
+        self.assertEqual(client.get_multi(['a', 'b']), {'a': 'x', 'b': 'y'})
+        client._client.get_multi.assert_called_with(['b'])
+
+    def test_iter_multi(self):
+        """iter_multi() should yield local hits first, and cache what it
+        fetches, misses included.
+        """
+        client = make_client(local_cache=LocalCache(miss_ttl=2))
+        client.local_cache.set('a', 'x', 1)
+        client._client.iter_multi.return_value = iter([('b', ['y', 0])])
+        self.assertEqual(list(client.iter_multi(['a', 'b', 'c'])),
+                         [('a', 'x'), ('b', 'y')])
+        client._client.iter_multi.assert_called_with(['b', 'c'])
+        self.assertEqual(client.local_cache.get('b'), (True, 'y'))
+        self.assertEqual(client.local_cache.get('c'), (True, MISSING))
+        self.assertEqual(list(client.iter_multi(['a', 'b', 'c'])),
+                         [('a', 'x'), ('b', 'y')])
+        self.assertEqual(client._client.iter_multi.call_count, 1)
+
+    def test_pipeline_miss(self):
+        client = make_client(local_cache=LocalCache(miss_ttl=2))
+        client._client.pipeline_send.return_value = True
+        client._client.pipeline_recv.return_value = [None, {}]
+        with client.pipeline() as p:
+            p.get('a')
+            p.get_multi(['b'])
+        self.assertEqual(p.results, [None, {}])
+        self.assertEqual(client.local_cache.get('a'), (True, MISSING))
+        self.assertEqual(client.local_cache.get('b'), (True, MISSING))
+
+        client.error_as_miss = True
+        client._client.pipeline_recv.side_effect = IOError('boom')
+        with client.pipeline() as p:
+            p.get('c')
+            p.get_multi(['d'])
+        self.assertEqual(p.results, [None, {}])
+        self.assertEqual(len(client.local_cache), 2)
@@ -0,0 +1,135 @@
+# -*- coding: utf8 -*-
+
+import sys
+from pyermc import memcache
+from pyermc.pipeline import Pipeline
+from tests.helpers import make_client
+## we use some test harness stuff from python2.7.
+## if not on 2.7, try importing unittest2 for compat
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class TestPipeline(unittest.TestCase):
+    def test_pipeline(self):
+        client = make_client()
+        p = client.pipeline()
+        self.assertIsInstance(p, Pipeline)
+        self.assertIs(p.client, client)
+        self.assertEqual(len(p), 0)
+
+    def test_queue(self):
+        """queued commands should be sent to the driver as a single batch,
+        and responses unpacked like the matching Client method would.
+        """
+        client = make_client()
+        client._client.pipeline_recv.return_value = [
+            ['1', memcache.Client._FLAG_INTEGER], 3, True, None,
+            {'e': ['x', 0]}]
+        with client.pipeline() as p:
+            self.assertIs(p.get(u'a'), p)
+            p.incr('b', -2)
+            p.set('c', 1, time=5)
+            p.delete('d', noreply=True)
+            p.get_multi(['e', 'f'])
+            self.assertEqual(len(p), 5)
+            self.assertFalse(client._client.pipeline_send.called)
+        client._client.pipeline_send.assert_called_once_with([
+            ('get', ('a',)),
+            ('decr', ('b', 2)),
+            ('set', ('c', '1', 5, memcache.Client._FLAG_INTEGER)),
+            ('delete', ('d',), {'noreply': True}),
+            ('get_multi', (['e', 'f'],))])
+        self.assertEqual(p.results, [1, 3, True, None, {'e': 'x'}])
+        self.assertEqual(len(p), 0)
+
+    def test_gets_cas(self):
+        """gets should cache CAS_IDs when executed, and cas should use the
+        CAS_ID known when queued.
+        """
+        client = make_client(cache_cas=True)
+        client.cas_ids = {'b': 7}
+        client._client.pipeline_recv.return_value = [['x', 0, 12], True]
+        p = client.pipeline()
+        p.gets('a')
+        p.cas('b', 'y')
+        self.assertEqual(p.execute(), ['x', True])
+        self.assertEqual(client.cas_ids, {'a': 12, 'b': 7})
+        commands = client._client.pipeline_send.call_args[0][0]
+        self.assertEqual(commands[1], ('cas', ('b', 'y', 7, 0, 0)))
+
+    def test_multi(self):
+        """set_multi/delete_multi should map failed keys back, and empty
+        ones should not be sent at all.
+        """
+        client = make_client()
+        client._client.pipeline_recv.return_value = [['b'], []]
+        p = client.pipeline()
+        p.set_multi({})
+        p.set_multi({'a': 'x', 'b': 'y'})
+        p.delete_multi([u'a'])
+        p.delete_multi([])
+        self.assertEqual(p.execute(), [[], ['b'], [], []])
+        commands = client._client.pipeline_send.call_args[0][0]
+        self.assertEqual([c[0] for c in commands],
+                         ['set_multi', 'delete_multi'])
+
+    def test_multi_noreply(self):
+        """noreply set_multi/delete_multi should report no failed keys,
+        whatever the driver answered.
+        """
+        client = make_client()
+        client._client.pipeline_recv.return_value = [None, None, None]
+        p = client.pipeline()
+        p.set_multi({'a': 1, 'b': 2}, noreply=True)
+        p.delete_multi(['a', 'b'], noreply=True)
+        p.delete('c', noreply=True)
+        self.assertEqual(p.execute(), [[], [], None])
+
+    def test_empty(self):
+        client = make_client()
+        self.assertEqual(client.pipeline().execute(), [])
+        self.assertFalse(client._client.pipeline_send.called)
+
+    def test_exception(self):
+        """queued commands should be dropped if the with block raises.
+        """
+        client = make_client()
+        with self.assertRaises(ValueError):
+            with client.pipeline() as p:
+                p.get('a')
+                raise ValueError('boom')
+        self.assertEqual(len(p), 0)
+        self.assertIsNone(p.results)
+        self.assertFalse(client._client.pipeline_send.called)
+
+    def test_error_as_miss(self):
+        """a masked error should give the results of a missed command.
+        """
+        client = make_client(error_as_miss=True)
+        client._client.pipeline_recv.side_effect = IOError('boom')
+        p = client.pipeline()
+        p.get('a')
+        p.set_multi({'b': 1})
+        self.assertEqual(p.execute(), [None, ['b']])
+
+    def test_error(self):
+        client = make_client()
+        driver = client._client
+        driver.pipeline_recv.side_effect = IOError('boom')
+        p = client.pipeline()
+        p.get('a')
+        with self.assertRaises(memcache.MemcacheDriverException):
+            p.execute()
+        driver.close.assert_called_with()
+
+    def test_check_key(self):
+        client = make_client()
+        p = client.pipeline()
+        with self.assertRaises(memcache.MemcacheKeyError):
+            p.get('bad key')
+        with self.assertRaises(TypeError):
+            p.incr('a', 'b')
+        self.assertEqual(len(p), 0)
@@ -0,0 +1,144 @@
+# -*- coding: utf8 -*-
+
+import sys
+import mock
+import threading
+from pyermc import memcache, pool
+from pyermc.driver.noop import NoopDriver
+from tests.helpers import make_pool
+## we use some test harness stuff from python2.7.
+## if not on 2.7, try importing unittest2 for compat
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class TestClientPool(unittest.TestCase):
+    def test_init_bad_size(self):
+        with self.assertRaises(ValueError):
+            make_pool(max_size=0)
+
+    def test_get_creates_clients(self):
+        """get() should lazily create clients using the pool's client args.
+        """
+        p = make_pool(max_size=2)
+        self.assertEqual(len(p), 0)
+        client = p.get()
+        self.assertIsInstance(client, memcache.Client)
+        self.assertEqual(client.host, '1.2.3.4')
+        self.assertEqual(client.port, 5678)
+        self.assertIsInstance(client._client, NoopDriver)
+        self.assertEqual(len(p), 1)
+        self.assertEqual(p.idle, 0)
+
+    def test_put_reuses_clients(self):
+        """put() should make a client available to the next get().
+        """
+        p = make_pool(max_size=2)
+        client = p.get()
+        p.put(client)
+        self.assertEqual(p.idle, 1)
+        self.assertIs(p.get(), client)
+        self.assertEqual(len(p), 1)
+
+    def test_put_foreign_client(self):
+        p = make_pool()
+        with self.assertRaises(ValueError):
+            p.put(memcache.Client(client_driver=NoopDriver))
+
+    def test_get_nonblocking_exhausted(self):
+        """get(block=False) should raise when the pool is full.
+        """
+        p = make_pool(max_size=1)
+        p.get()
+        with self.assertRaises(pool.MemcachePoolExhausted):
+            p.get(block=False)
+
+    def test_get_blocking_timeout(self):
+        """get() should raise after timeout when the pool stays full.
+        """
+        p = make_pool(max_size=1)
+        p.get()
+        with self.assertRaisesRegexp(pool.MemcachePoolExhausted, 'Timed out'):
+            p.get(timeout=0.01)
+
+    def test_get_blocking_waits_for_put(self):
+        """get() should wake up when another thread puts a client back.
+        """
+        p = make_pool(max_size=1)
+        client = p.get()
+        timer = threading.Timer(0.01, p.put, [client])
+        timer.start()
+        self.assertIs(p.get(timeout=5), client)
+        timer.join()
+
+    def test_reserve(self):
+        """reserve() should check a client out and put it back on exit, even
+        when the block raises.
+        """
+        p = make_pool(max_size=1)
+        with p.reserve() as client:
+            self.assertEqual(p.idle, 0)
+        self.assertEqual(p.idle, 1)
+        with self.assertRaises(RuntimeError):
+            with p.reserve() as client2:
+                raise RuntimeError()
+        self.assertIs(client2, client)
+        self.assertEqual(p.idle, 1)
+
+    @mock.patch('pyermc.pool.time.time')
+    def test_idle_timeout(self, mock_time):
+        """clients idle for longer than idle_timeout should be replaced.
+        """
+        mock_time.return_value = 100
+        p = make_pool(max_size=1, idle_timeout=10)
+        client = p.get()
+        client.close = mock.Mock()
+        p.put(client)
+        mock_time.return_value = 109
+        self.assertIs(p.get(), client)
+        p.put(client)
+        mock_time.return_value = 119
+        self.assertIsNot(p.get(), client)
+        client.close.assert_called_with()
+        self.assertEqual(len(p), 1)
+
+    @mock.patch('pyermc.pool.time.time')
+    def test_max_lifetime(self, mock_time):
+        """clients older than max_lifetime should be replaced.
+        """
+        mock_time.return_value = 100
+        p = make_pool(max_size=1, max_lifetime=10)
+        client = p.get()
+        client.close = mock.Mock()
+        mock_time.return_value = 110
+        p.put(client)
+        client.close.assert_called_with()
+        self.assertEqual(len(p), 0)
+        self.assertIsNot(p.get(), client)
+
+    def test_client_creation_error(self):
+        """a failure creating a client should not leak a pool slot.
+        """
+        p = pool.ClientPool(max_size=1, client_driver=None)
+        with self.assertRaises(TypeError):
+            p.get()
+        self.assertEqual(len(p), 0)
+
+    def test_close(self):
+        """close() should close idle clients, and clients put back later.
+        """
+        p = make_pool(max_size=2)
+        client1 = p.get()
+        client2 = p.get()
+        client1.close = mock.Mock()
+        client2.close = mock.Mock()
+        p.put(client1)
+        p.close()
+        client1.close.assert_called_with()
+        p.put(client2)
+        client2.close.assert_called_with()
+        self.assertEqual(len(p), 0)
+        with self.assertRaises(pool.MemcachePoolExhausted):
+            p.get()
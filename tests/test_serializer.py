@@ -0,0 +1,86 @@
+# -*- coding: utf8 -*-
+
+import sys
+import json
+import lz4
+from pyermc import memcache
+from pyermc.serializer import (
+    Serializer, PickleSerializer, FLAG_PICKLE, FLAG_INTEGER, FLAG_LONG)
+from pyermc.driver.noop import NoopDriver
+## we use some test harness stuff from python2.7.
+## if not on 2.7, try importing unittest2 for compat
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class JSONSerializer(Serializer):
+    FLAG_JSON = 1<<8
+
+    def dumps(self, val):
+        return self.FLAG_JSON, json.dumps(val)
+
+    def loads(self, buf, flags):
+        assert flags == self.FLAG_JSON
+        return json.loads(buf)
+
+
+class TestPickleSerializer(unittest.TestCase):
+    def test_flags(self):
+        self.assertEqual(FLAG_PICKLE, memcache.Client._FLAG_PICKLE)
+        self.assertEqual(FLAG_INTEGER, memcache.Client._FLAG_INTEGER)
+        self.assertEqual(FLAG_LONG, memcache.Client._FLAG_LONG)
+
+    def test_round_trip(self):
+        serializer = PickleSerializer()
+        for val, flags in [('x', 0), (1, FLAG_INTEGER), (2L, FLAG_LONG),
+                           ({'a': [1]}, FLAG_PICKLE)]:
+            result = serializer.dumps(val)
+            self.assertEqual(result[0], flags)
+            self.assertEqual(serializer.loads(result[1], flags), val)
+
+    def test_buffers(self):
+        """buffers should be stored as is, and read back as str.
+        """
+        serializer = PickleSerializer()
+        for val in [bytearray('xy'), memoryview('xy')]:
+            flags, buf = serializer.dumps(val)
+            self.assertEqual(flags, 0)
+            self.assertIs(buf, val)
+            self.assertEqual(serializer.loads(str(bytearray(buf)), 0), 'xy')
+
+    def test_no_pickle(self):
+        serializer = PickleSerializer(pickle=False)
+        val = {'a': 1}
+        self.assertEqual(serializer.dumps(val), (0, val))
+
+    def test_unknown_flags(self):
+        with self.assertRaises(ValueError):
+            PickleSerializer().loads('x', 1<<8)
+
+
+class TestClientSerializer(unittest.TestCase):
+    def test_default(self):
+        client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver,
+                                 pickle_proto=1)
+        self.assertIsInstance(client.serializer, PickleSerializer)
+        self.assertEqual(client.serializer.pickle_proto, 1)
+
+    def test_custom(self):
+        """a custom serializer should be used both ways, and never see the
+        compression flag.
+        """
+        client = memcache.Client('127.0.0.1', 11211, client_driver=NoopDriver,
+                                 serializer=JSONSerializer())
+        val = {'a': 'b' * 100}
+        flags, sval = client._val_to_store_info(val, 0)
+        self.assertEqual((flags, sval), (JSONSerializer.FLAG_JSON,
+                                         json.dumps(val)))
+        self.assertEqual(client._recv_value(sval, flags), val)
+
+        flags, sval = client._val_to_store_info(val, 10)
+        self.assertEqual(flags, JSONSerializer.FLAG_JSON |
+                         memcache.Client._FLAG_COMPRESSED)
+        self.assertEqual(lz4.decompress(sval), json.dumps(val))
+        self.assertEqual(client._recv_value(sval, flags), val)
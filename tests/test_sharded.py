@@ -0,0 +1,265 @@
+# -*- coding: utf8 -*-
+
+import sys
+import mock
+from mock import sentinel
+import pyermc
+from pyermc import memcache, sharded
+from tests.helpers import make_sharded_client
+## we use some test harness stuff from python2.7.
+## if not on 2.7, try importing unittest2 for compat
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+SERVERS = ['10.0.0.1:11211', ('10.0.0.2', 11211), ('10.0.0.3', '11212', 2)]
+
+
+class TestShardedClient(unittest.TestCase):
+    def test_init(self):
+        client = make_sharded_client(SERVERS, timeout=22)
+        self.assertEqual(client.servers, [('10.0.0.1', 11211, 1),
+                                          ('10.0.0.2', 11211, 1),
+                                          ('10.0.0.3', 11212, 2)])
+        self.assertEqual(len(client.clients), 3)
+        for c, (host, port, weight) in zip(client.clients, client.servers):
+            self.assertIsInstance(c, memcache.Client)
+            self.assertEqual(c.host, host)
+            self.assertEqual(c.port, port)
+            self.assertEqual(c.timeout, 22)
+        self.assertEqual(len(client._ring), 3 * 160)
+
+    def test_init_bad_servers(self):
+        with self.assertRaises(ValueError):
+            sharded.ShardedClient([])
+        with self.assertRaises(ValueError):
+            sharded.ShardedClient(['localhost'])
+        with self.assertRaises(ValueError):
+            sharded.ShardedClient([('localhost',)])
+
+    def test_get_client(self):
+        """get_client() should route through the ring, after key checks.
+        """
+        client = make_sharded_client(SERVERS)
+        for i in range(50):
+            key = 'key_%d' % i
+            self.assertIs(client.get_client(key),
+                          client._ring.get_node(key))
+        self.assertIs(client.get_client(u'üî'),
+                      client._ring.get_node(u'üî'.encode('utf-8')))
+        with self.assertRaises(memcache.MemcacheKeyError):
+            client.get_client('bad key')
+
+    def test_routing(self):
+        """single key commands should go to the client owning the key.
+        """
+        client = make_sharded_client(SERVERS)
+        owner = client.get_client('foo')
+        calls = [('incr', ('foo', 1, False)), ('decr', ('foo', 1, True)),
+                 ('delete', ('foo', True)), ('get', ('foo',)),
+                 ('gets', ('foo',)), ('add', ('foo', 'v', 0, 0, False)),
+                 ('append', ('foo', 'v', 0, 0, True)),
+                 ('prepend', ('foo', 'v', 0, 0, False)),
+                 ('replace', ('foo', 'v', 0, 0, True)),
+                 ('set', ('foo', 'v', 0, 0, True)),
+                 ('cas', ('foo', 'v', 0, 0))]
+        for cmd, args in calls:
+            with mock.patch.object(owner, cmd) as mock_cmd:
+                mock_cmd.return_value = sentinel.result
+                self.assertIs(getattr(client, cmd)(*args), sentinel.result)
+                mock_cmd.assert_called_with(*args)
+
+    def test_get_multi(self):
+        """get_multi() should send each server only the keys it owns, and
+        merge the results.
+        """
+        client = make_sharded_client(SERVERS)
+        keys = ['key_%d' % i for i in range(30)]
+        owners = {}
+        for key in keys:
+            owners.setdefault(client.get_client(key), []).append(key)
+        self.assertEqual(len(owners), 3)
+        for c in client.clients:
+            c._client.get_multi = mock.Mock(
+                side_effect=lambda ks: dict((k, [k.upper(), 0]) for k in ks))
+        result = client.get_multi(keys)
+        self.assertEqual(result, dict((k, k.upper()) for k in keys))
+        for c, owned in owners.items():
+            c._client.get_multi.assert_called_once_with(owned)
+
+    def test_iter_multi(self):
+        """iter_multi() should iterate over each server's keys in turn.
+        """
+        client = make_sharded_client(SERVERS)
+        keys = ['key_%d' % i for i in range(30)]
+        for c in client.clients:
+            c._client.iter_multi = mock.Mock(
+                side_effect=lambda ks: ((k, [k.upper(), 0]) for k in ks))
+        result = list(client.iter_multi(keys))
+        self.assertEqual(sorted(result), sorted((k, k.upper()) for k in keys))
+        self.assertEqual(len(result), len(keys))
+
+    def test_get_multi_local_cache(self):
+        """get_multi() should not fan out keys found in a local cache.
+        """
+        cache = pyermc.LocalCache()
+        client = make_sharded_client(SERVERS, local_cache=cache)
+        keys = ['key_%d' % i for i in range(30)]
+        for key in keys[1:]:
+            cache.set(key, key.upper(), 1)
+        owner = client.get_client(keys[0])
+        for c in client.clients:
+            c._client = mock.Mock()
+            c._client.pipeline_send.return_value = True
+            c._client.pipeline_recv.return_value = [{keys[0]: ['x', 0]}]
+        result = client.get_multi(keys)
+        self.assertEqual(result[keys[0]], 'x')
+        self.assertEqual(result[keys[1]], keys[1].upper())
+        for c in client.clients:
+            self.assertEqual(c._client.pipeline_send.called, c is owner)
+        owner._client.pipeline_send.assert_called_with(
+            [('get_multi', ([keys[0]],))])
+
+    def test_get_multi_single_server(self):
+        """get_multi() should skip the fan out when one server owns all keys.
+        """
+        client = make_sharded_client(SERVERS)
+        owner = client.get_client('foo')
+        with mock.patch.object(owner, 'get_multi') as mock_get_multi:
+            mock_get_multi.return_value = sentinel.result
+            self.assertIs(client.get_multi(['foo']), sentinel.result)
+            mock_get_multi.assert_called_with(['foo'])
+
+    def test_get_multi_fan_out(self):
+        """get_multi() should send to every server before reading any
+        response.
+        """
+        client = make_sharded_client(SERVERS)
+        calls = []
+        for i, c in enumerate(client.clients):
+            c._client = mock.Mock()
+            c._client.pipeline_send.side_effect = (
+                lambda cmds, i=i: calls.append(('send', i)) or True)
+            c._client.pipeline_recv.side_effect = (
+                lambda i=i: calls.append(('recv', i)) or [{}])
+        client.get_multi(['key_%d' % i for i in range(30)])
+        self.assertEqual([c[0] for c in calls], ['send'] * 3 + ['recv'] * 3)
+
+    @mock.patch('pyermc.sharded.MULTI_WINDOW', 2)
+    def test_get_multi_rounds(self):
+        """get_multi() should send at most a window of keys to each server,
+        and read every server's responses before sending the next round.
+        """
+        client = make_sharded_client(SERVERS)
+        keys = ['key_%d' % i for i in range(30)]
+        calls = []
+        for i, c in enumerate(client.clients):
+            c._client = mock.Mock()
+            def send(cmds, i=i):
+                calls.append(('send', i, cmds[0][1][0]))
+                return True
+            def recv(i=i):
+                sent = [c[2] for c in calls if c[:2] == ('send', i)][-1]
+                calls.append(('recv', i, sent))
+                return [dict((key, [key, 0]) for key in sent)]
+            c._client.pipeline_send.side_effect = send
+            c._client.pipeline_recv.side_effect = recv
+        self.assertEqual(client.get_multi(keys),
+                         dict((key, key) for key in keys))
+        in_flight = set()
+        for op, i, sent in calls:
+            self.assertLessEqual(len(sent), 2)
+            if op == 'send':
+                self.assertNotIn(i, in_flight)
+                in_flight.add(i)
+            else:
+                in_flight.remove(i)
+        self.assertEqual(in_flight, set())
+        sends = [c for c in calls if c[0] == 'send']
+        self.assertEqual(sorted(k for c in sends for k in c[2]), sorted(keys))
+        # the first round goes to every server before any is read
+        self.assertEqual([c[0] for c in calls[:4]], ['send'] * 3 + ['recv'])
+
+    def test_get_multi_error(self):
+        """get_multi() should close clients whose responses were not read
+        when another server fails.
+        """
+        client = make_sharded_client(SERVERS)
+        for c in client.clients:
+            c._client = mock.Mock()
+            c._client.pipeline_send.return_value = True
+            c._client.pipeline_recv.return_value = [{}]
+        groups = client._group_keys(['key_%d' % i for i in range(30)])
+        groups[0][0]._client.pipeline_recv.side_effect = IOError('boom')
+        drivers = [c._client for c in client.clients]
+        with self.assertRaises(memcache.MemcacheDriverException):
+            client.get_multi(['key_%d' % i for i in range(30)])
+        for driver in drivers:
+            driver.close.assert_called_with()
+
+    def test_set_multi(self):
+        """set_multi() should send each server only the items it owns, and
+        merge the failed keys.
+        """
+        client = make_sharded_client(SERVERS)
+        keys = ['key_%d' % i for i in range(30)]
+        owners = {}
+        for key in keys:
+            owners.setdefault(client.get_client(key), []).append(key)
+        for c in client.clients:
+            c._client.set_multi = mock.Mock(
+                side_effect=lambda items, time, noreply: [items[0][0]])
+        failed = client.set_multi(dict((k, k) for k in keys))
+        self.assertEqual(len(failed), 3)
+        for c, owned in owners.items():
+            items = c._client.set_multi.call_args[0][0]
+            self.assertEqual(sorted(i[0] for i in items), sorted(owned))
+
+    def test_delete_multi(self):
+        """delete_multi() should send each server only the keys it owns.
+        """
+        client = make_sharded_client(SERVERS)
+        keys = ['key_%d' % i for i in range(30)]
+        for c in client.clients:
+            c._client.delete_multi = mock.Mock(return_value=[])
+        self.assertEqual(client.delete_multi(keys), [])
+        self.assertEqual(client.delete_multi([]), [])
+        sent = []
+        for c in client.clients:
+            sent.extend(c._client.delete_multi.call_args[0][0])
+        self.assertEqual(sorted(sent), sorted(keys))
+
+    def test_sync(self):
+        """sync() should collect failed keys from every server.
+        """
+        client = make_sharded_client(SERVERS)
+        for i, c in enumerate(client.clients):
+            c._client = mock.Mock()
+            c._client.sync.return_value = ['key_%d' % i]
+        self.assertEqual(client.sync(), ['key_0', 'key_1', 'key_2'])
+
+    def test_flush_all(self):
+        client = make_sharded_client(SERVERS)
+        for c in client.clients:
+            c.flush_all = mock.Mock(return_value=True)
+        self.assertTrue(client.flush_all())
+        client.clients[1].flush_all.return_value = False
+        self.assertFalse(client.flush_all())
+        for c in client.clients:
+            self.assertEqual(c.flush_all.call_count, 2)
+
+    def test_stats(self):
+        client = make_sharded_client(SERVERS)
+        self.assertEqual(client.stats(), {'10.0.0.1:11211': {},
+                                          '10.0.0.2:11211': {},
+                                          '10.0.0.3:11212': {}})
+
+    def test_close(self):
+        client = make_sharded_client(SERVERS)
+        for c in client.clients:
+            c.close = mock.Mock()
+        client.close()
+        for c in client.clients:
+            c.close.assert_called_with()